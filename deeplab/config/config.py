@@ -30,8 +30,16 @@ config.network.pretrained = '../model/pretrained_model/resnet_v1-101'
 config.network.pretrained_epoch = 0
 config.network.PIXEL_MEANS = np.array([103.06, 115.90, 123.15])
 config.network.IMAGE_STRIDE = 0
+# executors of other input shapes than the maximum ones kept for reuse, 0 rebinds on every shape change
+config.network.EXECUTOR_CACHE_SIZE = 8
 config.network.FIXED_PARAMS = ['conv1', 'bn_conv1', 'res2', 'bn2', 'gamma', 'beta']
 
+# on-disk cache of decoded and resized images, empty PATH disables it
+config.IMAGE_CACHE = edict()
+config.IMAGE_CACHE.PATH = ''
+# size cap in MB, least recently used images are evicted beyond it, 0 for unlimited
+config.IMAGE_CACHE.MAX_SIZE = 0
+
 # dataset related params
 config.dataset = edict()
 config.dataset.dataset = 'cityscapes'
@@ -64,10 +72,18 @@ config.TRAIN.SHUFFLE = True
 config.TRAIN.ENABLE_OHEM = False
 # size of images for each device, 2 for rcnn, 1 for rpn and e2e
 config.TRAIN.BATCH_IMAGES = 1
+# time the phases of every training batch and log their rolling p50/p95 with the speed
+config.TRAIN.PHASE_TIMING = False
+# wait for the devices at the end of every phase, the phases are exact but training is slower
+config.TRAIN.PHASE_TIMING_SYNC = False
+# if given, a json line with the phase times of every batch is appended to this file
+config.TRAIN.PHASE_TRACE = ''
 
 config.TEST = edict()
 # size of images for each device
 config.TEST.BATCH_IMAGES = 1
+# write the pred segmentations as pngs, from a background thread while testing
+config.TEST.WRITE_SEGMENTATION = True
 
 # Test Model Epoch
 config.TEST.test_epoch = 0
@@ -23,9 +23,10 @@ class Predictor(object):
     def __init__(self, symbol, data_names, label_names,
                  context=mx.cpu(), max_data_shapes=None,
                  provide_data=None, provide_label=None,
-                 arg_params=None, aux_params=None):
+                 arg_params=None, aux_params=None, max_cached_modules=8, shape_quantum=0):
         self._mod = MutableModule(symbol, data_names, label_names,
-                                  context=context, max_data_shapes=max_data_shapes)
+                                  context=context, max_data_shapes=max_data_shapes,
+                                  max_cached_modules=max_cached_modules, shape_quantum=shape_quantum)
         self._mod.bind(provide_data, provide_label, for_training=False)
         self._mod.init_params(arg_params=arg_params, aux_params=aux_params)
 
@@ -73,7 +74,9 @@ def pred_eval(predictor, test_data, imdb, vis=False, ignore_cache=None, logger=N
         test_data = PrefetchingIter(test_data)
 
     num_images = imdb.num_images
-    all_segmentation_result = [[] for _ in xrange(num_images)]
+    # the confusion matrix is updated per batch and the maps are dropped if the dataset supports it
+    evaluator = imdb.segmentation_evaluator(config.TEST.WRITE_SEGMENTATION)
+    all_segmentation_result = [[] for _ in xrange(num_images)] if evaluator is None else None
     idx = 0
 
     data_time, net_time, post_time = 0.0, 0.0, 0.0
@@ -86,7 +89,13 @@ def pred_eval(predictor, test_data, imdb, vis=False, ignore_cache=None, logger=N
         t2 = time.time() - t
         t = time.time()
 
-        all_segmentation_result[idx: idx+test_data.batch_size] = [output.astype('int8') for output in output_all]
+        if evaluator is not None:
+            for delta, output in enumerate(output_all):
+                # the last batch may be padded
+                if idx + delta < num_images:
+                    evaluator.add(idx + delta, output.astype('int8'))
+        else:
+            all_segmentation_result[idx: idx+test_data.batch_size] = [output.astype('int8') for output in output_all]
 
         idx += test_data.batch_size
         t3 = time.time() - t
@@ -99,7 +108,10 @@ def pred_eval(predictor, test_data, imdb, vis=False, ignore_cache=None, logger=N
         if logger:
             logger.info('testing {}/{} data {:.4f}s net {:.4f}s post {:.4f}s'.format(idx, imdb.num_images, data_time / idx * test_data.batch_size, net_time / idx * test_data.batch_size, post_time / idx * test_data.batch_size))
 
-    evaluation_results = imdb.evaluate_segmentations(all_segmentation_result)
+    if evaluator is not None:
+        evaluation_results = evaluator.evaluate()
+    else:
+        evaluation_results = imdb.evaluate_segmentations(all_segmentation_result)
 
     if not os.path.exists(res_file) or ignore_cache:
         with open(res_file, 'wb') as f:
@@ -71,7 +71,8 @@ def test_deeplab(network, dataset, image_set, root_path, dataset_path,
     predictor = Predictor(sym, data_names, label_names,
                           context=ctx, max_data_shapes=max_data_shape,
                           provide_data=test_data.provide_data, provide_label=test_data.provide_label,
-                          arg_params=arg_params, aux_params=aux_params)
+                          arg_params=arg_params, aux_params=aux_params,
+                          max_cached_modules=config.network.EXECUTOR_CACHE_SIZE)
 
     # start detection
     pred_eval(predictor, test_data, imdb, vis=vis, logger=logger)
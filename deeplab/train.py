@@ -109,7 +109,8 @@ def train_net(args, ctx, pretrained, epoch, prefix, begin_epoch, end_epoch, lr,
 
     mod = MutableModule(sym, data_names=data_names, label_names=label_names,
                         logger=logger, context=ctx, max_data_shapes=[max_data_shape for _ in xrange(batch_size)],
-                        max_label_shapes=[max_label_shape for _ in xrange(batch_size)], fixed_param_prefix=fixed_param_prefix)
+                        max_label_shapes=[max_label_shape for _ in xrange(batch_size)], fixed_param_prefix=fixed_param_prefix,
+                        max_cached_modules=config.network.EXECUTOR_CACHE_SIZE)
 
     # decide training params
     # metric
@@ -147,10 +148,15 @@ def train_net(args, ctx, pretrained, epoch, prefix, begin_epoch, end_epoch, lr,
         train_data = PrefetchingIter(train_data)
 
     # train
+    phase_timer = callback.PhaseTimer(trace_file=config.TRAIN.PHASE_TRACE, sync=config.TRAIN.PHASE_TIMING_SYNC) \
+        if config.TRAIN.PHASE_TIMING else None
     mod.fit(train_data, eval_metric=eval_metrics, epoch_end_callback=epoch_end_callback,
             batch_end_callback=batch_end_callback, kvstore=config.default.kvstore,
             optimizer='sgd', optimizer_params=optimizer_params,
-            arg_params=arg_params, aux_params=aux_params, begin_epoch=begin_epoch, num_epoch=end_epoch)
+            arg_params=arg_params, aux_params=aux_params, begin_epoch=begin_epoch, num_epoch=end_epoch,
+            phase_timer=phase_timer)
+    if phase_timer is not None:
+        phase_timer.close()
 
 def main():
     print 'Called with argument:', args
@@ -7,9 +7,14 @@
 # --------------------------------------------------------
 
 import time
+import json
 import logging
+from collections import deque
+import numpy as np
 import mxnet as mx
 
+from operator_py import profiler as op_profiler
+
 
 class Speedometer(object):
     def __init__(self, batch_size, frequent=50):
@@ -28,16 +33,24 @@ class Speedometer(object):
 
         if self.init:
             if count % self.frequent == 0:
+                # metrics are accumulated on device, reading them waits for the queued batches
+                if param.eval_metric is not None:
+                    name, value = param.eval_metric.get()
                 speed = self.frequent * self.batch_size / (time.time() - self.tic)
                 s = ''
                 if param.eval_metric is not None:
-                    name, value = param.eval_metric.get()
                     s = "Epoch[%d] Batch [%d]\tSpeed: %.2f samples/sec\tTrain-" % (param.epoch, count, speed)
                     for n, v in zip(name, value):
                         s += "%s=%f,\t" % (n, v)
                 else:
                     s = "Iter[%d] Batch [%d]\tSpeed: %.2f samples/sec" % (param.epoch, count, speed)
 
+                phase_timer = param.locals.get('phase_timer') if param.locals is not None else None
+                if phase_timer is not None:
+                    s += "\tPhases: %s" % phase_timer.summary()
+                if op_profiler.enabled():
+                    s += "\tOps: %s" % op_profiler.summary(reset_stats=True)
+
                 logging.info(s)
                 print(s)
                 self.tic = time.time()
@@ -46,6 +59,81 @@ class Speedometer(object):
             self.tic = time.time()
 
 
+class PhaseTimer(object):
+    """
+    wall time of the phases of every training batch, passed to MutableModule.fit
+    rolling p50/p95 of each phase are appended to the Speedometer log
+    """
+    PHASES = ['data', 'forward_backward', 'update', 'update_metric', 'callback']
+
+    def __init__(self, window=100, trace_file=None, sync=False):
+        """
+        :param window: number of recent batches the percentiles are computed over
+        :param trace_file: if given, one json line with the phase times of every batch is appended to it
+        :param sync: wait for the devices at the end of each phase, else device work is
+                     attributed to the phase that happens to wait for it. Waiting serializes
+                     the device pipeline, so the logged speed is lower than without timing
+        """
+        self.sync = sync
+        self.times = dict([(phase, deque(maxlen=window)) for phase in self.PHASES])
+        self.trace = open(trace_file, 'a') if trace_file else None
+        self.batch_times = dict()
+        self.tic = time.time()
+
+    def start(self):
+        """
+        start timing the next batch, the time until the first lap is the data phase
+        :return: None
+        """
+        self.batch_times = dict()
+        self.tic = time.time()
+
+    def lap(self, phase):
+        """
+        end a phase of the current batch
+        :param phase: one of PHASES
+        :return: None
+        """
+        if self.sync:
+            mx.nd.waitall()
+        toc = time.time()
+        self.batch_times[phase] = toc - self.tic
+        self.tic = toc
+
+    def end_batch(self, epoch, nbatch):
+        """
+        record the phases of the current batch and start the next one
+        :return: None
+        """
+        for phase, seconds in self.batch_times.items():
+            self.times[phase].append(seconds)
+        if self.trace is not None:
+            record = dict(self.batch_times)
+            record.update({'epoch': epoch, 'batch': nbatch, 'time': time.time()})
+            self.trace.write(json.dumps(record) + '\n')
+        self.start()
+
+    def percentiles(self):
+        """
+        :return: dict of phase -> (p50, p95) in seconds over the window
+        """
+        return dict([(phase, (np.percentile(times, 50), np.percentile(times, 95)))
+                     for phase, times in self.times.items() if len(times) > 0])
+
+    def summary(self):
+        """
+        :return: p50/p95 of each phase in ms
+        """
+        percentiles = self.percentiles()
+        return ', '.join(['%s=%.1f/%.1fms' % (phase, percentiles[phase][0] * 1000, percentiles[phase][1] * 1000)
+                          for phase in self.PHASES if phase in percentiles])
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+
 def do_checkpoint(prefix, means, stds):
     def _callback(iter_no, sym, arg, aux):
         arg['bbox_pred_weight_test'] = (arg['bbox_pred_weight'].T * mx.nd.array(stds)).T
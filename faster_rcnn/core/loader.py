@@ -8,11 +8,15 @@
 
 import numpy as np
 import mxnet as mx
+import Queue
+from multiprocessing import Pool, RawArray
+from ctypes import c_float
 from mxnet.executor_manager import _split_input_slice
 
 from config.config import config
 from utils.image import tensor_vstack
 from rpn.rpn import get_rpn_testbatch, get_rpn_batch, assign_anchor
+from rpn.anchor_cache import infer_feat_shape
 from rcnn import get_rcnn_testbatch, get_rcnn_batch
 
 
@@ -250,9 +254,27 @@ class ROIIter(mx.io.DataIter):
         self.data = [mx.nd.array(all_data[name]) for name in self.data_name]
         self.label = [mx.nd.array(all_label[name]) for name in self.label_name]
 
+    def next_cursor(self):
+        """ claim the next batch for a prefetching worker, None at the end of epoch """
+        if not self.iter_next():
+            return None
+        cur = self.cur
+        self.cur += self.batch_size
+        return cur
+
+    def get_batch_at(self, cur):
+        """ build the batch starting at cur without touching the iterator state """
+        data, label = self.fetch(cur)
+        return mx.io.DataBatch(data=data, label=label, pad=0, index=cur / self.batch_size,
+                               provide_data=[[(k, v.shape) for k, v in zip(self.data_name, idata)] for idata in data],
+                               provide_label=[[(k, v.shape) for k, v in zip(self.label_name, ilabel)] for ilabel in label])
+
     def get_batch_individual(self):
+        self.data, self.label = self.fetch(self.cur)
+
+    def fetch(self, cur):
         # slice roidb
-        cur_from = self.cur
+        cur_from = cur
         cur_to = min(cur_from + self.batch_size, self.size)
         roidb = [self.roidb[self.index[i]] for i in range(cur_from, cur_to)]
 
@@ -272,8 +294,9 @@ class ROIIter(mx.io.DataIter):
 
         all_data = [_['data'] for _ in rst]
         all_label = [_['label'] for _ in rst]
-        self.data = [[mx.nd.array(data[key]) for key in self.data_name] for data in all_data]
-        self.label = [[mx.nd.array(label[key]) for key in self.label_name] for label in all_label]
+        data = [[mx.nd.array(data[key]) for key in self.data_name] for data in all_data]
+        label = [[mx.nd.array(label[key]) for key in self.label_name] for label in all_label]
+        return data, label
 
     def parfetch(self, iroidb):
         data, label = get_rcnn_batch(iroidb, self.cfg)
@@ -287,6 +310,8 @@ class AnchorLoader(mx.io.DataIter):
                  aspect_grouping=False):
         """
         This Iter will provide roi data to Fast R-CNN network
+        if cfg.TRAIN.NUM_WORKERS > 0, each device slice is built in a worker process
+        and the image tensor is handed back through a shared memory buffer
         :param feat_sym: to infer shape of assign_output
         :param roidb: must be preprocessed
         :param batch_size: must divide BATCH_SIZE(128)
@@ -331,6 +356,24 @@ class AnchorLoader(mx.io.DataIter):
         self.data = None
         self.label = None
 
+        # seed of the scale choice and anchor sampling of this epoch, drawn in reset
+        self.epoch_seed = 0
+
+        # init multi-process pool with a set of shared image buffers (one per device slice)
+        # for every batch that can be in flight, the ids of unused sets are kept in free_buffers
+        self.pool = None
+        self.buffer_sets = None
+        self.free_buffers = None
+        if cfg.TRAIN.NUM_WORKERS > 0:
+            self.buffer_sets = [[RawArray(c_float, self._max_slice_size()) for _ in self.ctx]
+                                for _ in range(max(cfg.TRAIN.PREFETCH_DEPTH, 1))]
+            self.free_buffers = Queue.Queue()
+            for set_id in range(len(self.buffer_sets)):
+                self.free_buffers.put(set_id)
+            self.pool = Pool(processes=cfg.TRAIN.NUM_WORKERS, initializer=_init_anchor_worker,
+                             initargs=(feat_sym, cfg, feat_stride, anchor_scales, anchor_ratios, allowed_border,
+                                       self.buffer_sets))
+
         # get first batch to fill in provide_data and provide_label
         self.reset()
         self.get_batch_individual()
@@ -351,6 +394,26 @@ class AnchorLoader(mx.io.DataIter):
     def provide_label_single(self):
         return [(k, v.shape) for k, v in zip(self.label_name, self.label[0])]
 
+    def _max_slice_size(self):
+        """ number of floats in the largest image tensor of one device slice """
+        max_size = max([max(v) for v in self.cfg.SCALES])
+        stride = self.cfg.network.IMAGE_STRIDE
+        if stride > 0:
+            max_size = int(np.ceil(max_size / float(stride)) * stride)
+        work_load_list = self.work_load_list
+        if work_load_list is None:
+            work_load_list = [1] * len(self.ctx)
+        images_per_slice = max([islice.stop - islice.start
+                                for islice in _split_input_slice(self.batch_size, work_load_list)])
+        return images_per_slice * 3 * max_size * max_size
+
+    def close(self):
+        """ stop the worker processes, later batches are built in this process """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
     def reset(self):
         self.cur = 0
         if self.shuffle:
@@ -369,6 +432,7 @@ class AnchorLoader(mx.io.DataIter):
                 self.index = inds
             else:
                 np.random.shuffle(self.index)
+        self.epoch_seed = np.random.randint(0, 2 ** 31 - 1)
 
     def iter_next(self):
         return self.cur + self.batch_size <= self.size
@@ -442,8 +506,7 @@ class AnchorLoader(mx.io.DataIter):
             # infer label shape
             data_shape = {k: v.shape for k, v in data.items()}
             del data_shape['im_info']
-            _, feat_shape, _ = self.feat_sym.infer_shape(**data_shape)
-            feat_shape = [int(i) for i in feat_shape[0]]
+            feat_shape = infer_feat_shape(self.feat_sym, data_shape)
 
             # add gt_boxes to data for e2e
             data['gt_boxes'] = label['gt_boxes'][np.newaxis, :, :]
@@ -466,8 +529,37 @@ class AnchorLoader(mx.io.DataIter):
         self.data = [mx.nd.array(all_data[key]) for key in self.data_name]
         self.label = [mx.nd.array(all_label[key]) for key in self.label_name]
 
+    def next_cursor(self):
+        """ claim the next batch for a prefetching worker, None at the end of epoch """
+        if not self.iter_next():
+            return None
+        cur = self.cur
+        self.cur += self.batch_size
+        return cur
+
+    def get_batch_at(self, cur):
+        """ build the batch starting at cur without touching the iterator state """
+        data, label = self.fetch(cur)
+        return mx.io.DataBatch(data=data, label=label, pad=0, index=cur / self.batch_size,
+                               provide_data=[[(k, v.shape) for k, v in zip(self.data_name, idata)] for idata in data],
+                               provide_label=[[(k, v.shape) for k, v in zip(self.label_name, ilabel)] for ilabel in label])
+
     def get_batch_individual(self):
-        cur_from = self.cur
+        self.data, self.label = self.fetch(self.cur)
+
+    def batch_seeds(self, cur, num_slices):
+        """
+        seeds of the device slices of the batch starting at cur, they only depend on
+        the epoch seed and the cursor, not on which thread builds the batch or when
+        :param cur: cursor of the batch
+        :param num_slices: number of device slices
+        :return: list of int seeds
+        """
+        rng = np.random.RandomState([self.epoch_seed, cur])
+        return [int(seed) for seed in rng.randint(0, 2 ** 31 - 1, size=num_slices)]
+
+    def fetch(self, cur):
+        cur_from = cur
         cur_to = min(cur_from + self.batch_size, self.size)
         roidb = [self.roidb[self.index[i]] for i in range(cur_from, cur_to)]
         # decide multi device slice
@@ -478,29 +570,84 @@ class AnchorLoader(mx.io.DataIter):
         assert isinstance(work_load_list, list) and len(work_load_list) == len(ctx), \
             "Invalid settings for work load. "
         slices = _split_input_slice(self.batch_size, work_load_list)
+        seeds = self.batch_seeds(cur, len(slices))
+        if self.pool is not None:
+            # the image tensors stay in the checked out buffer set until they are copied into NDArrays
+            set_id = self.free_buffers.get()
+            try:
+                return self.to_ndarray(self.get_batch_parallel(roidb, slices, seeds, set_id))
+            finally:
+                self.free_buffers.put(set_id)
         rst = []
         for idx, islice in enumerate(slices):
             iroidb = [roidb[i] for i in range(islice.start, islice.stop)]
-            rst.append(self.parfetch(iroidb))
+            rst.append(self.parfetch(iroidb, np.random.RandomState(seeds[idx])))
+        return self.to_ndarray(rst)
+
+    def to_ndarray(self, rst):
         all_data = [_['data'] for _ in rst]
         all_label = [_['label'] for _ in rst]
-        self.data = [[mx.nd.array(data[key]) for key in self.data_name] for data in all_data]
-        self.label = [[mx.nd.array(label[key]) for key in self.label_name] for label in all_label]
+        data = [[mx.nd.array(data[key]) for key in self.data_name] for data in all_data]
+        label = [[mx.nd.array(label[key]) for key in self.label_name] for label in all_label]
+        return data, label
 
-    def parfetch(self, iroidb):
-        # get testing data for multigpu
-        data, label = get_rpn_batch(iroidb, self.cfg)
-        data_shape = {k: v.shape for k, v in data.items()}
-        del data_shape['im_info']
-        _, feat_shape, _ = self.feat_sym.infer_shape(**data_shape)
-        feat_shape = [int(i) for i in feat_shape[0]]
-
-        # add gt_boxes to data for e2e
-        data['gt_boxes'] = label['gt_boxes'][np.newaxis, :, :]
-
-        # assign anchor for label
-        label = assign_anchor(feat_shape, label['gt_boxes'], data['im_info'], self.cfg,
-                              self.feat_stride, self.anchor_scales,
-                              self.anchor_ratios, self.allowed_border)
-        return {'data': data, 'label': label}
+    def get_batch_parallel(self, roidb, slices, seeds, set_id):
+        multiprocess_results = []
+        for idx, islice in enumerate(slices):
+            iroidb = [roidb[i] for i in range(islice.start, islice.stop)]
+            multiprocess_results.append(self.pool.apply_async(_anchor_parfetch, (set_id, idx, seeds[idx], iroidb)))
+        # the buffer set is handed to the next batch afterwards, so wait for every worker even if one failed
+        for multiprocess_result in multiprocess_results:
+            multiprocess_result.wait()
+
+        rst = [multiprocess_result.get() for multiprocess_result in multiprocess_results]
+        for idx, r in enumerate(rst):
+            # image tensor was written into the shared buffer, only its shape came back
+            if isinstance(r['data']['data'], tuple):
+                shape = r['data']['data']
+                buf = np.ctypeslib.as_array(self.buffer_sets[set_id][idx])
+                r['data']['data'] = buf[:int(np.prod(shape))].reshape(shape)
+        return rst
+
+    def parfetch(self, iroidb, rng=None):
+        return anchor_parfetch(iroidb, self.feat_sym, self.cfg, self.feat_stride, self.anchor_scales,
+                               self.anchor_ratios, self.allowed_border, rng)
+
+
+def anchor_parfetch(iroidb, feat_sym, cfg, feat_stride, anchor_scales, anchor_ratios, allowed_border, rng=None):
+    # get testing data for multigpu
+    data, label = get_rpn_batch(iroidb, cfg, rng)
+    data_shape = {k: v.shape for k, v in data.items()}
+    del data_shape['im_info']
+    feat_shape = infer_feat_shape(feat_sym, data_shape)
+
+    # add gt_boxes to data for e2e
+    data['gt_boxes'] = label['gt_boxes'][np.newaxis, :, :]
+
+    # assign anchor for label
+    label = assign_anchor(feat_shape, label['gt_boxes'], data['im_info'], cfg,
+                          feat_stride, anchor_scales,
+                          anchor_ratios, allowed_border, rng)
+    return {'data': data, 'label': label}
+
+
+# state of an AnchorLoader worker process, filled by _init_anchor_worker
+_anchor_worker = {}
+
+
+def _init_anchor_worker(feat_sym, cfg, feat_stride, anchor_scales, anchor_ratios, allowed_border, buffer_sets):
+    _anchor_worker['args'] = (feat_sym, cfg, feat_stride, anchor_scales, anchor_ratios, allowed_border)
+    _anchor_worker['buffer_sets'] = buffer_sets
+
+
+def _anchor_parfetch(set_id, slot, seed, iroidb):
+    rst = anchor_parfetch(iroidb, *_anchor_worker['args'], rng=np.random.RandomState(seed))
+
+    # hand the image tensor back through shared memory if it fits, otherwise pickle it
+    im_tensor = rst['data']['data']
+    buf = np.ctypeslib.as_array(_anchor_worker['buffer_sets'][set_id][slot])
+    if im_tensor.size <= buf.size:
+        buf[:im_tensor.size] = im_tensor.ravel()
+        rst['data']['data'] = im_tensor.shape
+    return rst
 
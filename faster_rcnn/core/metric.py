@@ -7,7 +7,6 @@
 # --------------------------------------------------------
 
 import mxnet as mx
-import numpy as np
 
 
 def get_rpn_names():
@@ -28,149 +27,188 @@ def get_rcnn_names(cfg):
     return pred, label
 
 
-class RPNAccMetric(mx.metric.EvalMetric):
-    def __init__(self):
-        super(RPNAccMetric, self).__init__('RPNAcc')
-        self.pred, self.label = get_rpn_names()
+class DeviceMetric(mx.metric.EvalMetric):
+    """
+    metric reduced to a sum and a count on the device of the outputs, the scalars are accumulated
+    there and only copied to host every sync_period updates or when the metric is read
+    """
+    def __init__(self, name, sync_period=50):
+        """
+        :param name: metric name
+        :param sync_period: updates between copies to host, 0 to copy only when the metric is read
+        """
+        self.sync_period = sync_period
+        super(DeviceMetric, self).__init__(name)
+
+    def reset(self):
+        super(DeviceMetric, self).reset()
+        # device -> [sum, count] accumulated on that device
+        self._device_sums = dict()
+        self._num_updates = 0
+
+    def device_update(self, labels, preds):
+        """
+        :param labels: labels of one device
+        :param preds: outputs of one device
+        :return: sum of the metric and number of instances as NDArrays on the device of preds
+        """
+        raise NotImplementedError
 
     def update(self, labels, preds):
+        metric_sum, num_inst = self.device_update(labels, preds)
+        device = str(metric_sum.context)
+        if device in self._device_sums:
+            self._device_sums[device][0] += metric_sum
+            self._device_sums[device][1] += num_inst
+        else:
+            self._device_sums[device] = [metric_sum, num_inst]
+        self._num_updates += 1
+        if self.sync_period > 0 and self._num_updates % self.sync_period == 0:
+            self.sync()
+
+    def sync(self):
+        """
+        add the device sums to sum_metric and num_inst
+        :return: None
+        """
+        for metric_sum, num_inst in self._device_sums.values():
+            self.sum_metric += float(metric_sum.asnumpy()[0])
+            self.num_inst += int(round(num_inst.asnumpy()[0]))
+        self._device_sums = dict()
+
+    def get(self):
+        self.sync()
+        return super(DeviceMetric, self).get()
+
+
+def _keep_mask(label):
+    """ 1 for labels that are not ignored (-1) """
+    return label != -1
+
+
+def _pick_log_loss(prob, label, keep, axis):
+    """ summed -log of the probabilities of the labels, ignored labels pick class 0 and are masked out """
+    cls = mx.nd.pick(prob, mx.nd.maximum(label, 0), axis=axis)
+    return mx.nd.sum(-1 * mx.nd.log(cls + 1e-14) * keep)
+
+
+class RPNAccMetric(DeviceMetric):
+    def __init__(self, sync_period=50):
+        super(RPNAccMetric, self).__init__('RPNAcc', sync_period)
+        self.pred, self.label = get_rpn_names()
+
+    def device_update(self, labels, preds):
         pred = preds[self.pred.index('rpn_cls_prob')]
-        label = labels[self.label.index('rpn_label')]
+        label = labels[self.label.index('rpn_label')].as_in_context(pred.context)
 
         # pred (b, c, p) or (b, c, h, w)
-        pred_label = mx.ndarray.argmax_channel(pred).asnumpy().astype('int32')
+        pred_label = mx.ndarray.argmax_channel(pred)
         pred_label = pred_label.reshape((pred_label.shape[0], -1))
         # label (b, p)
-        label = label.asnumpy().astype('int32')
+        label = label.reshape((label.shape[0], -1))
 
         # filter with keep_inds
-        keep_inds = np.where(label != -1)
-        pred_label = pred_label[keep_inds]
-        label = label[keep_inds]
+        keep = _keep_mask(label)
+        correct = mx.nd.sum((pred_label == label) * keep)
+        return correct, mx.nd.sum(keep)
 
-        self.sum_metric += np.sum(pred_label.flat == label.flat)
-        self.num_inst += len(pred_label.flat)
 
-
-class RCNNAccMetric(mx.metric.EvalMetric):
-    def __init__(self, cfg):
-        super(RCNNAccMetric, self).__init__('RCNNAcc')
+class RCNNAccMetric(DeviceMetric):
+    def __init__(self, cfg, sync_period=50):
+        super(RCNNAccMetric, self).__init__('RCNNAcc', sync_period)
         self.e2e = cfg.TRAIN.END2END
         self.ohem = cfg.TRAIN.ENABLE_OHEM
         self.pred, self.label = get_rcnn_names(cfg)
 
-    def update(self, labels, preds):
+    def device_update(self, labels, preds):
         pred = preds[self.pred.index('rcnn_cls_prob')]
         if self.ohem or self.e2e:
             label = preds[self.pred.index('rcnn_label')]
         else:
-            label = labels[self.label.index('rcnn_label')]
+            label = labels[self.label.index('rcnn_label')].as_in_context(pred.context)
 
         last_dim = pred.shape[-1]
-        pred_label = pred.asnumpy().reshape(-1, last_dim).argmax(axis=1).astype('int32')
-        label = label.asnumpy().reshape(-1,).astype('int32')
+        pred_label = mx.nd.argmax(pred.reshape((-1, last_dim)), axis=1)
+        label = label.reshape((-1,))
 
         # filter with keep_inds
-        keep_inds = np.where(label != -1)
-        pred_label = pred_label[keep_inds]
-        label = label[keep_inds]
-
-        self.sum_metric += np.sum(pred_label.flat == label.flat)
-        self.num_inst += len(pred_label.flat)
+        keep = _keep_mask(label)
+        correct = mx.nd.sum((pred_label == label) * keep)
+        return correct, mx.nd.sum(keep)
 
 
-class RPNLogLossMetric(mx.metric.EvalMetric):
-    def __init__(self):
-        super(RPNLogLossMetric, self).__init__('RPNLogLoss')
+class RPNLogLossMetric(DeviceMetric):
+    def __init__(self, sync_period=50):
+        super(RPNLogLossMetric, self).__init__('RPNLogLoss', sync_period)
         self.pred, self.label = get_rpn_names()
 
-    def update(self, labels, preds):
+    def device_update(self, labels, preds):
         pred = preds[self.pred.index('rpn_cls_prob')]
-        label = labels[self.label.index('rpn_label')]
+        label = labels[self.label.index('rpn_label')].as_in_context(pred.context)
 
+        # pred (b, c, p) or (b, c, h, w) --> (b, c, p), the class is picked along c without a transpose
+        pred = pred.reshape((pred.shape[0], pred.shape[1], -1))
         # label (b, p)
-        label = label.asnumpy().astype('int32').reshape((-1))
-        # pred (b, c, p) or (b, c, h, w) --> (b, p, c) --> (b*p, c)
-        pred = pred.asnumpy().reshape((pred.shape[0], pred.shape[1], -1)).transpose((0, 2, 1))
-        pred = pred.reshape((label.shape[0], -1))
+        label = label.reshape((pred.shape[0], -1))
 
         # filter with keep_inds
-        keep_inds = np.where(label != -1)[0]
-        label = label[keep_inds]
-        cls = pred[keep_inds, label]
-
-        cls += 1e-14
-        cls_loss = -1 * np.log(cls)
-        cls_loss = np.sum(cls_loss)
-        self.sum_metric += cls_loss
-        self.num_inst += label.shape[0]
+        keep = _keep_mask(label)
+        return _pick_log_loss(pred, label, keep, axis=1), mx.nd.sum(keep)
 
 
-class RCNNLogLossMetric(mx.metric.EvalMetric):
-    def __init__(self, cfg):
-        super(RCNNLogLossMetric, self).__init__('RCNNLogLoss')
+class RCNNLogLossMetric(DeviceMetric):
+    def __init__(self, cfg, sync_period=50):
+        super(RCNNLogLossMetric, self).__init__('RCNNLogLoss', sync_period)
         self.e2e = cfg.TRAIN.END2END
         self.ohem = cfg.TRAIN.ENABLE_OHEM
         self.pred, self.label = get_rcnn_names(cfg)
 
-    def update(self, labels, preds):
+    def device_update(self, labels, preds):
         pred = preds[self.pred.index('rcnn_cls_prob')]
         if self.ohem or self.e2e:
             label = preds[self.pred.index('rcnn_label')]
         else:
-            label = labels[self.label.index('rcnn_label')]
+            label = labels[self.label.index('rcnn_label')].as_in_context(pred.context)
 
         last_dim = pred.shape[-1]
-        pred = pred.asnumpy().reshape(-1, last_dim)
-        label = label.asnumpy().reshape(-1,).astype('int32')
+        pred = pred.reshape((-1, last_dim))
+        label = label.reshape((-1,))
 
         # filter with keep_inds
-        keep_inds = np.where(label != -1)[0]
-        label = label[keep_inds]
-        cls = pred[keep_inds, label]
+        keep = _keep_mask(label)
+        return _pick_log_loss(pred, label, keep, axis=1), mx.nd.sum(keep)
 
-        cls += 1e-14
-        cls_loss = -1 * np.log(cls)
-        cls_loss = np.sum(cls_loss)
-        self.sum_metric += cls_loss
-        self.num_inst += label.shape[0]
 
-
-class RPNL1LossMetric(mx.metric.EvalMetric):
-    def __init__(self):
-        super(RPNL1LossMetric, self).__init__('RPNL1Loss')
+class RPNL1LossMetric(DeviceMetric):
+    def __init__(self, sync_period=50):
+        super(RPNL1LossMetric, self).__init__('RPNL1Loss', sync_period)
         self.pred, self.label = get_rpn_names()
 
-    def update(self, labels, preds):
-        bbox_loss = preds[self.pred.index('rpn_bbox_loss')].asnumpy()
+    def device_update(self, labels, preds):
+        bbox_loss = preds[self.pred.index('rpn_bbox_loss')]
 
         # calculate num_inst (average on those kept anchors)
-        label = labels[self.label.index('rpn_label')].asnumpy()
-        num_inst = np.sum(label != -1)
+        label = labels[self.label.index('rpn_label')].as_in_context(bbox_loss.context)
+        num_inst = mx.nd.sum(_keep_mask(label))
 
-        self.sum_metric += np.sum(bbox_loss)
-        self.num_inst += num_inst
+        return mx.nd.sum(bbox_loss), num_inst
 
 
-class RCNNL1LossMetric(mx.metric.EvalMetric):
-    def __init__(self, cfg):
-        super(RCNNL1LossMetric, self).__init__('RCNNL1Loss')
+class RCNNL1LossMetric(DeviceMetric):
+    def __init__(self, cfg, sync_period=50):
+        super(RCNNL1LossMetric, self).__init__('RCNNL1Loss', sync_period)
         self.e2e = cfg.TRAIN.END2END
         self.ohem = cfg.TRAIN.ENABLE_OHEM
         self.pred, self.label = get_rcnn_names(cfg)
 
-    def update(self, labels, preds):
-        bbox_loss = preds[self.pred.index('rcnn_bbox_loss')].asnumpy()
-        if self.ohem:
-            label = preds[self.pred.index('rcnn_label')].asnumpy()
+    def device_update(self, labels, preds):
+        bbox_loss = preds[self.pred.index('rcnn_bbox_loss')]
+        if self.ohem or self.e2e:
+            label = preds[self.pred.index('rcnn_label')]
         else:
-            if self.e2e:
-                label = preds[self.pred.index('rcnn_label')].asnumpy()
-            else:
-                label = labels[self.label.index('rcnn_label')].asnumpy()
+            label = labels[self.label.index('rcnn_label')].as_in_context(bbox_loss.context)
 
         # calculate num_inst (average on those kept anchors)
-        num_inst = np.sum(label != -1)
+        num_inst = mx.nd.sum(_keep_mask(label))
 
-        self.sum_metric += np.sum(bbox_loss)
-        self.num_inst += num_inst
+        return mx.nd.sum(bbox_loss), num_inst
@@ -9,17 +9,23 @@
 """A `MutableModule` implement the `BaseModule` API, and allows input shape
 varying with training iterations. If shapes vary, executors will rebind,
 using shared arrays from the initial module binded with maximum shape.
+The executors of recently seen input shapes are kept, so alternating shapes
+do not rebind every batch.
 """
 
 import time
 import logging
 import warnings
+from collections import OrderedDict
+
+import numpy as np
 
 from mxnet import context as ctx
 from mxnet.initializer import Uniform, InitDesc
 from mxnet.module.base_module import BaseModule, _check_input_names, _parse_data_desc, _as_list
 from mxnet.model import _create_kvstore, _initialize_kvstore, _update_params, _update_params_on_kvstore, load_checkpoint, BatchEndParam
 from mxnet import metric
+from mxnet.io import DataBatch
 
 from .DataParallelExecutorGroup import DataParallelExecutorGroup
 from mxnet import ndarray as nd
@@ -721,10 +727,21 @@ class MutableModule(BaseModule):
     max_data_shapes : list of (name, shape) tuple, designating inputs whose shape vary
     max_label_shapes : list of (name, shape) tuple, designating inputs whose shape vary
     fixed_param_prefix : list of str, indicating fixed parameters
+    max_cached_modules : int
+        Default `8`. Number of executors of other input shapes than the maximum ones kept
+        for reuse, least recently used ones are released beyond it. `0` rebinds on every
+        shape change.
+    shape_quantum : int
+        Default `0`. If given and the module is binded without labels, the height and width
+        of 4-d data inputs are zero padded to multiples of it (at most the maximum shape),
+        which bounds the number of executors at test time. Batches with labels are left as
+        they are, since the labels are assigned for the unpadded data, pad them in the loader
+        with network.IMAGE_STRIDE instead.
     """
     def __init__(self, symbol, data_names, label_names,
                  logger=logging, context=ctx.cpu(), work_load_list=None,
-                 max_data_shapes=None, max_label_shapes=None, fixed_param_prefix=None):
+                 max_data_shapes=None, max_label_shapes=None, fixed_param_prefix=None,
+                 max_cached_modules=8, shape_quantum=0):
         super(MutableModule, self).__init__(logger=logger)
         self._symbol = symbol
         self._data_names = data_names
@@ -733,6 +750,13 @@ class MutableModule(BaseModule):
         self._work_load_list = work_load_list
 
         self._curr_module = None
+        self._curr_key = None
+        # module binded with the maximum shapes, every cached module shares its arrays
+        self._base_module = None
+        self._module_cache = OrderedDict()
+        self._max_cached_modules = max_cached_modules
+        self._shape_quantum = shape_quantum
+        self._reset_cache_stats()
         self._max_data_shapes = max_data_shapes
         self._max_label_shapes = max_label_shapes
         self._fixed_param_prefix = fixed_param_prefix
@@ -749,6 +773,30 @@ class MutableModule(BaseModule):
     def _reset_bind(self):
         self.binded = False
         self._curr_module = None
+        self._curr_key = None
+        self._base_module = None
+        self._module_cache = OrderedDict()
+
+    def _reset_cache_stats(self):
+        self._cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'rebind_time': 0.0}
+
+    @property
+    def cache_stats(self):
+        """ executor cache counters, 'rebind_time' is the seconds spent binding on misses """
+        stats = dict(self._cache_stats)
+        stats['modules'] = len(self._module_cache)
+        return stats
+
+    @staticmethod
+    def _shape_key(data_shapes, label_shapes):
+        """ hashable per device input shapes """
+        key = []
+        for i in xrange(len(data_shapes)):
+            shapes = list(data_shapes[i])
+            if label_shapes is not None and label_shapes[i] is not None:
+                shapes += list(label_shapes[i])
+            key.append(tuple(sorted((desc[0], tuple(desc[1])) for desc in shapes)))
+        return tuple(key)
 
     @property
     def data_names(self):
@@ -838,6 +886,9 @@ class MutableModule(BaseModule):
         module.bind([max_data_shapes for _ in xrange(len(self._context))], [max_label_shapes for _ in xrange(len(self._context))],
                     for_training, inputs_need_grad, force_rebind=False, shared_module=None)
         self._curr_module = module
+        self._base_module = module
+        self._curr_key = self._shape_key(module.data_shapes, module.label_shapes)
+        self._module_cache = OrderedDict([(self._curr_key, module)])
 
         # copy back saved params, if already initialized
         if self.params_initialized:
@@ -877,7 +928,7 @@ class MutableModule(BaseModule):
             eval_batch_end_callback=None, initializer=Uniform(0.01),
             arg_params=None, aux_params=None, allow_missing=False,
             force_rebind=False, force_init=False, begin_epoch=0, num_epoch=None,
-            validation_metric=None, monitor=None, prefix=None):
+            validation_metric=None, monitor=None, prefix=None, phase_timer=None):
         """Train the module parameters.
 
         Parameters
@@ -931,6 +982,10 @@ class MutableModule(BaseModule):
             this value as N+1.
         num_epoch : int
             Number of epochs to run training.
+        phase_timer : PhaseTimer
+            Default `None`. If given, times the data, forward_backward, update, update_metric
+            and callback phases of every batch, it is visible to batch_end_callback as
+            `locals['phase_timer']`.
 
         Examples
         --------
@@ -962,12 +1017,22 @@ class MutableModule(BaseModule):
         for epoch in range(begin_epoch, num_epoch):
             tic = time.time()
             eval_metric.reset()
+            if phase_timer is not None:
+                phase_timer.start()
             for nbatch, data_batch in enumerate(train_data):
+                if phase_timer is not None:
+                    phase_timer.lap('data')
                 if monitor is not None:
                     monitor.tic()
                 self.forward_backward(data_batch)
+                if phase_timer is not None:
+                    phase_timer.lap('forward_backward')
                 self.update()
+                if phase_timer is not None:
+                    phase_timer.lap('update')
                 self.update_metric(eval_metric, data_batch.label)
+                if phase_timer is not None:
+                    phase_timer.lap('update_metric')
 
                 if monitor is not None:
                     monitor.toc_print()
@@ -978,12 +1043,19 @@ class MutableModule(BaseModule):
                                                      locals=locals())
                     for callback in _as_list(batch_end_callback):
                         callback(batch_end_params)
+                if phase_timer is not None:
+                    phase_timer.lap('callback')
+                    phase_timer.end_batch(epoch, nbatch)
 
             # one epoch of training is finished
             for name, val in eval_metric.get_name_value():
                 self.logger.info('Epoch[%d] Train-%s=%f', epoch, name, val)
             toc = time.time()
             self.logger.info('Epoch[%d] Time cost=%.3f', epoch, (toc-tic))
+            stats = self.cache_stats
+            self.logger.info('Epoch[%d] Executor cache hits=%d misses=%d evictions=%d modules=%d rebind time=%.3f',
+                             epoch, stats['hits'], stats['misses'], stats['evictions'], stats['modules'],
+                             stats['rebind_time'])
 
             # sync aux params across devices
             arg_params, aux_params = self.get_params()
@@ -1007,38 +1079,82 @@ class MutableModule(BaseModule):
             train_data.reset()
 
 
-    def forward(self, data_batch, is_train=None):
-        assert self.binded and self.params_initialized
-
-        # get current_shapes
-        if self._curr_module.label_shapes is not None:
-            current_shapes = [dict(self._curr_module.data_shapes[i] + self._curr_module.label_shapes[i]) for i in xrange(len(self._context))]
-        else:
-            current_shapes = [dict(self._curr_module.data_shapes[i]) for i in xrange(len(self._context))]
+    def _quantize_batch(self, data_batch):
+        """ zero pad the height and width of 4-d data inputs to multiples of shape_quantum """
+        max_shapes = dict(self._max_data_shapes[0]) if self._max_data_shapes is not None else dict()
+        quantum = float(self._shape_quantum)
+        data = []
+        provide_data = []
+        for idata, ishapes in zip(data_batch.data, data_batch.provide_data):
+            new_data = []
+            new_shapes = []
+            for arr, (name, shape) in zip(idata, ishapes):
+                if len(shape) == 4:
+                    height = int(np.ceil(shape[2] / quantum) * quantum)
+                    width = int(np.ceil(shape[3] / quantum) * quantum)
+                    if name in max_shapes:
+                        height = max(min(height, max_shapes[name][2]), shape[2])
+                        width = max(min(width, max_shapes[name][3]), shape[3])
+                    if (height, width) != tuple(shape[2:]):
+                        arr = nd.pad(arr, mode='constant', constant_value=0,
+                                     pad_width=(0, 0, 0, 0, 0, height - shape[2], 0, width - shape[3]))
+                        shape = (shape[0], shape[1], height, width)
+                new_data.append(arr)
+                new_shapes.append((name, shape))
+            data.append(new_data)
+            provide_data.append(new_shapes)
+        return DataBatch(data=data, label=data_batch.label, pad=data_batch.pad, index=data_batch.index,
+                         provide_data=provide_data, provide_label=data_batch.provide_label)
+
+    def _switch_module(self, data_batch):
+        """ make the module binded for the shapes of data_batch current, binding one on a cache miss """
+        label_shapes = data_batch.provide_label if self._base_module.label_shapes is not None else None
+        key = self._shape_key(data_batch.provide_data, label_shapes)
+        if key == self._curr_key:
+            return
 
-        # get input_shapes
-        if is_train:
-            input_shapes = [dict(data_batch.provide_data[i] + data_batch.provide_label[i]) for i in xrange(len(self._context))]
+        module = self._module_cache.pop(key, None)
+        if module is not None:
+            self._cache_stats['hits'] += 1
         else:
-            input_shapes = [dict(data_batch.provide_data[i]) for i in xrange(len(data_batch.provide_data))]
-
-        # decide if shape changed
-        shape_changed = len(current_shapes) != len(input_shapes)
-        for pre, cur in zip(current_shapes, input_shapes):
-            for k, v in pre.items():
-                if v != cur[k]:
-                    shape_changed = True
-
-        if shape_changed:
+            self._cache_stats['misses'] += 1
+            tic = time.time()
             # self._curr_module.reshape(data_batch.provide_data, data_batch.provide_label)
             module = Module(self._symbol, self._data_names, self._label_names,
                             logger=self.logger, context=[self._context[i] for i in xrange(len(data_batch.provide_data))],
                             work_load_list=self._work_load_list,
                             fixed_param_names=self._fixed_param_names)
-            module.bind(data_batch.provide_data, data_batch.provide_label, self._curr_module.for_training,
-                        self._curr_module.inputs_need_grad, force_rebind=False,
-                        shared_module=self._curr_module)
-            self._curr_module = module
+            module.bind(data_batch.provide_data, data_batch.provide_label, self._base_module.for_training,
+                        self._base_module.inputs_need_grad, force_rebind=False,
+                        shared_module=self._base_module)
+            self._cache_stats['rebind_time'] += time.time() - tic
+        # most recently used last
+        self._module_cache[key] = module
+
+        # release the least recently used modules, the maximum shape one owns the shared arrays
+        num_cached = len(self._module_cache) - 1
+        for old_key in list(self._module_cache.keys()):
+            if num_cached <= self._max_cached_modules:
+                break
+            if self._module_cache[old_key] is self._base_module:
+                continue
+            del self._module_cache[old_key]
+            self._cache_stats['evictions'] += 1
+            num_cached -= 1
+
+        # parameters and optimizer are shared, so is whether the device copies are newer
+        if self._base_module.optimizer_initialized and not module.optimizer_initialized:
+            module.borrow_optimizer(self._base_module)
+        module._params_dirty = module._params_dirty or self._curr_module._params_dirty
+        self._curr_module = module
+        self._curr_key = key
+
+    def forward(self, data_batch, is_train=None):
+        assert self.binded and self.params_initialized
+
+        if self._shape_quantum > 0 and self._base_module.label_shapes is None:
+            data_batch = self._quantize_batch(data_batch)
+        self._switch_module(data_batch)
 
         self._curr_module.forward(data_batch, is_train=is_train)
 
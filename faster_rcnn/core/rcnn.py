@@ -22,8 +22,8 @@ roidb extended format [image_index]
 import numpy as np
 import numpy.random as npr
 
-from utils.image import get_image, tensor_vstack
-from bbox.bbox_transform import bbox_overlaps, bbox_transform
+from utils.image import get_image, get_image_batch
+from bbox.bbox_transform import max_overlaps, bbox_transform
 from bbox.bbox_regression import expand_bbox_regression_targets
 
 
@@ -57,8 +57,7 @@ def get_rcnn_batch(roidb, cfg):
     :return: data, label
     """
     num_images = len(roidb)
-    imgs, roidb = get_image(roidb, cfg)
-    im_array = tensor_vstack(imgs)
+    im_array, roidb = get_image_batch(roidb, cfg)
 
     assert cfg.TRAIN.BATCH_ROIS == -1 or cfg.TRAIN.BATCH_ROIS % cfg.TRAIN.BATCH_IMAGES == 0, \
         'BATCHIMAGES {} must divide BATCH_ROIS {}'.format(cfg.TRAIN.BATCH_IMAGES, cfg.TRAIN.BATCH_ROIS)
@@ -118,7 +117,7 @@ def get_rcnn_batch(roidb, cfg):
 
 
 def sample_rois(rois, fg_rois_per_image, rois_per_image, num_classes, cfg,
-                labels=None, overlaps=None, bbox_targets=None, gt_boxes=None):
+                labels=None, overlaps=None, bbox_targets=None, gt_boxes=None, out=None):
     """
     generate random sample of ROIs comprising foreground and background examples
     :param rois: all_rois [n, 4]; e2e: [n, 5] with batch_index
@@ -129,12 +128,12 @@ def sample_rois(rois, fg_rois_per_image, rois_per_image, num_classes, cfg,
     :param overlaps: maybe precomputed (max_overlaps)
     :param bbox_targets: maybe precomputed
     :param gt_boxes: optional for e2e [n, 5] (x1, y1, x2, y2, cls)
+    :param out: optional (rois, labels, bbox_targets, bbox_weights) buffers of rois_per_image rows to write to
     :return: (labels, rois, bbox_targets, bbox_weights)
     """
     if labels is None:
-        overlaps = bbox_overlaps(rois[:, 1:].astype(np.float), gt_boxes[:, :4].astype(np.float))
-        gt_assignment = overlaps.argmax(axis=1)
-        overlaps = overlaps.max(axis=1)
+        # only the best gt of each roi is needed, not the n * k overlaps
+        gt_assignment, overlaps = max_overlaps(rois[:, 1:], gt_boxes[:, :4])
         labels = gt_boxes[gt_assignment, 4]
 
     # foreground RoI with FG_THRESH overlap
@@ -154,33 +153,68 @@ def sample_rois(rois, fg_rois_per_image, rois_per_image, num_classes, cfg,
     if len(bg_indexes) > bg_rois_per_this_image:
         bg_indexes = npr.choice(bg_indexes, size=bg_rois_per_this_image, replace=False)
 
-    # indexes selected
-    keep_indexes = np.append(fg_indexes, bg_indexes)
+    # pad more to ensure a fixed minibatch size, every round takes rois without replacement
+    # (npr.choice(len(rois), replace=False) draws the same permutation)
+    gap = rois_per_image - fg_indexes.size - bg_indexes.size
+    num_rounds = int(np.ceil(gap / float(len(rois)))) if gap > 0 else 0
+    gap_indexes = [npr.permutation(len(rois)) for _ in range(num_rounds)]
 
-    # pad more to ensure a fixed minibatch size
-    while keep_indexes.shape[0] < rois_per_image:
-        gap = np.minimum(len(rois), rois_per_image - keep_indexes.shape[0])
-        gap_indexes = npr.choice(range(len(rois)), size=gap, replace=False)
-        keep_indexes = np.append(keep_indexes, gap_indexes)
+    # indexes selected
+    keep_indexes = np.concatenate([fg_indexes, bg_indexes] + gap_indexes)[:rois_per_image].astype(np.int)
 
-    # select labels
-    labels = labels[keep_indexes]
+    if out is None:
+        out_rois = rois[keep_indexes]
+        out_labels = labels[keep_indexes]
+    else:
+        out_rois, out_labels, out_bbox_targets, out_bbox_weights = out
+        np.take(rois, keep_indexes, axis=0, out=out_rois)
+        np.take(labels, keep_indexes, out=out_labels)
     # set labels of bg_rois to be 0
-    labels[fg_rois_per_this_image:] = 0
-    rois = rois[keep_indexes]
+    out_labels[fg_rois_per_this_image:] = 0
 
     # load or compute bbox_target
     if bbox_targets is not None:
         bbox_target_data = bbox_targets[keep_indexes, :]
     else:
-        targets = bbox_transform(rois[:, 1:], gt_boxes[gt_assignment[keep_indexes], :4])
+        targets = bbox_transform(out_rois[:, 1:], gt_boxes[gt_assignment[keep_indexes], :4])
         if cfg.TRAIN.BBOX_NORMALIZATION_PRECOMPUTED:
             targets = ((targets - np.array(cfg.TRAIN.BBOX_MEANS))
                        / np.array(cfg.TRAIN.BBOX_STDS))
-        bbox_target_data = np.hstack((labels[:, np.newaxis], targets))
+        bbox_target_data = np.hstack((out_labels[:, np.newaxis], targets))
 
-    bbox_targets, bbox_weights = \
-        expand_bbox_regression_targets(bbox_target_data, num_classes, cfg)
+    out_bbox_targets, out_bbox_weights = \
+        expand_bbox_regression_targets(bbox_target_data, num_classes, cfg,
+                                       out=None if out is None else (out_bbox_targets, out_bbox_weights))
+
+    return out_rois, out_labels, out_bbox_targets, out_bbox_weights
 
-    return rois, labels, bbox_targets, bbox_weights
 
+def sample_rois_batch(all_rois, gt_boxes_list, fg_rois_per_image, rois_per_image, num_classes, cfg):
+    """
+    sample_rois of every image of a device written to one set of preallocated outputs,
+    the gt boxes of each image are added to its candidate rois
+    :param all_rois: [n, 5] rois of all images with batch_index
+    :param gt_boxes_list: [image_index] gt boxes [k, 5] (x1, y1, x2, y2, cls)
+    :param fg_rois_per_image: foreground roi number
+    :param rois_per_image: total roi number
+    :param num_classes: number of classes
+    :return: (rois [num_images * rois_per_image, 5], labels, bbox_targets, bbox_weights)
+    """
+    num_images = len(gt_boxes_list)
+    num_rois = num_images * rois_per_image
+    num_reg_classes = 2 if cfg.CLASS_AGNOSTIC else num_classes
+    dtype = all_rois.dtype
+    rois = np.empty((num_rois, 5), dtype=dtype)
+    labels = np.empty((num_rois,), dtype=gt_boxes_list[0].dtype if num_images > 0 else dtype)
+    bbox_targets = np.empty((num_rois, 4 * num_reg_classes), dtype=np.float32)
+    bbox_weights = np.empty((num_rois, 4 * num_reg_classes), dtype=np.float32)
+
+    for im_i, gt_boxes in enumerate(gt_boxes_list):
+        # Include ground-truth boxes in the set of candidate rois
+        batch_index = im_i * np.ones((gt_boxes.shape[0], 1), dtype=gt_boxes.dtype)
+        image_rois = np.vstack((all_rois[all_rois[:, 0] == im_i], np.hstack((batch_index, gt_boxes[:, :-1]))))
+        rows = slice(im_i * rois_per_image, (im_i + 1) * rois_per_image)
+        sample_rois(image_rois, fg_rois_per_image, rois_per_image, num_classes, cfg, gt_boxes=gt_boxes,
+                    out=(rois[rows], labels[rows], bbox_targets[rows], bbox_weights[rows]))
+
+    return rois, labels, bbox_targets, bbox_weights
@@ -12,10 +12,12 @@ Proposal Target Operator selects foreground and background roi and assigns label
 import mxnet as mx
 import numpy as np
 from distutils.util import strtobool
+from profiler import profile_op
 
 
 
 
+@profile_op('BoxAnnotatorOHEM')
 class BoxAnnotatorOHEMOperator(mx.operator.CustomOp):
     def __init__(self, num_classes, num_reg_classes, roi_per_img):
         super(BoxAnnotatorOHEMOperator, self).__init__()
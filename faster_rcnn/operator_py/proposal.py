@@ -8,16 +8,19 @@ import numpy as np
 import numpy.random as npr
 from distutils.util import strtobool
 
-from bbox.bbox_transform import bbox_pred, clip_boxes
+from bbox.bbox_transform import bbox_pred
 from rpn.generate_anchor import generate_anchors
-from nms.nms import py_nms_wrapper, cpu_nms_wrapper, gpu_nms_wrapper
+from rpn.anchor_cache import get_shifted_anchors
+from nms.nms import gpu_nms_wrapper, soft_nms_wrapper, cpu_nms_topn
+from profiler import profile_op
 
 DEBUG = False
 
 
+@profile_op('proposal')
 class ProposalOperator(mx.operator.CustomOp):
     def __init__(self, feat_stride, scales, ratios, output_score,
-                 rpn_pre_nms_top_n, rpn_post_nms_top_n, threshold, rpn_min_size):
+                 rpn_pre_nms_top_n, rpn_post_nms_top_n, threshold, rpn_min_size, nms_type='nms', nms_sigma=0.5):
         super(ProposalOperator, self).__init__()
         self._feat_stride = feat_stride
         self._scales = np.fromstring(scales[1:-1], dtype=float, sep=',')
@@ -29,6 +32,8 @@ class ProposalOperator(mx.operator.CustomOp):
         self._rpn_post_nms_top_n = rpn_post_nms_top_n
         self._threshold = threshold
         self._rpn_min_size = rpn_min_size
+        self._nms_type = nms_type
+        self._nms_sigma = nms_sigma
 
         if DEBUG:
             print 'feat_stride: {}'.format(self._feat_stride)
@@ -36,22 +41,27 @@ class ProposalOperator(mx.operator.CustomOp):
             print self._anchors
 
     def forward(self, is_train, req, in_data, out_data, aux):
-        nms = gpu_nms_wrapper(self._threshold, in_data[0].context.device_id)
-
-        batch_size = in_data[0].shape[0]
-        if batch_size > 1:
-            raise ValueError("Sorry, multiple images each device is not implemented")
+        context = in_data[0].context
+        if self._nms_type != 'nms':
+            # decayed proposals are only reordered, post_nms_topN does the cut
+            nms = soft_nms_wrapper(self._nms_type, self._threshold, self._nms_sigma, score_thresh=0)
+        elif context.device_type == 'gpu':
+            nms = gpu_nms_wrapper(self._threshold, context.device_id)
+        else:
+            # cpu_nms_topn
+            nms = None
 
-        # for each (H, W) location i
+        # for each (H, W) location i of each image
         #   generate A anchor boxes centered on cell i
         #   apply predicted bbox deltas at cell i to each of the A anchors
         # clip predicted boxes to image
         # remove predicted boxes with either height or width < threshold
-        # sort all (proposal, score) pairs by score from highest to lowest
-        # take top pre_nms_topN proposals before NMS
-        # apply NMS with threshold 0.7 to remaining proposals
-        # take after_nms_topN proposals after NMS
-        # return the top proposals (-> RoIs top, scores top)
+        # then per image
+        #   sort all (proposal, score) pairs by score from highest to lowest
+        #   take top pre_nms_topN proposals before NMS
+        #   apply NMS with threshold 0.7 to remaining proposals
+        #   take after_nms_topN proposals after NMS
+        # return the top proposals (-> RoIs top, scores top) of all images in image order
 
         pre_nms_topN = self._rpn_pre_nms_top_n
         post_nms_topN = self._rpn_post_nms_top_n
@@ -61,98 +71,110 @@ class ProposalOperator(mx.operator.CustomOp):
         # keep the second part
         scores = in_data[0].asnumpy()[:, self._num_anchors:, :, :]
         bbox_deltas = in_data[1].asnumpy()
-        im_info = in_data[2].asnumpy()[0, :]
+        im_info = in_data[2].asnumpy()
+        batch_size, A, feat_height, feat_width = scores.shape
 
         if DEBUG:
-            print 'im_size: ({}, {})'.format(im_info[0], im_info[1])
-            print 'scale: {}'.format(im_info[2])
+            print 'im_size: {}'.format(im_info[:, :2])
+            print 'scale: {}'.format(im_info[:, 2])
 
         # 1. Generate proposals from bbox_deltas and shifted anchors
         # use real image size instead of padded feature map sizes
-        height, width = int(im_info[0] / self._feat_stride), int(im_info[1] / self._feat_stride)
+        heights = np.minimum((im_info[:, 0] / self._feat_stride).astype(int), feat_height)
+        widths = np.minimum((im_info[:, 1] / self._feat_stride).astype(int), feat_width)
 
         if DEBUG:
             print 'score map size: {}'.format(scores.shape)
-            print "resudial: {}".format((scores.shape[2] - height, scores.shape[3] - width))
+            print "resudial: {}".format((feat_height - heights, feat_width - widths))
 
-        # Enumerate all shifts
-        shift_x = np.arange(0, width) * self._feat_stride
-        shift_y = np.arange(0, height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())).transpose()
+        # Enumerate all shifted anchors of the padded feature map, (K*A, 4) ordered by (h, w, a)
+        # cached by feature map shape
+        K = feat_height * feat_width
+        anchors = get_shifted_anchors(feat_height, feat_width, self._feat_stride, self._scales, self._ratios)
 
-        # Enumerate all shifted anchors:
-        #
-        # add A anchors (1, A, 4) to
-        # cell K shifts (K, 1, 4) to get
-        # shift anchors (K, A, 4)
-        # reshape to (K*A, 4) shifted anchors
-        A = self._num_anchors
-        K = shifts.shape[0]
-        anchors = self._anchors.reshape((1, A, 4)) + shifts.reshape((1, K, 4)).transpose((1, 0, 2))
-        anchors = anchors.reshape((K * A, 4))
+        # cells inside the real size of each image, (N, K * A) ordered by (h, w, a)
+        # nonzero gives the anchors of all images in image order and (h, w, a) order within an image
+        inside = (np.arange(feat_height)[np.newaxis, :, np.newaxis] < heights[:, np.newaxis, np.newaxis]) & \
+                 (np.arange(feat_width)[np.newaxis, np.newaxis, :] < widths[:, np.newaxis, np.newaxis])
+        inside = np.repeat(inside.reshape((batch_size, K)), A, axis=1)
+        im_inds, anchor_inds = np.nonzero(inside)
 
         # Transpose and reshape predicted bbox transformations to get them
         # into the same order as the anchors:
         #
-        # bbox deltas will be (1, 4 * A, H, W) format
-        # transpose to (1, H, W, 4 * A)
-        # reshape to (1 * H * W * A, 4) where rows are ordered by (h, w, a)
+        # bbox deltas will be (N, 4 * A, H, W) format
+        # transpose to (N, H, W, 4 * A)
+        # reshape to (N, H * W * A, 4) where rows are ordered by (h, w, a)
         # in slowest to fastest order
-        bbox_deltas = self._clip_pad(bbox_deltas, (height, width))
-        bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1)).reshape((-1, 4))
+        bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1)).reshape((batch_size, K * A, 4))[im_inds, anchor_inds]
 
         # Same story for the scores:
         #
-        # scores are (1, A, H, W) format
-        # transpose to (1, H, W, A)
-        # reshape to (1 * H * W * A, 1) where rows are ordered by (h, w, a)
-        scores = self._clip_pad(scores, (height, width))
-        scores = scores.transpose((0, 2, 3, 1)).reshape((-1, 1))
+        # scores are (N, A, H, W) format
+        # transpose to (N, H, W, A)
+        # reshape to (N, H * W * A) where rows are ordered by (h, w, a)
+        scores = scores.transpose((0, 2, 3, 1)).reshape((batch_size, K * A))[im_inds, anchor_inds]
 
         # Convert anchors into proposals via bbox transformations
-        proposals = bbox_pred(anchors, bbox_deltas)
+        proposals = bbox_pred(anchors[anchor_inds], bbox_deltas)
 
-        # 2. clip predicted boxes to image
-        proposals = clip_boxes(proposals, im_info[:2])
+        # 2. clip predicted boxes to their image
+        proposals[:, 0::2] = np.maximum(np.minimum(proposals[:, 0::2], im_info[im_inds, 1:2] - 1), 0)
+        proposals[:, 1::2] = np.maximum(np.minimum(proposals[:, 1::2], im_info[im_inds, 0:1] - 1), 0)
 
         # 3. remove predicted boxes with either height or width < threshold
         # (NOTE: convert min_size to input image scale stored in im_info[2])
-        keep = self._filter_boxes(proposals, min_size * im_info[2])
-        proposals = proposals[keep, :]
-        scores = scores[keep]
-
-        # 4. sort all (proposal, score) pairs by score from highest to lowest
-        # 5. take top pre_nms_topN (e.g. 6000)
-        order = scores.ravel().argsort()[::-1]
-        if pre_nms_topN > 0:
-            order = order[:pre_nms_topN]
-        proposals = proposals[order, :]
-        scores = scores[order]
-
-        # 6. apply nms (e.g. threshold = 0.7)
-        # 7. take after_nms_topN (e.g. 300)
+        keep = self._filter_boxes(proposals, min_size * im_info[im_inds, 2])
+        im_inds = im_inds[keep]
+        det = np.hstack((proposals[keep, :], scores[keep, np.newaxis])).astype(np.float32)
+        bounds = np.searchsorted(im_inds, np.arange(batch_size + 1))
+
+        # 4. - 8. for each image
+        rois = []
+        roi_scores = []
+        for i in range(batch_size):
+            im_det = self._nms_top_n(nms, det[bounds[i]:bounds[i + 1]], pre_nms_topN, post_nms_topN)
+            batch_inds = np.full((im_det.shape[0], 1), i, dtype=np.float32)
+            rois.append(np.hstack((batch_inds, im_det[:, :4])))
+            roi_scores.append(im_det[:, 4:5])
+
+        # Output rois array with the batch index of every roi
+        self.assign(out_data[0], req[0], np.vstack(rois))
+
+        if self._output_score:
+            self.assign(out_data[1], req[1], np.vstack(roi_scores))
+
+    def _nms_top_n(self, nms, det, pre_nms_topN, post_nms_topN):
+        """
+        steps 4. to 8. of one image
+        :param nms: nms function, None for cpu_nms_topn
+        :param det: [N, 5] float32 proposals and scores of one image
+        :return: [post_nms_topN, 5] top proposals padded by repeating random kept ones
+        """
+        if nms is None:
+            # steps 4 to 7 run in one multithreaded call
+            keep = cpu_nms_topn(det, self._threshold, pre_nms_topN, post_nms_topN)
+        else:
+            # 4. sort all (proposal, score) pairs by score from highest to lowest
+            # 5. take top pre_nms_topN (e.g. 6000)
+            order = det[:, 4].argsort()[::-1]
+            if pre_nms_topN > 0:
+                order = order[:pre_nms_topN]
+            det = det[order, :]
+
+            # 6. apply nms (e.g. threshold = 0.7)
+            # 7. take after_nms_topN (e.g. 300)
+            keep = nms(det)
+            if post_nms_topN > 0:
+                keep = keep[:post_nms_topN]
+
         # 8. return the top proposals (-> RoIs top)
-        det = np.hstack((proposals, scores)).astype(np.float32)
-        keep = nms(det)
-        if post_nms_topN > 0:
-            keep = keep[:post_nms_topN]
         # pad to ensure output size remains unchanged
         if len(keep) < post_nms_topN:
             pad = npr.choice(keep, size=post_nms_topN - len(keep))
             keep = np.hstack((keep, pad))
-        proposals = proposals[keep, :]
-        scores = scores[keep]
-
-        # Output rois array
-        # Our RPN implementation only supports a single input image, so all
-        # batch inds are 0
-        batch_inds = np.zeros((proposals.shape[0], 1), dtype=np.float32)
-        blob = np.hstack((batch_inds, proposals.astype(np.float32, copy=False)))
-        self.assign(out_data[0], req[0], blob)
-
-        if self._output_score:
-            self.assign(out_data[1], req[1], scores.astype(np.float32, copy=False))
+        # soft and matrix nms have written their decayed scores into det
+        return det[keep, :]
 
     def backward(self, req, out_grad, in_data, out_data, in_grad, aux):
         self.assign(in_grad[0], req[0], 0)
@@ -167,27 +189,12 @@ class ProposalOperator(mx.operator.CustomOp):
         keep = np.where((ws >= min_size) & (hs >= min_size))[0]
         return keep
 
-    @staticmethod
-    def _clip_pad(tensor, pad_shape):
-        """
-        Clip boxes of the pad area.
-        :param tensor: [n, c, H, W]
-        :param pad_shape: [h, w]
-        :return: [n, c, h, w]
-        """
-        H, W = tensor.shape[2:]
-        h, w = pad_shape
-
-        if h < H or w < W:
-            tensor = tensor[:, :, :h, :w].copy()
-
-        return tensor
-
 
 @mx.operator.register("proposal")
 class ProposalProp(mx.operator.CustomOpProp):
     def __init__(self, feat_stride='16', scales='(8, 16, 32)', ratios='(0.5, 1, 2)', output_score='False',
-                 rpn_pre_nms_top_n='6000', rpn_post_nms_top_n='300', threshold='0.3', rpn_min_size='16'):
+                 rpn_pre_nms_top_n='6000', rpn_post_nms_top_n='300', threshold='0.3', rpn_min_size='16',
+                 nms_type='nms', nms_sigma='0.5'):
         super(ProposalProp, self).__init__(need_top_grad=False)
         self._feat_stride = int(feat_stride)
         self._scales = scales
@@ -197,6 +204,8 @@ class ProposalProp(mx.operator.CustomOpProp):
         self._rpn_post_nms_top_n = int(rpn_post_nms_top_n)
         self._threshold = float(threshold)
         self._rpn_min_size = int(rpn_min_size)
+        self._nms_type = nms_type
+        self._nms_sigma = float(nms_sigma)
 
     def list_arguments(self):
         return ['cls_prob', 'bbox_pred', 'im_info']
@@ -214,8 +223,8 @@ class ProposalProp(mx.operator.CustomOpProp):
 
         batch_size = cls_prob_shape[0]
         im_info_shape = (batch_size, 3)
-        output_shape = (self._rpn_post_nms_top_n, 5)
-        score_shape = (self._rpn_post_nms_top_n, 1)
+        output_shape = (batch_size * self._rpn_post_nms_top_n, 5)
+        score_shape = (batch_size * self._rpn_post_nms_top_n, 1)
 
         if self._output_score:
             return [cls_prob_shape, bbox_pred_shape, im_info_shape], [output_shape, score_shape]
@@ -224,7 +233,8 @@ class ProposalProp(mx.operator.CustomOpProp):
 
     def create_operator(self, ctx, shapes, dtypes):
         return ProposalOperator(self._feat_stride, self._scales, self._ratios, self._output_score,
-                                self._rpn_pre_nms_top_n, self._rpn_post_nms_top_n, self._threshold, self._rpn_min_size)
+                                self._rpn_pre_nms_top_n, self._rpn_post_nms_top_n, self._threshold, self._rpn_min_size,
+                                self._nms_type, self._nms_sigma)
 
     def declare_backward_dependency(self, out_grad, in_data, out_data):
         return []
@@ -17,11 +17,13 @@ from easydict import EasyDict as edict
 import cPickle
 
 
-from core.rcnn import sample_rois
+from core.rcnn import sample_rois_batch
+from profiler import profile_op
 
 DEBUG = False
 
 
+@profile_op('proposal_target')
 class ProposalTargetOperator(mx.operator.CustomOp):
     def __init__(self, num_classes, batch_images, batch_rois, cfg, fg_fraction):
         super(ProposalTargetOperator, self).__init__()
@@ -50,14 +52,12 @@ class ProposalTargetOperator(mx.operator.CustomOp):
             fg_rois_per_image = np.round(self._fg_fraction * rois_per_image).astype(int)
 
 
-        # Include ground-truth boxes in the set of candidate rois
-        zeros = np.zeros((gt_boxes.shape[0], 1), dtype=gt_boxes.dtype)
-        all_rois = np.vstack((all_rois, np.hstack((zeros, gt_boxes[:, :-1]))))
         # Sanity check: single batch only
         assert np.all(all_rois[:, 0] == 0), 'Only single item batches are supported'
 
+        # ground-truth boxes are included in the set of candidate rois
         rois, labels, bbox_targets, bbox_weights = \
-            sample_rois(all_rois, fg_rois_per_image, rois_per_image, self._num_classes, self._cfg, gt_boxes=gt_boxes)
+            sample_rois_batch(all_rois, [gt_boxes], fg_rois_per_image, rois_per_image, self._num_classes, self._cfg)
 
         if DEBUG:
             print "labels=", labels
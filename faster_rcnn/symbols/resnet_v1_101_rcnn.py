@@ -780,7 +780,8 @@ class resnet_v1_101_rcnn(Symbol):
                     op_type='proposal', feat_stride=cfg.network.RPN_FEAT_STRIDE,
                     scales=tuple(cfg.network.ANCHOR_SCALES), ratios=tuple(cfg.network.ANCHOR_RATIOS),
                     rpn_pre_nms_top_n=cfg.TEST.RPN_PRE_NMS_TOP_N, rpn_post_nms_top_n=cfg.TEST.RPN_POST_NMS_TOP_N,
-                    threshold=cfg.TEST.RPN_NMS_THRESH, rpn_min_size=cfg.TEST.RPN_MIN_SIZE)
+                    threshold=cfg.TEST.RPN_NMS_THRESH, rpn_min_size=cfg.TEST.RPN_MIN_SIZE,
+                    nms_type=cfg.TEST.NMS_TYPE, nms_sigma=cfg.TEST.NMS_SIGMA)
 
         conv_new_1 = mx.sym.Convolution(data=relu1, kernel=(1, 1), num_filter=256, name="conv_new_1")
         conv_new_1_relu = mx.sym.Activation(data=conv_new_1, act_type='relu', name='conv_new_1_relu')
@@ -894,7 +895,8 @@ class resnet_v1_101_rcnn(Symbol):
                     op_type='proposal', feat_stride=cfg.network.RPN_FEAT_STRIDE,
                     scales=tuple(cfg.network.ANCHOR_SCALES), ratios=tuple(cfg.network.ANCHOR_RATIOS),
                     rpn_pre_nms_top_n=cfg.TEST.RPN_PRE_NMS_TOP_N, rpn_post_nms_top_n=cfg.TEST.RPN_POST_NMS_TOP_N,
-                    threshold=cfg.TEST.RPN_NMS_THRESH, rpn_min_size=cfg.TEST.RPN_MIN_SIZE)
+                    threshold=cfg.TEST.RPN_NMS_THRESH, rpn_min_size=cfg.TEST.RPN_MIN_SIZE,
+                    nms_type=cfg.TEST.NMS_TYPE, nms_sigma=cfg.TEST.NMS_SIGMA)
                 group = mx.symbol.Group([rois, score])
         self.sym = group
         return group
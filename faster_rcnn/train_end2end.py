@@ -47,6 +47,7 @@ from utils.load_data import load_gt_roidb, merge_roidb, filter_roidb
 from utils.load_model import load_param
 from utils.PrefetchingIter import PrefetchingIter
 from utils.lr_scheduler import WarmupMultiFactorScheduler
+from operator_py import profiler as op_profiler
 
 
 def train_net(args, ctx, pretrained, epoch, prefix, begin_epoch, end_epoch, lr, lr_step):
@@ -108,7 +109,8 @@ def train_net(args, ctx, pretrained, epoch, prefix, begin_epoch, end_epoch, lr,
 
     mod = MutableModule(sym, data_names=data_names, label_names=label_names,
                         logger=logger, context=ctx, max_data_shapes=[max_data_shape for _ in range(batch_size)],
-                        max_label_shapes=[max_label_shape for _ in range(batch_size)], fixed_param_prefix=fixed_param_prefix)
+                        max_label_shapes=[max_label_shape for _ in range(batch_size)], fixed_param_prefix=fixed_param_prefix,
+                        max_cached_modules=config.network.EXECUTOR_CACHE_SIZE)
 
     if config.TRAIN.RESUME:
         mod._preload_opt_states = '%s-%04d.states'%(prefix, begin_epoch)
@@ -148,13 +150,24 @@ def train_net(args, ctx, pretrained, epoch, prefix, begin_epoch, end_epoch, lr,
                         'clip_gradient': None}
 
     if not isinstance(train_data, PrefetchingIter):
-        train_data = PrefetchingIter(train_data)
+        train_data = PrefetchingIter(train_data, prefetch_depth=config.TRAIN.PREFETCH_DEPTH,
+                                     num_workers=config.TRAIN.PREFETCH_WORKERS)
 
     # train
+    phase_timer = callback.PhaseTimer(trace_file=config.TRAIN.PHASE_TRACE, sync=config.TRAIN.PHASE_TIMING_SYNC) \
+        if config.TRAIN.PHASE_TIMING else None
+    if config.TRAIN.PROFILE_OPS:
+        op_profiler.enable(trace_file=config.TRAIN.PROFILE_OPS_TRACE)
     mod.fit(train_data, eval_metric=eval_metrics, epoch_end_callback=epoch_end_callback,
             batch_end_callback=batch_end_callback, kvstore=config.default.kvstore,
             optimizer='sgd', optimizer_params=optimizer_params,
-            arg_params=arg_params, aux_params=aux_params, begin_epoch=begin_epoch, num_epoch=end_epoch)
+            arg_params=arg_params, aux_params=aux_params, begin_epoch=begin_epoch, num_epoch=end_epoch,
+            phase_timer=phase_timer)
+    train_data.close()
+    if phase_timer is not None:
+        phase_timer.close()
+    if config.TRAIN.PROFILE_OPS:
+        op_profiler.disable()
 
 
 def main():
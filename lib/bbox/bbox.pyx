@@ -55,3 +55,197 @@ def bbox_overlaps_cython(
                     )
                     overlaps[n, k] = iw * ih / ua
     return overlaps
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def max_overlaps_cython(
+        np.ndarray[DTYPE_t, ndim=2] boxes,
+        np.ndarray[DTYPE_t, ndim=2] query_boxes):
+    """
+    Best query box of each box without building the overlap matrix.
+    Overlaps are computed as in bbox_overlaps_cython and ties go to the first query box,
+    so the result is the argmax and max along axis 1 of bbox_overlaps_cython.
+    Parameters
+    ----------
+    boxes: (N, 4) ndarray of float
+    query_boxes: (K, 4) ndarray of float, K > 0
+    Returns
+    -------
+    assignment: (N, ) ndarray of the index of the query box with the max overlap
+    max_overlaps: (N, ) ndarray of that overlap
+    """
+    cdef unsigned int N = boxes.shape[0]
+    cdef unsigned int K = query_boxes.shape[0]
+    cdef np.ndarray[np.int_t, ndim=1] assignment = np.zeros((N,), dtype=np.int)
+    cdef np.ndarray[DTYPE_t, ndim=1] max_overlaps = np.zeros((N,), dtype=DTYPE)
+    cdef np.ndarray[DTYPE_t, ndim=1] query_areas = np.zeros((K,), dtype=DTYPE)
+    cdef DTYPE_t iw, ih, ua, overlap, best
+    cdef unsigned int k, n, best_k
+    for k in range(K):
+        query_areas[k] = (
+            (query_boxes[k, 2] - query_boxes[k, 0] + 1) *
+            (query_boxes[k, 3] - query_boxes[k, 1] + 1)
+        )
+    for n in range(N):
+        best = -1
+        best_k = 0
+        for k in range(K):
+            overlap = 0
+            iw = (
+                min(boxes[n, 2], query_boxes[k, 2]) -
+                max(boxes[n, 0], query_boxes[k, 0]) + 1
+            )
+            if iw > 0:
+                ih = (
+                    min(boxes[n, 3], query_boxes[k, 3]) -
+                    max(boxes[n, 1], query_boxes[k, 1]) + 1
+                )
+                if ih > 0:
+                    ua = float(
+                        (boxes[n, 2] - boxes[n, 0] + 1) *
+                        (boxes[n, 3] - boxes[n, 1] + 1) +
+                        query_areas[k] - iw * ih
+                    )
+                    overlap = iw * ih / ua
+            if overlap > best:
+                best = overlap
+                best_k = k
+        assignment[n] = best_k
+        max_overlaps[n] = best
+    return assignment, max_overlaps
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def anchor_overlaps_cython(
+        np.ndarray[DTYPE_t, ndim=2] anchors,
+        unsigned int feat_height,
+        unsigned int feat_width,
+        unsigned int num_anchors,
+        DTYPE_t feat_stride,
+        np.ndarray[DTYPE_t, ndim=2] query_boxes):
+    """
+    Overlaps of the intersecting pairs of the anchors of a feature map and query_boxes.
+    Anchor (h, w, a) is anchor a of cell (0, 0) shifted by (w, h) * feat_stride, so the cells
+    whose anchor a can intersect a query box form a rectangle, and only those are tested.
+    Overlaps are computed as in bbox_overlaps_cython.
+    Parameters
+    ----------
+    anchors: (feat_height * feat_width * num_anchors, 4) ndarray of float ordered by (h, w, a)
+    query_boxes: (K, 4) ndarray of float
+    Returns
+    -------
+    anchor_inds, query_inds: indexes of the intersecting pairs
+    overlaps: overlap of each pair
+    """
+    cdef unsigned int K = query_boxes.shape[0]
+    cdef unsigned int A = num_anchors
+    cdef np.ndarray[np.int_t, ndim=2] h_range = np.zeros((K * A, 2), dtype=np.int)
+    cdef np.ndarray[np.int_t, ndim=2] w_range = np.zeros((K * A, 2), dtype=np.int)
+    cdef unsigned int k, a, n, ka
+    cdef int h, w, count = 0
+    cdef DTYPE_t iw, ih, box_area, ua
+
+    # rectangle of cells of each (query box, anchor), bounds are widened by one cell and tested exactly below
+    for k in range(K):
+        for a in range(A):
+            ka = k * A + a
+            w_range[ka, 0] = max(<int>((query_boxes[k, 0] - anchors[a, 2] - 1) // feat_stride), 0)
+            w_range[ka, 1] = min(<int>((query_boxes[k, 2] - anchors[a, 0] + 1) // feat_stride) + 1, <int>feat_width - 1)
+            h_range[ka, 0] = max(<int>((query_boxes[k, 1] - anchors[a, 3] - 1) // feat_stride), 0)
+            h_range[ka, 1] = min(<int>((query_boxes[k, 3] - anchors[a, 1] + 1) // feat_stride) + 1, <int>feat_height - 1)
+            if w_range[ka, 1] >= w_range[ka, 0] and h_range[ka, 1] >= h_range[ka, 0]:
+                count += (w_range[ka, 1] - w_range[ka, 0] + 1) * (h_range[ka, 1] - h_range[ka, 0] + 1)
+
+    cdef np.ndarray[np.int_t, ndim=1] anchor_inds = np.zeros((count,), dtype=np.int)
+    cdef np.ndarray[np.int_t, ndim=1] query_inds = np.zeros((count,), dtype=np.int)
+    cdef np.ndarray[DTYPE_t, ndim=1] overlaps = np.zeros((count,), dtype=DTYPE)
+    count = 0
+    for k in range(K):
+        box_area = (
+            (query_boxes[k, 2] - query_boxes[k, 0] + 1) *
+            (query_boxes[k, 3] - query_boxes[k, 1] + 1)
+        )
+        for a in range(A):
+            ka = k * A + a
+            for h in range(h_range[ka, 0], h_range[ka, 1] + 1):
+                for w in range(w_range[ka, 0], w_range[ka, 1] + 1):
+                    n = (h * feat_width + w) * A + a
+                    iw = (
+                        min(anchors[n, 2], query_boxes[k, 2]) -
+                        max(anchors[n, 0], query_boxes[k, 0]) + 1
+                    )
+                    if iw > 0:
+                        ih = (
+                            min(anchors[n, 3], query_boxes[k, 3]) -
+                            max(anchors[n, 1], query_boxes[k, 1]) + 1
+                        )
+                        if ih > 0:
+                            ua = float(
+                                (anchors[n, 2] - anchors[n, 0] + 1) *
+                                (anchors[n, 3] - anchors[n, 1] + 1) +
+                                box_area - iw * ih
+                            )
+                            anchor_inds[count] = n
+                            query_inds[count] = k
+                            overlaps[count] = iw * ih / ua
+                            count += 1
+    return anchor_inds[:count], query_inds[:count], overlaps[:count]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def greedy_query_overlaps_cython(np.ndarray[DTYPE_t, ndim=2] overlaps):
+    """
+    One to one assignment of boxes to query boxes by decreasing overlap, as in IMDB.evaluate_recall:
+    the highest overlap among the unassigned boxes and query boxes is assigned first,
+    ties go to the first query box and then to the first box.
+    Parameters
+    ----------
+    overlaps: (N, K) ndarray of overlap between boxes and query_boxes
+    Returns
+    -------
+    query_overlaps: (K, ) ndarray of the overlap of each query box with its box, 0 if it got none
+    """
+    cdef unsigned int N = overlaps.shape[0]
+    cdef unsigned int K = overlaps.shape[1]
+    cdef np.ndarray[DTYPE_t, ndim=1] query_overlaps = np.zeros((K,), dtype=DTYPE)
+    cdef np.ndarray[np.uint8_t, ndim=1] box_used = np.zeros((N,), dtype=np.uint8)
+    cdef np.ndarray[np.uint8_t, ndim=1] query_used = np.zeros((K,), dtype=np.uint8)
+    # best unassigned box of each query box
+    cdef np.ndarray[DTYPE_t, ndim=1] best_overlap = np.zeros((K,), dtype=DTYPE)
+    cdef np.ndarray[np.int_t, ndim=1] best_box = np.zeros((K,), dtype=np.int)
+    cdef unsigned int j, k, n, best_k
+    cdef int used_n
+    cdef DTYPE_t best
+
+    for k in range(K):
+        best_overlap[k] = -1
+        for n in range(N):
+            if overlaps[n, k] > best_overlap[k]:
+                best_overlap[k] = overlaps[n, k]
+                best_box[k] = n
+    for j in range(min(N, K)):
+        best = -1
+        best_k = 0
+        for k in range(K):
+            if not query_used[k] and best_overlap[k] > best:
+                best = best_overlap[k]
+                best_k = k
+        # the remaining query boxes are not covered, they keep 0
+        if best <= 0:
+            break
+        used_n = best_box[best_k]
+        query_overlaps[best_k] = best
+        query_used[best_k] = 1
+        box_used[used_n] = 1
+        # query boxes whose best box was taken look for the next one
+        for k in range(K):
+            if not query_used[k] and best_box[k] == used_n:
+                best_overlap[k] = -1
+                for n in range(N):
+                    if not box_used[n] and overlaps[n, k] > best_overlap[k]:
+                        best_overlap[k] = overlaps[n, k]
+                        best_box[k] = n
+    return query_overlaps
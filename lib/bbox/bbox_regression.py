@@ -113,25 +113,33 @@ def add_bbox_regression_targets(roidb, cfg):
     return means.ravel(), stds.ravel()
 
 
-def expand_bbox_regression_targets(bbox_targets_data, num_classes, cfg):
+def expand_bbox_regression_targets(bbox_targets_data, num_classes, cfg, out=None):
     """
     expand from 5 to 4 * num_classes; only the right class has non-zero bbox regression targets
     :param bbox_targets_data: [k * 5]
     :param num_classes: number of classes
+    :param out: optional (bbox_targets, bbox_weights) [k * 4 num_classes] buffers to write to
     :return: bbox target processed [k * 4 num_classes]
     bbox_weights ! only foreground boxes have bbox regression computation!
     """
     classes = bbox_targets_data[:, 0]
     if cfg.CLASS_AGNOSTIC:
         num_classes = 2
-    bbox_targets = np.zeros((classes.size, 4 * num_classes), dtype=np.float32)
-    bbox_weights = np.zeros(bbox_targets.shape, dtype=np.float32)
+    if out is None:
+        bbox_targets = np.zeros((classes.size, 4 * num_classes), dtype=np.float32)
+        bbox_weights = np.zeros(bbox_targets.shape, dtype=np.float32)
+    else:
+        bbox_targets, bbox_weights = out
+        bbox_targets[:] = 0
+        bbox_weights[:] = 0
     indexes = np.where(classes > 0)[0]
-    for index in indexes:
-        cls = classes[index]
-        start = int(4 * 1 if cls > 0 else 0) if cfg.CLASS_AGNOSTIC else int(4 * cls)
-        end = start + 4
-        bbox_targets[index, start:end] = bbox_targets_data[index, 1:]
-        bbox_weights[index, start:end] = cfg.TRAIN.BBOX_WEIGHTS
+    # scatter the 4 targets of each foreground box to the columns of its class
+    if cfg.CLASS_AGNOSTIC:
+        starts = 4 * np.ones((indexes.size,), dtype=np.int)
+    else:
+        starts = (4 * classes[indexes]).astype(np.int)
+    columns = starts[:, np.newaxis] + np.arange(4)
+    bbox_targets[indexes[:, np.newaxis], columns] = bbox_targets_data[indexes, 1:]
+    bbox_weights[indexes[:, np.newaxis], columns] = cfg.TRAIN.BBOX_WEIGHTS
     return bbox_targets, bbox_weights
 
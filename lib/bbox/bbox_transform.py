@@ -1,11 +1,42 @@
 import numpy as np
-from bbox import bbox_overlaps_cython
+from bbox import bbox_overlaps_cython, max_overlaps_cython, anchor_overlaps_cython, greedy_query_overlaps_cython
 
 
 def bbox_overlaps(boxes, query_boxes):
     return bbox_overlaps_cython(boxes, query_boxes)
 
 
+def max_overlaps(boxes, query_boxes):
+    """
+    argmax and max of bbox_overlaps along the query boxes, computed without the n * k matrix
+    :param boxes: n * 4 bounding boxes
+    :param query_boxes: k * 4 bounding boxes, k > 0
+    :return: n index of the query box each box overlaps most, n overlap with it
+    """
+    return max_overlaps_cython(np.ascontiguousarray(boxes, dtype=np.float), np.ascontiguousarray(query_boxes, dtype=np.float))
+
+
+def anchor_overlaps(anchors, feat_height, feat_width, num_anchors, feat_stride, query_boxes):
+    """
+    sparse overlaps between the shifted anchors of a feature map and query boxes
+    :param anchors: (feat_height * feat_width * num_anchors, 4) ordered by (h, w, a)
+    :param query_boxes: k * 4 bounding boxes
+    :return: anchor indexes, query box indexes and overlaps of the pairs that intersect,
+    every other pair has overlap 0 in bbox_overlaps
+    """
+    return anchor_overlaps_cython(anchors.astype(np.float, copy=False), feat_height, feat_width, num_anchors,
+                                  float(feat_stride), query_boxes.astype(np.float))
+
+
+def greedy_query_overlaps(overlaps):
+    """
+    one to one assignment of boxes to query boxes by decreasing overlap
+    :param overlaps: n * k overlaps from bbox_overlaps
+    :return: k overlap of each query box with its assigned box, 0 if it got none
+    """
+    return greedy_query_overlaps_cython(np.ascontiguousarray(overlaps, dtype=np.float))
+
+
 def bbox_overlaps_py(boxes, query_boxes):
     """
     determine overlaps between boxes and query_boxes
@@ -13,6 +13,8 @@ import numpy as np
 import itertools
 
 from imdb import IMDB
+from segmentation_eval import get_confusion_matrix, evaluate_confusion_matrix, confusion_matrix_iu, \
+    SegmentationIncrementalEval
 from PIL import Image
 
 class CityScape(IMDB):
@@ -170,16 +172,17 @@ class CityScape(IMDB):
 
         return pallete
 
-    def evaluate_segmentations(self, pred_segmentations = None):
+    def evaluate_segmentations(self, pred_segmentations = None, write_results=True):
         """
         top level evaluations
-        :param pred_segmentations: the pred segmentation result
+        :param pred_segmentations: the pred segmentation result, None to evaluate the written pngs
+        :param write_results: write the pred segmentation result as pngs, they are scored from memory
         :return: the evaluation results
         """
-        if not (pred_segmentations is None):
+        if not (pred_segmentations is None) and write_results:
             self.write_segmentation_result(pred_segmentations)
 
-        info = self._py_evaluate_segmentation()
+        info = self._py_evaluate_segmentation(pred_segmentations)
         return info
 
 
@@ -191,55 +194,40 @@ class CityScape(IMDB):
         :param class_num: the nunber of class
         :return: the confusion matrix
         """
-        index = (gt_label * class_num + pred_label).astype('int32')
-        label_count = np.bincount(index)
-        confusion_matrix = np.zeros((class_num, class_num))
+        return get_confusion_matrix(gt_label, pred_label, class_num)
 
-        for i_label in range(class_num):
-            for i_pred_label in range(class_num):
-                cur_index = i_label * class_num + i_pred_label
-                if cur_index < len(label_count):
-                    confusion_matrix[i_label, i_pred_label] = label_count[cur_index]
-
-        return confusion_matrix
-
-    def _py_evaluate_segmentation(self):
+    def _py_evaluate_segmentation(self, pred_segmentations=None):
         """
         This function is a wrapper to calculte the metrics for given pred_segmentation results
+        :param pred_segmentations: the pred segmentation result, None to read the written pngs
         :return: the evaluation metrics
         """
-        res_file_folder = os.path.join(self.result_path, 'results')
-
-        confusion_matrix = np.zeros((self.num_classes,self.num_classes))
-        for i, index in enumerate(self.image_set_index):
-            seg_gt_info = self.load_segdb_from_index(index)
-
-            seg_gt = np.array(Image.open(seg_gt_info['seg_cls_path'])).astype('float32')
-
-            seg_pathes = os.path.split(seg_gt_info['seg_cls_path'])
-            res_image_name = seg_pathes[1][:-len('_gtFine_labelTrainIds.png')]
-            res_subfolder_name = os.path.split(seg_pathes[0])[-1]
-            res_save_folder = os.path.join(res_file_folder, res_subfolder_name)
-            res_save_path = os.path.join(res_save_folder, res_image_name + '.png')
-
-            seg_pred = np.array(Image.open(res_save_path)).astype('float32')
-            #seg_pred = np.squeeze(pred_segmentations[i])
-
-            seg_pred = cv2.resize(seg_pred, (seg_gt.shape[1], seg_gt.shape[0]), interpolation=cv2.INTER_NEAREST)
-            ignore_index = seg_gt != 255
-            seg_gt = seg_gt[ignore_index]
-            seg_pred = seg_pred[ignore_index]
+        gt_paths = [self.annotation_path_from_index(index) for index in self.image_set_index]
+        if pred_segmentations is None:
+            pred_segmentations = [self.result_path_from_index(index) for index in self.image_set_index]
+        # the pred is resized to the gt
+        confusion_matrix = evaluate_confusion_matrix(gt_paths, pred_segmentations, self.num_classes, True)
+        return confusion_matrix_iu(confusion_matrix)
 
-            confusion_matrix += self.get_confusion_matrix(seg_gt, seg_pred, self.num_classes)
-
-        pos = confusion_matrix.sum(1)
-        res = confusion_matrix.sum(0)
-        tp = np.diag(confusion_matrix)
-
-        IU_array = (tp / np.maximum(1.0, pos + res - tp))
-        mean_IU = IU_array.mean()
+    def segmentation_evaluator(self, write_results=True):
+        """
+        evaluator updating the confusion matrix image by image, see SegmentationIncrementalEval
+        :param write_results: also write the pred segmentations as pngs from a background thread
+        :return: SegmentationIncrementalEval
+        """
+        gt_paths = [self.annotation_path_from_index(index) for index in self.image_set_index]
+        result_paths = [self.result_path_from_index(index) for index in self.image_set_index] if write_results else None
+        return SegmentationIncrementalEval(gt_paths, self.num_classes, True, result_paths, self.getpallete(256))
 
-        return {'meanIU':mean_IU, 'IU_array':IU_array}
+    def result_path_from_index(self, index):
+        """
+        :param index: the given index
+        :return: the path of the written segmentation result
+        """
+        seg_pathes = os.path.split(self.annotation_path_from_index(index))
+        res_image_name = seg_pathes[1][:-len('_gtFine_labelTrainIds.png')]
+        res_subfolder_name = os.path.split(seg_pathes[0])[-1]
+        return os.path.join(self.result_path, 'results', res_subfolder_name, res_image_name + '.png')
 
     def write_segmentation_result(self, segmentation_results):
         """
@@ -254,13 +242,8 @@ class CityScape(IMDB):
 
         pallete = self.getpallete(256)
         for i, index in enumerate(self.image_set_index):
-            seg_gt_info = self.load_segdb_from_index(index)
-
-            seg_pathes = os.path.split(seg_gt_info['seg_cls_path'])
-            res_image_name = seg_pathes[1][:-len('_gtFine_labelTrainIds.png')]
-            res_subfolder_name = os.path.split(seg_pathes[0])[-1]
-            res_save_folder = os.path.join(res_file_folder, res_subfolder_name)
-            res_save_path = os.path.join(res_save_folder, res_image_name + '.png')
+            res_save_path = self.result_path_from_index(index)
+            res_save_folder = os.path.dirname(res_save_path)
 
             if not os.path.exists(res_save_folder):
                 os.makedirs(res_save_folder)
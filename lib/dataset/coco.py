@@ -9,6 +9,8 @@ from imdb import IMDB
 # coco api
 from .pycocotools.coco import COCO
 from .pycocotools.cocoeval import COCOeval
+from .pycocotools.detections import COCODetections
+from .pycocotools.annotations import COCOAnnotations
 from .pycocotools import mask as COCOmask
 from utils.mask_coco2voc import mask_coco2voc
 from utils.mask_voc2coco import mask_voc2coco
@@ -17,45 +19,82 @@ from bbox.bbox_transform import clip_boxes
 import multiprocessing as mp
 
 
-def coco_results_one_category_kernel(data_pack):
-    cat_id = data_pack['cat_id']
+def coco_results_kernel(data_pack):
+    """
+    detections of a shard of images as columns for COCODetections, per class
+    :param data_pack: dict with 'all_im_info' of the shard, 'boxes' and 'masks' as [class][image of the shard]
+    :return: for every class: image ids, [N, 4] boxes as [x, y, w, h], scores, list of RLEs for segm else None
+    """
     ann_type = data_pack['ann_type']
     binary_thresh = data_pack['binary_thresh']
     all_im_info = data_pack['all_im_info']
-    boxes = data_pack['boxes']
-    if ann_type == 'bbox':
-        masks = []
-    elif ann_type == 'segm':
-        masks = data_pack['masks']
-    else:
+    if ann_type not in ('bbox', 'segm'):
         print 'unimplemented ann_type: ' + ann_type
-    cat_results = []
-    for im_ind, im_info in enumerate(all_im_info):
-        index = im_info['index']
-        dets = boxes[im_ind].astype(np.float)
-        if len(dets) == 0:
+    results = []
+    for cls_ind, boxes in enumerate(data_pack['boxes']):
+        masks = data_pack['masks'][cls_ind] if ann_type == 'segm' else None
+        image_ids = []
+        cat_dets = []
+        segms = [] if ann_type == 'segm' else None
+        for im_ind, im_info in enumerate(all_im_info):
+            index = im_info['index']
+            dets = boxes[im_ind].astype(np.float)
+            if len(dets) == 0:
+                continue
+            if ann_type == 'segm':
+                width = im_info['width']
+                height = im_info['height']
+                dets[:, :4] = clip_boxes(dets[:, :4], [height, width])
+                segms.extend(mask_voc2coco(masks[im_ind], dets[:, :4], height, width, binary_thresh))
+            image_ids.append(np.full((dets.shape[0],), index, dtype=np.int64))
+            cat_dets.append(dets[:, :5])
+        if len(cat_dets) == 0:
+            results.append((np.zeros((0,), dtype=np.int64), np.zeros((0, 4)), np.zeros((0,)), segms))
             continue
-        scores = dets[:, -1]
-        if ann_type == 'bbox':
-            xs = dets[:, 0]
-            ys = dets[:, 1]
-            ws = dets[:, 2] - xs + 1
-            hs = dets[:, 3] - ys + 1
-            result = [{'image_id': index,
-                       'category_id': cat_id,
-                       'bbox': [xs[k], ys[k], ws[k], hs[k]],
-                       'score': scores[k]} for k in xrange(dets.shape[0])]
-        elif ann_type == 'segm':
-            width = im_info['width']
-            height = im_info['height']
-            dets[:, :4] = clip_boxes(dets[:, :4], [height, width])
-            mask_encode = mask_voc2coco(masks[im_ind], dets[:, :4], height, width, binary_thresh)
-            result = [{'image_id': index,
-                       'category_id': cat_id,
-                       'segmentation': mask_encode[k],
-                       'score': scores[k]} for k in xrange(len(mask_encode))]
-        cat_results.extend(result)
-    return cat_results
+        dets = np.vstack(cat_dets)
+        xywh = np.hstack((dets[:, 0:2], dets[:, 2:4] - dets[:, 0:2] + 1))
+        results.append((np.hstack(image_ids), xywh, dets[:, 4], segms))
+    return results
+
+
+class COCOIncrementalEval(object):
+    """
+    coco box evaluation fed image by image while the detections are produced,
+    see COCOeval.addImage
+    """
+    def __init__(self, anns, image_ids, class_to_coco_ind, classes):
+        """
+        :param anns: COCOAnnotations of the image set
+        :param image_ids: image id of every image index
+        :param class_to_coco_ind: dict of class name to coco category id
+        :param classes: class names with background at 0
+        """
+        self.coco_eval = COCOeval(anns, None)
+        self.coco_eval.params.useSegm = False
+        self.coco_eval.beginIncremental()
+        self.image_ids = image_ids
+        self.cat_ids = [class_to_coco_ind[cls] for cls in classes[1:]]
+
+    def add(self, im_ind, cls_dets):
+        """
+        :param im_ind: index of the image in the image set
+        :param cls_dets: [[x1, y1, x2, y2, score]] of every class with background at 0
+        :return: None
+        """
+        counts = [len(dets) for dets in cls_dets[1:]]
+        dets = [dets[:, :5] for dets in cls_dets[1:] if len(dets) > 0]
+        dets = np.vstack(dets).astype(np.float) if len(dets) > 0 else np.zeros((0, 5))
+        cat_ids = np.repeat(self.cat_ids, counts)
+        xywh = np.hstack((dets[:, 0:2], dets[:, 2:4] - dets[:, 0:2] + 1))
+        self.coco_eval.addImage(self.image_ids[im_ind], cat_ids, xywh, dets[:, 4])
+
+    def mean_ap(self):
+        """
+        :return: AP @ IoU=0.50:0.95 of the images added so far
+        """
+        self.coco_eval.accumulateIncremental()
+        precision = self.coco_eval.eval['precision'][:, :, :, 0, -1]
+        return np.mean(precision[precision > -1]) if np.any(precision > -1) else 0.
 
 
 class coco(IMDB):
@@ -69,14 +108,17 @@ class coco(IMDB):
         super(coco, self).__init__('COCO', image_set, root_path, data_path, result_path)
         self.root_path = root_path
         self.data_path = data_path
-        self.coco = COCO(self._get_ann_file())
+        # box annotations as arrays, parsed from the json file once and then loaded from the cache
+        self.anns = COCOAnnotations.fromFile(self._get_ann_file(),
+                                             os.path.join(self.cache_path, self.name + '_annotations'))
+        self._coco = None
 
         # deal with class names
-        cats = [cat['name'] for cat in self.coco.loadCats(self.coco.getCatIds())]
+        cats = [cat['name'] for cat in self.anns.loadCats(self.anns.getCatIds())]
         self.classes = ['__background__'] + cats
         self.num_classes = len(self.classes)
         self._class_to_ind = dict(zip(self.classes, xrange(self.num_classes)))
-        self._class_to_coco_ind = dict(zip(cats, self.coco.getCatIds()))
+        self._class_to_coco_ind = dict(zip(cats, self.anns.getCatIds()))
         self._coco_ind_to_class_ind = dict([(self._class_to_coco_ind[cls], self._class_to_ind[cls])
                                             for cls in self.classes[1:]])
 
@@ -93,6 +135,13 @@ class coco(IMDB):
                     'test-dev2015': 'test2015'}
         self.data_name = view_map[image_set] if image_set in view_map else image_set
 
+    @property
+    def coco(self):
+        """ COCO api of the annotation file, parsed on first use by segmentation code """
+        if self._coco is None:
+            self._coco = COCO(self._get_ann_file())
+        return self._coco
+
     def _get_ann_file(self):
         """ self.data_path / annotations / instances_train2014.json """
         prefix = 'instances' if 'test' not in self.image_set else 'image_info'
@@ -101,7 +150,7 @@ class coco(IMDB):
 
     def _load_image_set_index(self):
         """ image id: int """
-        image_ids = self.coco.getImgIds()
+        image_ids = self.anns.getImgIds()
         return image_ids
 
     def image_path_from_index(self, index):
@@ -137,39 +186,27 @@ class coco(IMDB):
         :param index: coco image id
         :return: roidb entry
         """
-        im_ann = self.coco.loadImgs(index)[0]
-        width = im_ann['width']
-        height = im_ann['height']
+        height, width = self.anns.getImgSize(index)
 
-        annIds = self.coco.getAnnIds(imgIds=index, iscrowd=False)
-        objs = self.coco.loadAnns(annIds)
+        inds = self.anns.getAnnInds(index, iscrowd=0)
+        x, y, w, h = self.anns.bboxes[inds].T
 
         # sanitize bboxes
-        valid_objs = []
-        for obj in objs:
-            x, y, w, h = obj['bbox']
-            x1 = np.max((0, x))
-            y1 = np.max((0, y))
-            x2 = np.min((width - 1, x1 + np.max((0, w - 1))))
-            y2 = np.min((height - 1, y1 + np.max((0, h - 1))))
-            if obj['area'] > 0 and x2 >= x1 and y2 >= y1:
-                obj['clean_bbox'] = [x1, y1, x2, y2]
-                valid_objs.append(obj)
-        objs = valid_objs
-        num_objs = len(objs)
-
-        boxes = np.zeros((num_objs, 4), dtype=np.uint16)
-        gt_classes = np.zeros((num_objs), dtype=np.int32)
+        x1 = np.maximum(0, x)
+        y1 = np.maximum(0, y)
+        x2 = np.minimum(width - 1, x1 + np.maximum(0, w - 1))
+        y2 = np.minimum(height - 1, y1 + np.maximum(0, h - 1))
+        valid = (self.anns.areas[inds] > 0) & (x2 >= x1) & (y2 >= y1)
+        inds = inds[valid]
+        num_objs = len(inds)
+
+        boxes = np.vstack((x1, y1, x2, y2)).transpose()[valid].astype(np.uint16)
+        gt_classes = np.array([self._coco_ind_to_class_ind[cat_id] for cat_id in self.anns.annCatIds[inds].tolist()],
+                              dtype=np.int32)
         overlaps = np.zeros((num_objs, self.num_classes), dtype=np.float32)
-
-        for ix, obj in enumerate(objs):
-            cls = self._coco_ind_to_class_ind[obj['category_id']]
-            boxes[ix, :] = obj['clean_bbox']
-            gt_classes[ix] = cls
-            if obj['iscrowd']:
-                overlaps[ix, :] = -1.0
-            else:
-                overlaps[ix, cls] = 1.0
+        overlaps[np.arange(num_objs), gt_classes] = 1.0
+        # crowd instances
+        overlaps[self.anns.iscrowd[inds] == 1, :] = -1.0
 
         roi_rec = {'image': self.image_path_from_index(index),
                    'height': height,
@@ -256,70 +293,93 @@ class coco(IMDB):
                    'flipped': False}
         return sds_rec, objs
 
-    def evaluate_detections(self, detections, ann_type='bbox', all_masks=None):
-        """ detections_val2014_results.json """
+    def evaluate_detections(self, detections, ann_type='bbox', all_masks=None, write_json=None):
+        """
+        evaluate detections in memory, the detections are saved as COCODetections columns,
+        detections_val2014_results.json is an optional side output
+        :param write_json: write the results json, None to write it only for test sets, which cannot be evaluated
+        """
         res_folder = os.path.join(self.result_path, 'results')
         if not os.path.exists(res_folder):
             os.makedirs(res_folder)
-        res_file = os.path.join(res_folder, 'detections_%s_results.json' % self.image_set)
-        self._write_coco_results(detections, res_file, ann_type, all_masks)
+        coco_dets = self._get_coco_detections(detections, ann_type, all_masks)
+        res_dir = os.path.join(res_folder, 'detections_%s_results_%s' % (self.image_set, ann_type))
+        print 'Saving results columns to %s' % res_dir
+        coco_dets.save(res_dir)
+        if write_json is None:
+            write_json = 'test' in self.image_set
+        if write_json:
+            res_file = os.path.join(res_folder, 'detections_%s_results.json' % self.image_set)
+            print 'Writing results json to %s' % res_file
+            coco_dets.writeJson(res_file)
         if 'test' not in self.image_set:
-            info_str = self._do_python_eval(res_file, res_folder, ann_type)
+            info_str = self._do_python_eval(coco_dets, res_folder, ann_type)
             return info_str
 
     def evaluate_sds(self, all_boxes, all_masks):
         info_str = self.evaluate_detections(all_boxes, 'segm', all_masks)
         return info_str
 
-    def _write_coco_results(self, all_boxes, res_file, ann_type, all_masks):
-        """ example results
-        [{"image_id": 42,
-          "category_id": 18,
-          "bbox": [258.15,41.29,348.26,243.78],
-          "score": 0.236}, ...]
+    def incremental_evaluator(self):
+        """
+        box evaluator matching the detections of every image as soon as they are produced
+        :return: COCOIncrementalEval, None for test sets which cannot be evaluated
+        """
+        if 'test' in self.image_set:
+            return None
+        return COCOIncrementalEval(self.anns, self.image_set_index, self._class_to_coco_ind, self.classes)
+
+    def evaluate_incremental(self, evaluator):
+        """
+        :param evaluator: incremental_evaluator given the detections of every image
+        :return: info_str
+        """
+        evaluator.coco_eval.accumulateIncremental()
+        return self._print_detection_metrics(evaluator.coco_eval)
+
+    def _get_coco_detections(self, all_boxes, ann_type, all_masks):
+        """
+        columns of all detections in results order, by category and then by image
+        masks are encoded by shards of images in parallel
+        :return: COCODetections
         """
-        all_im_info = [{'index': index,
-                        'height': self.coco.loadImgs(index)[0]['height'],
-                        'width': self.coco.loadImgs(index)[0]['width']}
-                        for index in self.image_set_index]
-
-        if ann_type == 'bbox':
-            data_pack = [{'cat_id': self._class_to_coco_ind[cls],
-                          'cls_ind': cls_ind,
-                          'cls': cls,
-                          'ann_type': ann_type,
-                          'binary_thresh': self.binary_thresh,
-                          'all_im_info': all_im_info,
-                          'boxes': all_boxes[cls_ind]}
-                         for cls_ind, cls in enumerate(self.classes) if not cls == '__background__']
-        elif ann_type == 'segm':
-            data_pack = [{'cat_id': self._class_to_coco_ind[cls],
-                          'cls_ind': cls_ind,
-                          'cls': cls,
-                          'ann_type': ann_type,
-                          'binary_thresh': self.binary_thresh,
-                          'all_im_info': all_im_info,
-                          'boxes': all_boxes[cls_ind],
-                          'masks': all_masks[cls_ind]}
-                         for cls_ind, cls in enumerate(self.classes) if not cls == '__background__']
+        all_im_info = []
+        for index in self.image_set_index:
+            height, width = self.anns.getImgSize(index)
+            all_im_info.append({'index': index, 'height': height, 'width': width})
+
+        cls_inds = [cls_ind for cls_ind, cls in enumerate(self.classes) if not cls == '__background__']
+        # mask encoding is the expensive part, a few shards of images per process balance crowded images
+        num_shards = mp.cpu_count() * 4 if ann_type == 'segm' else 1
+        shard_size = max(int(np.ceil(len(all_im_info) / float(num_shards))), 1)
+        shards = [(start, start + shard_size) for start in range(0, len(all_im_info), shard_size)]
+        data_pack = [{'ann_type': ann_type,
+                      'binary_thresh': self.binary_thresh,
+                      'all_im_info': all_im_info[start:end],
+                      'boxes': [all_boxes[cls_ind][start:end] for cls_ind in cls_inds],
+                      'masks': [all_masks[cls_ind][start:end] for cls_ind in cls_inds] if ann_type == 'segm' else None}
+                     for start, end in shards]
+        if ann_type == 'segm' and len(data_pack) > 1:
+            pool = mp.Pool(mp.cpu_count())
+            results = pool.map(coco_results_kernel, data_pack)
+            pool.close()
+            pool.join()
         else:
-            print 'unimplemented ann_type: '+ann_type
-        # results = coco_results_one_category_kernel(data_pack[1])
-        # print results[0]
-        pool = mp.Pool(mp.cpu_count())
-        results = pool.map(coco_results_one_category_kernel, data_pack)
-        pool.close()
-        pool.join()
-        results = sum(results, [])
-        print 'Writing results json to %s' % res_file
-        with open(res_file, 'w') as f:
-            json.dump(results, f, sort_keys=True, indent=4)
-
-    def _do_python_eval(self, res_file, res_folder, ann_type):
-        coco_dt = self.coco.loadRes(res_file)
-        coco_eval = COCOeval(self.coco, coco_dt)
+            results = [coco_results_kernel(pack) for pack in data_pack]
+        # by category, then by image as the shards
+        results = [[res[k] for res in results] for k in range(len(cls_inds))]
+        cat_ids = np.hstack([np.full((len(res[0]),), self._class_to_coco_ind[self.classes[cls_ind]], dtype=np.int64)
+                             for cls_ind, cls_results in zip(cls_inds, results) for res in cls_results])
+        results = [res for cls_results in results for res in cls_results]
+        segms = [segm for res in results for segm in res[3]] if ann_type == 'segm' else None
+        return COCODetections(np.hstack([res[0] for res in results]), cat_ids,
+                              np.vstack([res[1] for res in results]), np.hstack([res[2] for res in results]), segms)
+
+    def _do_python_eval(self, coco_dets, res_folder, ann_type):
+        # box evaluation only needs the annotation arrays
+        coco_eval = COCOeval(self.coco if ann_type == 'segm' else self.anns, coco_dets)
         coco_eval.params.useSegm = (ann_type == 'segm')
-        coco_eval.evaluate()
+        coco_eval.evaluate(num_workers=mp.cpu_count())
         coco_eval.accumulate()
         info_str = self._print_detection_metrics(coco_eval)
 
@@ -13,9 +13,39 @@ import os
 import cPickle
 import numpy as np
 from PIL import Image
-from bbox.bbox_transform import bbox_overlaps
+from bbox.bbox_transform import bbox_overlaps, max_overlaps, greedy_query_overlaps
+from proposal_store import ProposalStore, proposal_store_exists
 from multiprocessing import Pool, cpu_count
 
+def evaluate_recall_kernel(data_pack):
+    """
+    gt overlaps of a shard of images, see IMDB.evaluate_recall
+    :param data_pack: dict with 'images' [(gt boxes, proposal boxes)], 'area_ranges' and 'proposal_counts'
+    :return: number of proposals and of gts in each area range,
+             overlap of every gt with its assigned proposal [area range][proposal count]
+    """
+    area_ranges = data_pack['area_ranges']
+    counts = data_pack['proposal_counts']
+    area_counts = np.zeros((len(area_ranges),), dtype=np.int64)
+    num_pos = np.zeros((len(area_ranges),), dtype=np.int64)
+    gt_overlaps = [[[np.zeros(0)] for _ in counts] for _ in area_ranges]
+    for gt_boxes, boxes in data_pack['images']:
+        boxes_areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+        gt_areas = (gt_boxes[:, 2] - gt_boxes[:, 0] + 1) * (gt_boxes[:, 3] - gt_boxes[:, 1] + 1)
+        overlaps = bbox_overlaps(boxes.astype(np.float), gt_boxes.astype(np.float))
+        for a, area_range in enumerate(area_ranges):
+            area_counts[a] += np.count_nonzero((boxes_areas >= area_range[0]) & (boxes_areas < area_range[1]))
+            valid_gt_inds = np.where((gt_areas >= area_range[0]) & (gt_areas < area_range[1]))[0]
+            num_pos[a] += len(valid_gt_inds)
+            if boxes.shape[0] == 0:
+                continue
+            for c, count in enumerate(counts):
+                # find which proposal covers each gt box, best covered gt boxes first
+                gt_overlaps[a][c].append(greedy_query_overlaps(overlaps[:count, valid_gt_inds]))
+    gt_overlaps = [[np.hstack(x) for x in area_overlaps] for area_overlaps in gt_overlaps]
+    return area_counts, num_pos, gt_overlaps
+
+
 def get_flipped_entry_outclass_wrapper(IMDB_instance, seg_rec):
     return IMDB_instance.get_flipped_entry(seg_rec)
 
@@ -53,6 +83,24 @@ class IMDB(object):
     def evaluate_segmentations(self, segmentations):
         raise NotImplementedError
 
+    def incremental_evaluator(self):
+        """
+        evaluator given the detections of every image while testing, with add(im_ind, cls_dets) and mean_ap()
+        :return: evaluator for evaluate_incremental, None if the dataset is evaluated from all detections
+        """
+        return None
+
+    def evaluate_incremental(self, evaluator):
+        raise NotImplementedError
+
+    def segmentation_evaluator(self, write_results=True):
+        """
+        confusion matrix evaluator given the pred segmentation of every image while testing, see SegmentationIncrementalEval
+        :param write_results: also write the pred segmentations as pngs from a background thread
+        :return: evaluator, None if the dataset is evaluated from all pred segmentations
+        """
+        return None
+
     @property
     def cache_path(self):
         """
@@ -80,12 +128,22 @@ class IMDB(object):
         return self.image_path_from_index(self.image_set_index[index])
 
     def load_rpn_data(self, full=False):
+        """
+        load the proposals written by generate_proposals
+        :param full: proposals before the score threshold
+        :return: [image_index] ndarray of [box_index][x1, y1, x2, y2, score], memory mapped unless an old pickle
+        """
         if full:
-            rpn_file = os.path.join(self.result_path, 'rpn_data', self.name + '_full_rpn.pkl')
+            rpn_prefix = os.path.join(self.result_path, 'rpn_data', self.name + '_full_rpn')
         else:
-            rpn_file = os.path.join(self.result_path, 'rpn_data', self.name + '_rpn.pkl')
+            rpn_prefix = os.path.join(self.result_path, 'rpn_data', self.name + '_rpn')
+        if proposal_store_exists(rpn_prefix):
+            print 'loading {}'.format(rpn_prefix + '.bin')
+            return ProposalStore(rpn_prefix)
+        # proposals pickled before the binary store
+        rpn_file = rpn_prefix + '.pkl'
         print 'loading {}'.format(rpn_file)
-        assert os.path.exists(rpn_file), 'rpn data not found at {}'.format(rpn_file)
+        assert os.path.exists(rpn_file), 'rpn data not found at {}'.format(rpn_prefix + '.bin')
         with open(rpn_file, 'rb') as f:
             box_list = cPickle.load(f)
         return box_list
@@ -117,7 +175,9 @@ class IMDB(object):
     def create_roidb_from_box_list(self, box_list, gt_roidb):
         """
         given ground truth, prepare roidb
-        :param box_list: [image_index] ndarray of [box_index][x1, x2, y1, y2]
+        the proposals of every image are read, 'boxes' is a view of box_list until the roidb is merged or
+        flipped, the overlaps are computed in memory
+        :param box_list: [image_index] ndarray of [box_index][x1, x2, y1, y2], e.g. a ProposalStore
         :param gt_roidb: [image_index]['boxes', 'gt_classes', 'gt_overlaps', 'flipped']
         :return: roidb: [image_index]['boxes', 'gt_classes', 'gt_overlaps', 'flipped']
         """
@@ -134,21 +194,22 @@ class IMDB(object):
                 boxes = boxes[:, :4]
             num_boxes = boxes.shape[0]
             overlaps = np.zeros((num_boxes, self.num_classes), dtype=np.float32)
+            max_classes = np.zeros((num_boxes,), dtype=np.int)
             if gt_roidb is not None and gt_roidb[i]['boxes'].size > 0:
                 gt_boxes = gt_roidb[i]['boxes']
                 gt_classes = gt_roidb[i]['gt_classes']
-                # n boxes and k gt_boxes => n * k overlap
-                gt_overlaps = bbox_overlaps(boxes.astype(np.float), gt_boxes.astype(np.float))
                 # for each box in n boxes, select only maximum overlap (must be greater than zero)
-                argmaxes = gt_overlaps.argmax(axis=1)
-                maxes = gt_overlaps.max(axis=1)
+                # without the n * k overlap matrix
+                argmaxes, maxes = max_overlaps(boxes, gt_boxes)
                 I = np.where(maxes > 0)[0]
                 overlaps[I, gt_classes[argmaxes[I]]] = maxes[I]
+                # a row has a single nonzero, so this is the argmax of overlaps
+                max_classes[I] = gt_classes[argmaxes[I]]
 
             roi_rec.update({'boxes': boxes,
                             'gt_classes': np.zeros((num_boxes,), dtype=np.int32),
                             'gt_overlaps': overlaps,
-                            'max_classes': overlaps.argmax(axis=1),
+                            'max_classes': max_classes,
                             'max_overlaps': overlaps.max(axis=1),
                             'flipped': False})
 
@@ -246,13 +307,15 @@ class IMDB(object):
             flipped_image.save(saved_image_path, 'png')
         return saved_image_path
 
-    def evaluate_recall(self, roidb, candidate_boxes=None, thresholds=None):
+    def evaluate_recall(self, roidb, candidate_boxes=None, thresholds=None, proposal_counts=(100, 300, 1000)):
         """
         evaluate detection proposal recall metrics
         record max overlap value for each gt box; return vector of overlap values
+        gt boxes are assigned to proposals in a compiled kernel, images are evaluated in parallel
         :param roidb: used to evaluate
         :param candidate_boxes: if not given, use roidb's non-gt boxes
         :param thresholds: array-like recall threshold
+        :param proposal_counts: also report the average recall of the top proposals of each image, by count
         :return: None
         ar: average recall, recalls: vector recalls at each IoU overlap threshold
         thresholds: vector of IoU overlap threshold, gt_overlaps: vector of all ground-truth overlaps
@@ -262,95 +325,72 @@ class IMDB(object):
                       '100-200', '200-300', '300-inf']
         area_ranges = [[0**2, 1e5**2], [0**2, 25**2], [25**2, 50**2], [50**2, 100**2],
                        [100**2, 200**2], [200**2, 300**2], [300**2, 1e5**2]]
-        area_counts = []
-        for area_name, area_range in zip(area_names[1:], area_ranges[1:]):
-            area_count = 0
-            for i in range(self.num_images):
-                if candidate_boxes is None:
-                    # default is use the non-gt boxes from roidb
-                    non_gt_inds = np.where(roidb[i]['gt_classes'] == 0)[0]
-                    boxes = roidb[i]['boxes'][non_gt_inds, :]
-                else:
-                    boxes = candidate_boxes[i]
-                boxes_areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
-                valid_range_inds = np.where((boxes_areas >= area_range[0]) & (boxes_areas < area_range[1]))[0]
-                area_count += len(valid_range_inds)
-            area_counts.append(area_count)
-        total_counts = float(sum(area_counts))
-        for area_name, area_count in zip(area_names[1:], area_counts):
+        images = []
+        for i in range(self.num_images):
+            # check for max_overlaps == 1 avoids including crowd annotations
+            max_gt_overlaps = roidb[i]['gt_overlaps'].max(axis=1)
+            gt_inds = np.where((roidb[i]['gt_classes'] > 0) & (max_gt_overlaps == 1))[0]
+            if candidate_boxes is None:
+                # default is use the non-gt boxes from roidb
+                non_gt_inds = np.where(roidb[i]['gt_classes'] == 0)[0]
+                boxes = roidb[i]['boxes'][non_gt_inds, :]
+            else:
+                boxes = candidate_boxes[i]
+            images.append((roidb[i]['boxes'][gt_inds, :], boxes))
+        # None evaluates all proposals
+        counts = [None] + list(proposal_counts)
+        # a few shards per process to balance images
+        shard_size = max(int(np.ceil(len(images) / float(cpu_count() * 4))), 1)
+        data_pack = [{'images': images[start:start + shard_size],
+                      'area_ranges': area_ranges,
+                      'proposal_counts': counts}
+                     for start in range(0, len(images), shard_size)]
+        pool = Pool(cpu_count())
+        results = pool.map(evaluate_recall_kernel, data_pack)
+        pool.close()
+        pool.join()
+        area_counts = np.sum([res[0] for res in results], axis=0)
+        num_pos = np.sum([res[1] for res in results], axis=0)
+        all_gt_overlaps = [[np.hstack([res[2][a][c] for res in results])
+                            for c in range(len(counts))] for a in range(len(area_ranges))]
+
+        total_counts = float(sum(area_counts[1:]))
+        for area_name, area_count in zip(area_names[1:], area_counts[1:]):
             log_info = 'percentage of {} {}'.format(area_name, area_count / total_counts)
             print log_info
             all_log_info += log_info
         log_info = 'average number of proposal {}'.format(total_counts / self.num_images)
         print log_info
         all_log_info += log_info
-        for area_name, area_range in zip(area_names, area_ranges):
-            gt_overlaps = np.zeros(0)
-            num_pos = 0
-            for i in range(self.num_images):
-                # check for max_overlaps == 1 avoids including crowd annotations
-                max_gt_overlaps = roidb[i]['gt_overlaps'].max(axis=1)
-                gt_inds = np.where((roidb[i]['gt_classes'] > 0) & (max_gt_overlaps == 1))[0]
-                gt_boxes = roidb[i]['boxes'][gt_inds, :]
-                gt_areas = (gt_boxes[:, 2] - gt_boxes[:, 0] + 1) * (gt_boxes[:, 3] - gt_boxes[:, 1] + 1)
-                valid_gt_inds = np.where((gt_areas >= area_range[0]) & (gt_areas < area_range[1]))[0]
-                gt_boxes = gt_boxes[valid_gt_inds, :]
-                num_pos += len(valid_gt_inds)
-
-                if candidate_boxes is None:
-                    # default is use the non-gt boxes from roidb
-                    non_gt_inds = np.where(roidb[i]['gt_classes'] == 0)[0]
-                    boxes = roidb[i]['boxes'][non_gt_inds, :]
-                else:
-                    boxes = candidate_boxes[i]
-                if boxes.shape[0] == 0:
-                    continue
-
-                overlaps = bbox_overlaps(boxes.astype(np.float), gt_boxes.astype(np.float))
-
-                _gt_overlaps = np.zeros((gt_boxes.shape[0]))
-                # choose whatever is smaller to iterate
-                rounds = min(boxes.shape[0], gt_boxes.shape[0])
-                for j in range(rounds):
-                    # find which proposal maximally covers each gt box
-                    argmax_overlaps = overlaps.argmax(axis=0)
-                    # get the IoU amount of coverage for each gt box
-                    max_overlaps = overlaps.max(axis=0)
-                    # find which gt box is covered by most IoU
-                    gt_ind = max_overlaps.argmax()
-                    gt_ovr = max_overlaps.max()
-                    assert (gt_ovr >= 0), '%s\n%s\n%s' % (boxes, gt_boxes, overlaps)
-                    # find the proposal box that covers the best covered gt box
-                    box_ind = argmax_overlaps[gt_ind]
-                    # record the IoU coverage of this gt box
-                    _gt_overlaps[j] = overlaps[box_ind, gt_ind]
-                    assert (_gt_overlaps[j] == gt_ovr)
-                    # mark the proposal box and the gt box as used
-                    overlaps[box_ind, :] = -1
-                    overlaps[:, gt_ind] = -1
-                # append recorded IoU coverage level
-                gt_overlaps = np.hstack((gt_overlaps, _gt_overlaps))
-
-            gt_overlaps = np.sort(gt_overlaps)
-            if thresholds is None:
-                step = 0.05
-                thresholds = np.arange(0.5, 0.95 + 1e-5, step)
-            recalls = np.zeros_like(thresholds)
-
-            # compute recall for each IoU threshold
-            for i, t in enumerate(thresholds):
-                recalls[i] = (gt_overlaps >= t).sum() / float(num_pos)
-            ar = recalls.mean()
+        if thresholds is None:
+            step = 0.05
+            thresholds = np.arange(0.5, 0.95 + 1e-5, step)
+        # recall for each IoU threshold, [area, count, threshold]
+        recalls = np.zeros((len(area_ranges), len(counts), len(thresholds)))
+        for a in range(len(area_ranges)):
+            for c in range(len(counts)):
+                gt_overlaps = all_gt_overlaps[a][c]
+                for i, t in enumerate(thresholds):
+                    recalls[a, c, i] = (gt_overlaps >= t).sum() / float(num_pos[a])
+        for a, area_name in enumerate(area_names):
+            ar = recalls[a, 0].mean()
 
             # print results
             log_info = 'average recall for {}: {:.3f}'.format(area_name, ar)
             print log_info
             all_log_info += log_info
-            for threshold, recall in zip(thresholds, recalls):
+            for threshold, recall in zip(thresholds, recalls[a, 0]):
                 log_info = 'recall @{:.2f}: {:.3f}'.format(threshold, recall)
                 print log_info
                 all_log_info += log_info
 
+        # summary of the top proposals
+        for c, count in enumerate(counts[1:], 1):
+            log_info = 'AR@{}: '.format(count) + \
+                       ' '.join('{} {:.3f}'.format(area_name, recalls[a, c].mean()) for a, area_name in enumerate(area_names))
+            print log_info
+            all_log_info += log_info
+
         return all_log_info
 
     @staticmethod
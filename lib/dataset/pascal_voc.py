@@ -18,9 +18,12 @@ import cv2
 import os
 import numpy as np
 import PIL
+import multiprocessing as mp
 
 from imdb import IMDB
-from pascal_voc_eval import voc_eval, voc_eval_sds
+from pascal_voc_eval import voc_eval_sds, load_voc_gt, voc_eval_boxes_kernel, VOCIncrementalEval
+from segmentation_eval import get_confusion_matrix, evaluate_confusion_matrix, confusion_matrix_iu, \
+    SegmentationIncrementalEval
 from ds_utils import unique_boxes, filter_small_boxes
 
 class PascalVOC(IMDB):
@@ -53,6 +56,8 @@ class PascalVOC(IMDB):
         print 'num_images', self.num_images
         self.mask_size = mask_size
         self.binary_thresh = binary_thresh
+        # overlap thresholds of the box evaluation
+        self.eval_ovthreshs = [0.5, 0.7]
 
         self.config = {'comp_id': 'comp4',
                        'use_diff': False,
@@ -243,38 +248,41 @@ class PascalVOC(IMDB):
 
         return seg_rec
 
-    def evaluate_detections(self, detections):
+    def evaluate_detections(self, detections, write_results=False):
         """
         top level evaluations
         :param detections: result matrix, [bbox, confidence]
+        :param write_results: also write the VOCdevkit results files
         :return: None
         """
-        # make all these folders for results
-        result_dir = os.path.join(self.result_path, 'results')
-        if not os.path.exists(result_dir):
-            os.mkdir(result_dir)
-        year_folder = os.path.join(self.result_path, 'results', 'VOC' + self.year)
-        if not os.path.exists(year_folder):
-            os.mkdir(year_folder)
-        res_file_folder = os.path.join(self.result_path, 'results', 'VOC' + self.year, 'Main')
-        if not os.path.exists(res_file_folder):
-            os.mkdir(res_file_folder)
-
-        self.write_pascal_results(detections)
-        info = self.do_python_eval()
+        if write_results:
+            # make all these folders for results
+            result_dir = os.path.join(self.result_path, 'results')
+            if not os.path.exists(result_dir):
+                os.mkdir(result_dir)
+            year_folder = os.path.join(self.result_path, 'results', 'VOC' + self.year)
+            if not os.path.exists(year_folder):
+                os.mkdir(year_folder)
+            res_file_folder = os.path.join(self.result_path, 'results', 'VOC' + self.year, 'Main')
+            if not os.path.exists(res_file_folder):
+                os.mkdir(res_file_folder)
+
+            self.write_pascal_results(detections)
+        info = self.do_python_eval(detections)
         return info
 
-    def evaluate_segmentations(self, pred_segmentations=None):
+    def evaluate_segmentations(self, pred_segmentations=None, write_results=True):
         """
         top level evaluations
-        :param pred_segmentations: the pred segmentation result
+        :param pred_segmentations: the pred segmentation result, None to evaluate the written pngs
+        :param write_results: write the pred segmentation result as pngs, they are scored from memory
         :return: the evaluation results
         """
         # make all these folders for results
-        if not (pred_segmentations is None):
+        if not (pred_segmentations is None) and write_results:
             self.write_pascal_segmentation_result(pred_segmentations)
 
-        info = self._py_evaluate_segmentation()
+        info = self._py_evaluate_segmentation(pred_segmentations)
         return info
 
     def write_pascal_segmentation_result(self, pred_segmentations):
@@ -336,49 +344,33 @@ class PascalVOC(IMDB):
         :param class_num: the nunber of class
         :return: the confusion matrix
         """
-        index = (gt_label * class_num + pred_label).astype('int32')
-        label_count = np.bincount(index)
-        confusion_matrix = np.zeros((class_num, class_num))
-
-        for i_label in range(class_num):
-            for i_pred_label in range(class_num):
-                cur_index = i_label * class_num + i_pred_label
-                if cur_index < len(label_count):
-                    confusion_matrix[i_label, i_pred_label] = label_count[cur_index]
+        return get_confusion_matrix(gt_label, pred_label, class_num)
 
-        return confusion_matrix
-
-    def _py_evaluate_segmentation(self):
+    def _py_evaluate_segmentation(self, pred_segmentations=None):
         """
         This function is a wrapper to calculte the metrics for given pred_segmentation results
-        :param pred_segmentations: the pred segmentation result
+        :param pred_segmentations: the pred segmentation result, None to read the written pngs
         :return: the evaluation metrics
         """
-        confusion_matrix = np.zeros((self.num_classes,self.num_classes))
         result_dir = os.path.join(self.result_path, 'results', 'VOC' + self.year, 'Segmentation')
+        gt_paths = [self.segmentation_path_from_index(index) for index in self.image_set_index]
+        if pred_segmentations is None:
+            pred_segmentations = [os.path.join(result_dir, '%s.png'%(index)) for index in self.image_set_index]
+        # the gt is resized to the pred
+        confusion_matrix = evaluate_confusion_matrix(gt_paths, pred_segmentations, self.num_classes, False)
+        return confusion_matrix_iu(confusion_matrix)
 
-        for i, index in enumerate(self.image_set_index):
-            seg_gt_info = self.load_pascal_segmentation_annotation(index)
-            seg_gt_path = seg_gt_info['seg_cls_path']
-            seg_gt = np.array(PIL.Image.open(seg_gt_path)).astype('float32')
-            seg_pred_path = os.path.join(result_dir, '%s.png'%(index))
-            seg_pred = np.array(PIL.Image.open(seg_pred_path)).astype('float32')
-
-            seg_gt = cv2.resize(seg_gt, (seg_pred.shape[1], seg_pred.shape[0]), interpolation=cv2.INTER_NEAREST)
-            ignore_index = seg_gt != 255
-            seg_gt = seg_gt[ignore_index]
-            seg_pred = seg_pred[ignore_index]
-
-            confusion_matrix += self.get_confusion_matrix(seg_gt, seg_pred, self.num_classes)
-
-        pos = confusion_matrix.sum(1)
-        res = confusion_matrix.sum(0)
-        tp = np.diag(confusion_matrix)
-
-        IU_array = (tp / np.maximum(1.0, pos + res - tp))
-        mean_IU = IU_array.mean()
-
-        return {'meanIU':mean_IU, 'IU_array':IU_array}
+    def segmentation_evaluator(self, write_results=True):
+        """
+        evaluator updating the confusion matrix image by image, see SegmentationIncrementalEval
+        :param write_results: also write the pred segmentations as pngs from a background thread
+        :return: SegmentationIncrementalEval
+        """
+        result_dir = os.path.join(self.result_path, 'results', 'VOC' + self.year, 'Segmentation')
+        gt_paths = [self.segmentation_path_from_index(index) for index in self.image_set_index]
+        result_paths = [os.path.join(result_dir, '%s.png'%(index)) for index in self.image_set_index] \
+            if write_results else None
+        return SegmentationIncrementalEval(gt_paths, self.num_classes, False, result_paths, self.get_pallete(256))
 
     def get_result_file_template(self):
         """
@@ -414,43 +406,71 @@ class PascalVOC(IMDB):
                                 format(index, dets[k, -1],
                                        dets[k, 0] + 1, dets[k, 1] + 1, dets[k, 2] + 1, dets[k, 3] + 1))
 
-    def do_python_eval(self):
+    def do_python_eval(self, all_boxes):
         """
-        python evaluation wrapper
+        python evaluation wrapper, classes are evaluated in parallel from the in-memory detections
+        :param all_boxes: boxes to be processed [bbox, confidence]
         :return: info_str
         """
-        info_str = ''
+        gt, use_07_metric = self._load_eval_gt()
+        data_pack = [{'dets': all_boxes[cls_ind],
+                      'gt': gt[cls],
+                      'ovthreshs': self.eval_ovthreshs,
+                      'use_07_metric': use_07_metric}
+                     for cls_ind, cls in enumerate(self.classes) if cls != '__background__']
+        pool = mp.Pool(mp.cpu_count())
+        results = pool.map(voc_eval_boxes_kernel, data_pack)
+        pool.close()
+        pool.join()
+        return self._format_aps(results, use_07_metric)
+
+    def incremental_evaluator(self):
+        """
+        evaluator matching the detections of every image as soon as they are produced
+        :return: VOCIncrementalEval, call add(im_ind, cls_dets) for every image
+        """
+        gt, use_07_metric = self._load_eval_gt()
+        classes = [cls for cls in self.classes if cls != '__background__']
+        return VOCIncrementalEval(gt, classes, self.eval_ovthreshs, use_07_metric)
+
+    def evaluate_incremental(self, evaluator):
+        """
+        :param evaluator: incremental_evaluator given the detections of every image
+        :return: info_str, same as evaluate_detections
+        """
+        return self._format_aps(evaluator.evaluate(), evaluator.use_07_metric)
+
+    def _load_eval_gt(self):
+        """
+        :return: gt arrays of every class, see load_voc_gt, and whether to use voc07's metric
+        """
         annopath = os.path.join(self.data_path, 'Annotations', '{0!s}.xml')
         imageset_file = os.path.join(self.data_path, 'ImageSets', 'Main', self.image_set + '.txt')
         annocache = os.path.join(self.cache_path, self.name + '_annotations.pkl')
-        aps = []
         # The PASCAL VOC metric changed in 2010
         use_07_metric = True if self.year == 'SDS' or int(self.year) < 2010 else False
+        classes = [cls for cls in self.classes if cls != '__background__']
+        return load_voc_gt(annopath, imageset_file, annocache, classes), use_07_metric
+
+    def _format_aps(self, results, use_07_metric):
+        """
+        :param results: for every class a list of (rec, prec, ap) for each overlap threshold
+        :return: info_str
+        """
+        info_str = ''
         print 'VOC07 metric? ' + ('Y' if use_07_metric else 'No')
         info_str += 'VOC07 metric? ' + ('Y' if use_07_metric else 'No')
         info_str += '\n'
-        for cls_ind, cls in enumerate(self.classes):
-            if cls == '__background__':
-                continue
-            filename = self.get_result_file_template().format(cls)
-            rec, prec, ap = voc_eval(filename, annopath, imageset_file, cls, annocache,
-                                     ovthresh=0.5, use_07_metric=use_07_metric)
-            aps += [ap]
-            print('AP for {} = {:.4f}'.format(cls, ap))
-            info_str += 'AP for {} = {:.4f}\n'.format(cls, ap)
-        print('Mean AP@0.5 = {:.4f}'.format(np.mean(aps)))
-        info_str += 'Mean AP@0.5 = {:.4f}\n\n'.format(np.mean(aps))
-        # @0.7
-        aps = []
-        for cls_ind, cls in enumerate(self.classes):
-            if cls == '__background__':
-                continue
-            filename = self.get_result_file_template().format(cls)
-            rec, prec, ap = voc_eval(filename, annopath, imageset_file, cls, annocache,
-                                     ovthresh=0.7, use_07_metric=use_07_metric)
-            aps += [ap]
-            print('AP for {} = {:.4f}'.format(cls, ap))
-            info_str += 'AP for {} = {:.4f}\n'.format(cls, ap)
-        print('Mean AP@0.7 = {:.4f}'.format(np.mean(aps)))
-        info_str += 'Mean AP@0.7 = {:.4f}'.format(np.mean(aps))
+        classes = [cls for cls in self.classes if cls != '__background__']
+        for t, ovthresh in enumerate(self.eval_ovthreshs):
+            aps = []
+            for cls, cls_results in zip(classes, results):
+                rec, prec, ap = cls_results[t]
+                aps += [ap]
+                print('AP for {} = {:.4f}'.format(cls, ap))
+                info_str += 'AP for {} = {:.4f}\n'.format(cls, ap)
+            print('Mean AP@{} = {:.4f}'.format(ovthresh, np.mean(aps)))
+            info_str += 'Mean AP@{} = {:.4f}'.format(ovthresh, np.mean(aps))
+            if t < len(self.eval_ovthreshs) - 1:
+                info_str += '\n\n'
         return info_str
@@ -59,8 +59,7 @@ def voc_ap(rec, prec, use_07_metric=False):
         mpre = np.concatenate(([0.], prec, [0.]))
 
         # compute precision integration ladder
-        for i in range(mpre.size - 1, 0, -1):
-            mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+        mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
         # look for recall value changes
         i = np.where(mrec[1:] != mrec[:-1])[0]
@@ -70,17 +69,13 @@ def voc_ap(rec, prec, use_07_metric=False):
     return ap
 
 
-def voc_eval(detpath, annopath, imageset_file, classname, annocache, ovthresh=0.5, use_07_metric=False):
+def load_voc_recs(annopath, imageset_file, annocache):
     """
-    pascal voc evaluation
-    :param detpath: detection results detpath.format(classname)
-    :param annopath: annotations annopath.format(classname)
+    parse the annotations of an image set, cached
+    :param annopath: annotations annopath.format(image_filename)
     :param imageset_file: text file containing list of images
-    :param classname: category name
     :param annocache: caching annotations
-    :param ovthresh: overlap threshold
-    :param use_07_metric: whether to use voc07's 11 point ap computation
-    :return: rec, prec, ap
+    :return: image filenames, dict of image filename to list of objects
     """
     with open(imageset_file, 'r') as f:
         lines = f.readlines()
@@ -99,6 +94,239 @@ def voc_eval(detpath, annopath, imageset_file, classname, annocache, ovthresh=0.
     else:
         with open(annocache, 'rb') as f:
             recs = cPickle.load(f)
+    return image_filenames, recs
+
+
+def load_voc_gt(annopath, imageset_file, annocache, classnames):
+    """
+    ground truth of every class as arrays grouped by image in image set order
+    :param classnames: category names
+    :return: dict of class name to {'boxes': [G, 4] float, 'difficult': [G] bool, 'offsets': [num_images + 1]},
+             the gts of the i-th image are offsets[i]:offsets[i + 1]
+    """
+    image_filenames, recs = load_voc_recs(annopath, imageset_file, annocache)
+    gt = {}
+    for classname in classnames:
+        objects = [[obj for obj in recs[image_filename] if obj['name'] == classname]
+                   for image_filename in image_filenames]
+        counts = [len(x) for x in objects]
+        objects = [obj for x in objects for obj in x]
+        gt[classname] = {'boxes': np.array([x['bbox'] for x in objects], dtype=np.float).reshape((-1, 4)),
+                         'difficult': np.array([x['difficult'] for x in objects], dtype=np.bool),
+                         'offsets': np.hstack(([0], np.cumsum(counts))).astype(np.int64)}
+    return gt
+
+
+def voc_overlaps_max(boxes, im_inds, gt_boxes, gt_offsets):
+    """
+    best overlapping gt of every detection among the gts of its image, overlaps and ties as in voc_eval
+    :param boxes: [N, 4] detection boxes in the 1-based coordinates of the annotations
+    :param im_inds: [N] image of each detection
+    :param gt_boxes: [G, 4] gt boxes grouped by image
+    :param gt_offsets: [num_images + 1] the gts of the i-th image are gt_offsets[i]:gt_offsets[i + 1]
+    :return: ovmax [N], -inf for images without gt, jmax [N] gt index, -1 for images without gt
+    """
+    num_dets = boxes.shape[0]
+    # (detection, gt) pairs of the per image overlap matrices, by detection and then by gt
+    counts = (gt_offsets[1:] - gt_offsets[:-1])[im_inds]
+    pair_det = np.repeat(np.arange(num_dets), counts)
+    pair_gt = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - gt_offsets[im_inds], counts)
+    bb = boxes[pair_det, :]
+    bbgt = gt_boxes[pair_gt, :]
+
+    # intersection
+    ixmin = np.maximum(bbgt[:, 0], bb[:, 0])
+    iymin = np.maximum(bbgt[:, 1], bb[:, 1])
+    ixmax = np.minimum(bbgt[:, 2], bb[:, 2])
+    iymax = np.minimum(bbgt[:, 3], bb[:, 3])
+    iw = np.maximum(ixmax - ixmin + 1., 0.)
+    ih = np.maximum(iymax - iymin + 1., 0.)
+    inters = iw * ih
+
+    # union
+    uni = ((bb[:, 2] - bb[:, 0] + 1.) * (bb[:, 3] - bb[:, 1] + 1.) +
+           (bbgt[:, 2] - bbgt[:, 0] + 1.) *
+           (bbgt[:, 3] - bbgt[:, 1] + 1.) - inters)
+    overlaps = inters / uni
+
+    ovmax = np.full((num_dets,), -np.inf)
+    np.maximum.at(ovmax, pair_det, overlaps)
+    # first gt reaching the max, as np.argmax
+    best = np.flatnonzero(overlaps == ovmax[pair_det])
+    _, first = np.unique(pair_det[best], return_index=True)
+    jmax = -np.ones((num_dets,), dtype=np.int64)
+    jmax[pair_det[best[first]]] = pair_gt[best[first]]
+    return ovmax, jmax
+
+
+def voc_tp_fp(ovmax, jmax, gt_difficult, ovthresh):
+    """
+    true and false positives of detections sorted by descending score, as voc_eval
+    :param ovmax: [N] best overlap of each detection, see voc_overlaps_max
+    :param jmax: [N] index of the best gt
+    :param gt_difficult: [G] difficult flag of each gt, difficult matches count neither as tp nor as fp
+    :param ovthresh: overlap threshold
+    :return: tp [N], fp [N]
+    """
+    hit = ovmax > ovthresh
+    difficult = np.zeros(hit.shape, dtype=np.bool)
+    difficult[hit] = gt_difficult[jmax[hit]]
+    matched = np.flatnonzero(hit & ~difficult)
+    # only the first detection of a gt is a true positive, the others are duplicates
+    _, first = np.unique(jmax[matched], return_index=True)
+    tp = np.zeros(hit.shape)
+    fp = np.zeros(hit.shape)
+    fp[~hit] = 1.
+    fp[matched] = 1.
+    fp[matched[first]] = 0.
+    tp[matched[first]] = 1.
+    return tp, fp
+
+
+def voc_eval_boxes(cls_dets, cls_gt, ovthreshs=(0.5,), use_07_metric=False):
+    """
+    pascal voc evaluation of one class from in-memory detections, equal to voc_eval without the results file
+    :param cls_dets: [[x1, y1, x2, y2, score]] of every image in image set order, as all_boxes[cls_ind]
+    :param cls_gt: gt arrays of the class, see load_voc_gt
+    :param ovthreshs: overlap thresholds, detections are matched once for all of them
+    :param use_07_metric: whether to use voc07's 11 point ap computation
+    :return: list of (rec, prec, ap) for each overlap threshold
+    """
+    counts = [len(dets) for dets in cls_dets]
+    im_inds = np.repeat(np.arange(len(cls_dets)), counts)
+    dets = [dets[:, :5] for dets in cls_dets if len(dets) > 0]
+    dets = np.vstack(dets).astype(np.float) if len(dets) > 0 else np.zeros((0, 5))
+
+    # sort by confidence
+    sorted_inds = np.argsort(-dets[:, 4], kind='mergesort')
+    dets = dets[sorted_inds, :]
+    im_inds = im_inds[sorted_inds]
+
+    # the annotations use the 1-based pixel indexes of the VOCdevkit
+    ovmax, jmax = voc_overlaps_max(dets[:, :4] + 1, im_inds, cls_gt['boxes'], cls_gt['offsets'])
+    npos = np.count_nonzero(~cls_gt['difficult'])
+
+    results = []
+    for ovthresh in ovthreshs:
+        tp, fp = voc_tp_fp(ovmax, jmax, cls_gt['difficult'], ovthresh)
+        # compute precision recall
+        fp = np.cumsum(fp)
+        tp = np.cumsum(tp)
+        rec = tp / float(npos)
+        # avoid division by zero in case first detection matches a difficult ground ruth
+        prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+        results.append((rec, prec, voc_ap(rec, prec, use_07_metric)))
+    return results
+
+
+def voc_eval_boxes_kernel(data_pack):
+    return voc_eval_boxes(data_pack['dets'], data_pack['gt'], data_pack['ovthreshs'], data_pack['use_07_metric'])
+
+
+class VOCIncrementalEval(object):
+    """
+    pascal voc box evaluation fed image by image while the detections are produced,
+    per class only the scores and the tp / fp flags of every overlap threshold are kept
+    """
+    def __init__(self, gt, classnames, ovthreshs=(0.5,), use_07_metric=False):
+        """
+        :param gt: gt arrays of every class, see load_voc_gt
+        :param classnames: category names, the i-th one is class i + 1 of the detections
+        :param ovthreshs: overlap thresholds
+        :param use_07_metric: whether to use voc07's 11 point ap computation
+        """
+        self.gt = gt
+        self.classnames = classnames
+        self.ovthreshs = ovthreshs
+        self.use_07_metric = use_07_metric
+        # per class: chunks of (scores, image index, tp [T, N], fp [T, N])
+        self.chunks = [[] for _ in classnames]
+        # non difficult gts of the images added so far
+        self.npos = np.zeros((len(classnames),), dtype=np.int64)
+        self.num_images = 0
+
+    def add(self, im_ind, cls_dets):
+        """
+        match the detections of one image
+        :param im_ind: index of the image in the image set
+        :param cls_dets: [[x1, y1, x2, y2, score]] of every class with background at 0, as all_boxes[:][im_ind]
+        :return: None
+        """
+        for i, classname in enumerate(self.classnames):
+            cls_gt = self.gt[classname]
+            start, end = cls_gt['offsets'][im_ind], cls_gt['offsets'][im_ind + 1]
+            self.npos[i] += np.count_nonzero(~cls_gt['difficult'][start:end])
+            dets = cls_dets[i + 1]
+            if len(dets) == 0:
+                continue
+            # sort by confidence, the order of these detections in voc_eval_boxes
+            dets = dets[np.argsort(-dets[:, 4], kind='mergesort'), :5]
+            im_inds = np.full((dets.shape[0],), im_ind, dtype=np.int64)
+            ovmax, jmax = voc_overlaps_max(dets[:, :4].astype(np.float) + 1, im_inds,
+                                           cls_gt['boxes'], cls_gt['offsets'])
+            tp_fp = [voc_tp_fp(ovmax, jmax, cls_gt['difficult'], ovthresh) for ovthresh in self.ovthreshs]
+            self.chunks[i].append((dets[:, 4].copy(), im_inds.astype(np.int32),
+                                   np.array([tp for tp, fp in tp_fp], dtype=np.bool),
+                                   np.array([fp for tp, fp in tp_fp], dtype=np.bool)))
+        self.num_images += 1
+        if self.num_images % 256 == 0:
+            self._compact()
+
+    def _compact(self):
+        for i, chunks in enumerate(self.chunks):
+            if len(chunks) > 1:
+                self.chunks[i] = [tuple(np.concatenate([c[n] for c in chunks], axis=-1) for n in range(4))]
+
+    def evaluate(self):
+        """
+        evaluate the images added so far, equal to voc_eval_boxes once all images are added
+        :return: for every class a list of (rec, prec, ap) for each overlap threshold
+        """
+        self._compact()
+        return [self._evaluate_class(i) for i in range(len(self.classnames))]
+
+    def mean_ap(self):
+        """
+        :return: mean ap at the first overlap threshold over the classes seen in the images added so far
+        """
+        self._compact()
+        aps = [self._evaluate_class(i)[0][2] for i in range(len(self.classnames)) if self.npos[i] > 0]
+        return np.mean(aps) if aps else 0.
+
+    def _evaluate_class(self, i):
+        if self.chunks[i]:
+            scores, im_inds, tps, fps = self.chunks[i][0]
+        else:
+            scores = np.zeros((0,))
+            im_inds = np.zeros((0,), dtype=np.int32)
+            tps = fps = np.zeros((len(self.ovthreshs), 0), dtype=np.bool)
+        # descending score, ties in image order as the stable sort of voc_eval_boxes
+        order = np.lexsort((np.arange(len(scores)), im_inds, -scores.astype(np.float)))
+        cls_results = []
+        for t in range(len(self.ovthreshs)):
+            # compute precision recall
+            fp = np.cumsum(fps[t, order]).astype(np.float)
+            tp = np.cumsum(tps[t, order]).astype(np.float)
+            rec = tp / float(self.npos[i])
+            # avoid division by zero in case first detection matches a difficult ground ruth
+            prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+            cls_results.append((rec, prec, voc_ap(rec, prec, self.use_07_metric)))
+        return cls_results
+
+
+def voc_eval(detpath, annopath, imageset_file, classname, annocache, ovthresh=0.5, use_07_metric=False):
+    """
+    pascal voc evaluation
+    :param detpath: detection results detpath.format(classname)
+    :param annopath: annotations annopath.format(classname)
+    :param imageset_file: text file containing list of images
+    :param classname: category name
+    :param annocache: caching annotations
+    :param ovthresh: overlap threshold
+    :param use_07_metric: whether to use voc07's 11 point ap computation
+    :return: rec, prec, ap
+    """
+    image_filenames, recs = load_voc_recs(annopath, imageset_file, annocache)
 
     # extract objects in :param classname:
     class_recs = {}
@@ -0,0 +1,89 @@
+"""
+Binary store of rpn proposals.
+The proposals of all images are one contiguous float32 array of [x1, y1, x2, y2, score] rows in
+<prefix>.bin, the rows of the i-th image are [offsets[i], offsets[i+1]) of <prefix>_offsets.npy.
+The array is memory mapped when loaded, so only the proposals of the images that are read are paged in.
+"""
+
+import os
+import numpy as np
+
+
+NUM_COLUMNS = 5
+
+
+def proposal_store_exists(prefix):
+    """
+    :param prefix: file name of the store without extension
+    :return: the store was completely written, the offsets are written last
+    """
+    return os.path.exists(prefix + '_offsets.npy')
+
+
+class ProposalWriter(object):
+    """
+    appends the proposals of each image to the store as they are generated, nothing is kept in memory
+    """
+    def __init__(self, prefix):
+        """
+        :param prefix: file name of the store without extension
+        """
+        self.prefix = prefix
+        # an incomplete store must not be mistaken for a complete one
+        if proposal_store_exists(prefix):
+            os.remove(prefix + '_offsets.npy')
+        self.f = open(prefix + '.bin', 'wb')
+        self.offsets = [0]
+
+    def append(self, dets):
+        """
+        :param dets: [N, 5] proposals of the next image
+        :return: None
+        """
+        dets = np.ascontiguousarray(dets, dtype=np.float32).reshape((-1, NUM_COLUMNS))
+        dets.tofile(self.f)
+        self.offsets.append(self.offsets[-1] + dets.shape[0])
+
+    def close(self):
+        """
+        flush the proposals and write the offsets
+        :return: ProposalStore of the written proposals
+        """
+        self.f.close()
+        np.save(self.prefix + '_offsets.npy', np.array(self.offsets, dtype=np.int64))
+        return ProposalStore(self.prefix)
+
+
+class ProposalStore(object):
+    """
+    read-only list of [N, 5] proposals of every image, indexing returns a view of the memory mapped array
+    """
+    def __init__(self, prefix):
+        """
+        :param prefix: file name of the store without extension
+        """
+        self.offsets = np.load(prefix + '_offsets.npy')
+        if self.offsets[-1] > 0:
+            self.boxes = np.memmap(prefix + '.bin', dtype=np.float32, mode='r',
+                                   shape=(int(self.offsets[-1]), NUM_COLUMNS))
+        else:
+            # an empty file can not be mapped
+            self.boxes = np.zeros((0, NUM_COLUMNS), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        """
+        :param index: image index
+        :return: [N, 5] proposals of the image
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('image index {} out of range'.format(index))
+        return self.boxes[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
@@ -0,0 +1,60 @@
+#**************************************************************************
+# Greedy detection to ground truth matching of COCOeval.evaluateImg,
+# run for all IoU thresholds of an image and category in one call.
+#**************************************************************************
+
+cimport cython
+import numpy as np
+cimport numpy as np
+
+np.import_array()
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def greedy_match(np.ndarray[np.float64_t, ndim=2] ious,
+                 np.ndarray[np.float64_t, ndim=1] iou_thrs,
+                 np.ndarray[np.uint8_t, ndim=1] gt_ignore,
+                 np.ndarray[np.uint8_t, ndim=1] iscrowd):
+    """
+    match detections to ground truths exactly as COCOeval.evaluateImg
+    :param ious: [D, G] ious of detections sorted by descending score and gts sorted with ignored ones last
+    :param iou_thrs: [T] iou thresholds
+    :param gt_ignore: [G] ignore flag of each gt
+    :param iscrowd: [G] crowd flag of each gt, crowd gts can be matched more than once
+    :return: dt_match [T, D] index of the matched gt or -1, gt_match [T, G] index of the matched dt or -1
+    """
+    cdef Py_ssize_t D = ious.shape[0]
+    cdef Py_ssize_t G = ious.shape[1]
+    cdef Py_ssize_t T = iou_thrs.shape[0]
+    cdef np.ndarray[np.int_t, ndim=2] dt_match = -np.ones((T, D), dtype=np.int)
+    cdef np.ndarray[np.int_t, ndim=2] gt_match = -np.ones((T, G), dtype=np.int)
+    cdef np.ndarray[np.float64_t, ndim=1] thrs = np.minimum(iou_thrs, 1 - 1e-10)
+    cdef Py_ssize_t t, d, g, m
+    cdef double iou
+
+    with nogil:
+        # one row of ious serves every threshold
+        for d in range(D):
+            for t in range(T):
+                # information about best match so far (m=-1 -> unmatched)
+                iou = thrs[t]
+                m = -1
+                for g in range(G):
+                    # if this gt already matched, and not a crowd, continue
+                    if gt_match[t, g] >= 0 and not iscrowd[g]:
+                        continue
+                    # if dt matched to reg gt, and on ignore gt, stop
+                    if m > -1 and gt_ignore[m] == 0 and gt_ignore[g] == 1:
+                        break
+                    # continue to next gt unless better match made
+                    if ious[d, g] < iou:
+                        continue
+                    # match successful and best so far
+                    iou = ious[d, g]
+                    m = g
+                if m == -1:
+                    continue
+                dt_match[t, d] = m
+                gt_match[t, m] = d
+    return dt_match, gt_match
@@ -0,0 +1,142 @@
+import json
+import os
+import time
+import numpy as np
+
+class COCOAnnotations:
+    # Box annotations of a coco annotation file held as arrays.
+    #
+    # Images keep the order of COCO.getImgIds. Annotations are grouped by image in file
+    # order with CSR offsets, the annotations of the i-th image are [offsets[i], offsets[i+1]).
+    # The arrays are saved as .npy files in a directory and loaded memory mapped, so a saved
+    # store opens in a fraction of a second instead of parsing the json file.
+    # COCOeval accepts it as ground truth for box evaluation. Segmentations are not kept,
+    # use COCO for segmentation evaluation and masks.
+    #
+    # The usage is as follows:
+    #  anns = COCOAnnotations.fromFile(annFile, cacheDir)   # parses annFile once, then loads cacheDir
+    #  inds = anns.getAnnInds(imgId, iscrowd=0)
+    #  boxes = anns.bboxes[inds]                            # [x, y, w, h]
+    ARRAYS = ['imgIds', 'heights', 'widths', 'offsets',
+              'annIds', 'annCatIds', 'bboxes', 'areas', 'iscrowd', 'ignore']
+
+    def __init__(self, arrays, cats):
+        '''
+        :param arrays: dict with the arrays listed in ARRAYS
+        :param cats: list of category dicts in file order
+        :return: None
+        '''
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.cats = cats
+        self._catById = {cat['id']: cat for cat in cats}
+        self._imgPos = dict(zip(self.imgIds.tolist(), xrange(len(self.imgIds))))
+
+    @staticmethod
+    def fromDataset(dataset):
+        '''
+        build the arrays from a parsed annotation file
+        :param dataset: dict loaded from an instances or image_info json file
+        :return: COCOAnnotations
+        '''
+        # same key order as COCO.imgs, so images keep the order of COCO.getImgIds
+        imgs = {img['id']: img for img in dataset['images']}
+        imgIds = imgs.keys()
+        imgPos = dict(zip(imgIds, xrange(len(imgIds))))
+        anns = dataset.get('annotations', [])
+        annImg = np.array([imgPos[ann['image_id']] for ann in anns], dtype=np.int64)
+        # stable, annotations of an image stay in file order
+        order = np.argsort(annImg, kind='mergesort')
+        arrays = {
+            'imgIds':       np.array(imgIds, dtype=np.int64),
+            'heights':      np.array([imgs[i]['height'] for i in imgIds], dtype=np.int32),
+            'widths':       np.array([imgs[i]['width'] for i in imgIds], dtype=np.int32),
+            'offsets':      np.r_[0, np.cumsum(np.bincount(annImg, minlength=len(imgIds)))].astype(np.int64),
+            'annIds':       np.array([ann['id'] for ann in anns], dtype=np.int64)[order],
+            'annCatIds':    np.array([ann['category_id'] for ann in anns], dtype=np.int64)[order],
+            'bboxes':       np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape((-1, 4))[order],
+            'areas':        np.array([ann['area'] for ann in anns], dtype=np.float64)[order],
+            'iscrowd':      np.array([ann['iscrowd'] for ann in anns], dtype=np.uint8)[order],
+            'ignore':       np.array([ann.get('ignore', 0) for ann in anns], dtype=np.uint8)[order],
+        }
+        return COCOAnnotations(arrays, dataset.get('categories', []))
+
+    @staticmethod
+    def fromFile(annFile, cacheDir):
+        '''
+        load the store saved in cacheDir, or parse annFile and save it there
+        :param annFile: coco annotation json file
+        :param cacheDir: directory of the saved arrays
+        :return: COCOAnnotations
+        '''
+        if os.path.exists(os.path.join(cacheDir, 'cats.json')):
+            tic = time.time()
+            anns = COCOAnnotations.load(cacheDir)
+            print 'annotation arrays loaded from %s (t=%0.2fs)'%(cacheDir, time.time()- tic)
+            return anns
+        print 'loading annotations into memory...'
+        tic = time.time()
+        anns = COCOAnnotations.fromDataset(json.load(open(annFile, 'r')))
+        print 'Done (t=%0.2fs)'%(time.time()- tic)
+        anns.save(cacheDir)
+        print 'wrote annotation arrays to %s' % cacheDir
+        return anns
+
+    def save(self, cacheDir):
+        '''
+        save the arrays as .npy files, cats.json is written last and marks a complete store
+        :param cacheDir: output directory
+        :return: None
+        '''
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        for name in self.ARRAYS:
+            np.save(os.path.join(cacheDir, name + '.npy'), np.ascontiguousarray(getattr(self, name)))
+        with open(os.path.join(cacheDir, 'cats.json'), 'w') as f:
+            json.dump(self.cats, f)
+
+    @staticmethod
+    def load(cacheDir):
+        '''
+        :param cacheDir: directory written by save
+        :return: COCOAnnotations with read-only memory mapped arrays
+        '''
+        arrays = {name: np.load(os.path.join(cacheDir, name + '.npy'), mmap_mode='r') for name in COCOAnnotations.ARRAYS}
+        with open(os.path.join(cacheDir, 'cats.json'), 'r') as f:
+            cats = json.load(f)
+        return COCOAnnotations(arrays, cats)
+
+    def getImgIds(self):
+        return self.imgIds.tolist()
+
+    def getCatIds(self):
+        return [cat['id'] for cat in self.cats]
+
+    def loadCats(self, ids=[]):
+        if type(ids) == list:
+            return [self._catById[id] for id in ids]
+        elif type(ids) == int:
+            return [self._catById[ids]]
+
+    def getImgSize(self, imgId):
+        '''
+        :return: height, width of an image
+        '''
+        i = self._imgPos[imgId]
+        return int(self.heights[i]), int(self.widths[i])
+
+    def getAnnInds(self, imgId, catId=None, iscrowd=None):
+        '''
+        indexes into the annotation arrays of an image in file order, default skips a filter
+        :param imgId: image id
+        :param catId: keep annotations of this category
+        :param iscrowd: keep annotations with this crowd flag
+        :return: int64 array of indexes
+        '''
+        i = self._imgPos[imgId]
+        inds = np.arange(self.offsets[i], self.offsets[i + 1], dtype=np.int64)
+        if catId is not None:
+            inds = inds[self.annCatIds[inds] == catId]
+        if iscrowd is not None:
+            inds = inds[self.iscrowd[inds] == iscrowd]
+        return inds
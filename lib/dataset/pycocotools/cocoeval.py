@@ -4,8 +4,117 @@ import numpy as np
 import datetime
 import time
 from collections import defaultdict
+import multiprocessing as mp
 import mask
 import copy
+from _cocoeval import greedy_match
+from detections import COCODetections
+from annotations import COCOAnnotations
+
+
+def evaluate_images_kernel(data_pack):
+    '''
+    evaluate a shard of images, see COCOeval.evaluate
+    :param data_pack: dict with 'images', a list of (imgId, groups) with one group of gt and dt arrays
+                      per category, and the evaluation 'settings'
+    :return: for every image and category the ious and the evalImgs entry of every area range
+    '''
+    settings = data_pack['settings']
+    iouThrs = settings['iouThrs']
+    areaRng = settings['areaRng']
+    maxDet = settings['maxDet']
+    results = []
+    for imgId, groups in data_pack['images']:
+        image_results = []
+        for catId, group in groups:
+            if group is None:
+                image_results.append(([], [None] * len(areaRng)))
+                continue
+            # sort dt highest score first, same order as the stable sort of evaluateImg
+            order = np.argsort(-group['dt_scores'], kind='mergesort')[0:maxDet]
+            dt = [group['dt'][i] for i in order]
+            dt_ids = group['dt_ids'][order]
+            dt_area = group['dt_area'][order]
+            dt_scores = group['dt_scores'][order]
+            gt_ids = group['gt_ids']
+            ious = mask.iou(dt, group['gt'], group['iscrowd'].tolist())
+            T = len(iouThrs)
+            D = len(dt)
+            G = len(gt_ids)
+            evals = []
+            for aRng in areaRng:
+                gt_ignore = group['gt_ignore'] | (group['gt_area'] < aRng[0]) | (group['gt_area'] > aRng[1])
+                # sort gt ignore last
+                gtind = np.argsort(gt_ignore, kind='mergesort')
+                gt_ignore = gt_ignore[gtind]
+                gtm = np.zeros((T, G))
+                dtm = np.zeros((T, D))
+                dtIg = np.zeros((T, D))
+                if D > 0 and G > 0:
+                    dt_match, gt_match = greedy_match(np.ascontiguousarray(ious[:, gtind]), iouThrs,
+                                                      gt_ignore.astype(np.uint8), group['iscrowd'][gtind])
+                    matched = dt_match >= 0
+                    dtm[matched] = gt_ids[gtind][dt_match[matched]]
+                    dtIg[matched] = gt_ignore[dt_match[matched]]
+                    matched = gt_match >= 0
+                    gtm[matched] = dt_ids[gt_match[matched]]
+                # set unmatched detections outside of area range to ignore
+                a = ((dt_area < aRng[0]) | (dt_area > aRng[1])).reshape((1, D))
+                dtIg = np.logical_or(dtIg, np.logical_and(dtm == 0, np.repeat(a, T, 0)))
+                evals.append({
+                    'image_id':     imgId,
+                    'category_id':  catId,
+                    'aRng':         aRng,
+                    'maxDet':       maxDet,
+                    'dtIds':        dt_ids.tolist(),
+                    'gtIds':        gt_ids[gtind].tolist(),
+                    'dtMatches':    dtm,
+                    'gtMatches':    gtm,
+                    'dtScores':     dt_scores,
+                    'gtIgnore':     gt_ignore.astype(np.int),
+                    'dtIgnore':     dtIg,
+                })
+            image_results.append((ious, evals))
+        results.append(image_results)
+    return results
+
+
+def _precisionRecall(dtm, dtIg, npig, recThrs):
+    '''
+    precision at the recall thresholds and max recall of detections sorted by descending score
+    :param dtm: [T, D] nonzero where a detection is matched
+    :param dtIg: [T, D] nonzero where a detection is ignored
+    :param npig: number of gts that are not ignored, > 0
+    :param recThrs: [R] recall thresholds
+    :return: recall [T], precision [T, R]
+    '''
+    T = dtm.shape[0]
+    tps = np.logical_and(               dtm,  np.logical_not(dtIg) )
+    fps = np.logical_and(np.logical_not(dtm), np.logical_not(dtIg) )
+
+    # all iou thresholds at once, [T, nd]
+    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float)
+    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float)
+    nd = tp_sum.shape[1]
+    rc = tp_sum / npig
+    pr = tp_sum / (fp_sum+tp_sum+np.spacing(1))
+
+    if nd:
+        recall = rc[:, -1]
+    else:
+        recall = np.zeros((T,))
+
+    # make precision monotonically decreasing, each value is the max of the precisions to its right
+    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+
+    q = np.zeros((T, len(recThrs)))
+    for t in range(T):
+        inds = np.searchsorted(rc[t], recThrs)
+        # recall thresholds above the reached recall keep precision 0
+        valid = inds < nd
+        q[t, valid] = pr[t, inds[valid]]
+    return recall, q
+
 
 class COCOeval:
     # Interface for evaluating detection on the Microsoft COCO dataset.
@@ -17,6 +126,10 @@ class COCOeval:
     #  E.evaluate();                # run per image evaluation
     #  E.accumulate();              # accumulate per image results
     #  E.summarize();               # display summary metrics of results
+    # Box detections can also be evaluated while they are produced:
+    #  E = CocoEval(cocoGt, None); E.beginIncremental()
+    #  E.addImage(imgId, catIds, bboxes, scores)  # for every image
+    #  E.accumulateIncremental(); E.summarize()   # at any time, final once all images are added
     # For example usage see evalDemo.m and http://mscoco.org/.
     #
     # The evaluation parameters are as follows (defaults in brackets):
@@ -107,11 +220,24 @@ class COCOeval:
                 else:
                     raise Exception('segmentation format not supported.')
         p = self.params
-        if p.useCats:
+        if isinstance(self.cocoGt, COCOAnnotations):
+            # arrays are read directly by _evalGroup
+            assert not p.useSegm, 'COCOAnnotations has no segmentations, use COCO'
+            gts=[]
+        elif p.useCats:
             gts=self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
-            dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
         else:
             gts=self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds))
+        if self.cocoDt is None:
+            # detections are passed image by image to addImage
+            dts=[]
+        elif isinstance(self.cocoDt, COCODetections):
+            # columns are read directly by _evalGroup
+            assert not p.useSegm or self.cocoDt.segms is not None, 'segmentation evaluation of box results'
+            dts=[]
+        elif p.useCats:
+            dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
+        else:
             dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds))
 
         if p.useSegm:
@@ -126,9 +252,11 @@ class COCOeval:
         self.evalImgs = defaultdict(list)   # per-image per-category evaluation results
         self.eval     = {}                  # accumulated evaluation results
 
-    def evaluate(self):
+    def evaluate(self, num_workers=0):
         '''
         Run per image evaluation on given images and store results (a list of dict) in self.evalImgs
+        gives the same results as evaluateImg on every image, category and area range
+        :param num_workers: number of processes sharing the images, 0 to run in this process
         :return: None
         '''
         tic = time.time()
@@ -144,22 +272,92 @@ class COCOeval:
         # loop through images, area range, max detection number
         catIds = p.catIds if p.useCats else [-1]
 
-        computeIoU = self.computeIoU
-        self.ious = {(imgId, catId): computeIoU(imgId, catId) \
-                        for imgId in p.imgIds
-                        for catId in catIds}
-
-        evaluateImg = self.evaluateImg
-        maxDet = p.maxDets[-1]
-        self.evalImgs = [evaluateImg(imgId, catId, areaRng, maxDet)
-                 for catId in catIds
-                 for areaRng in p.areaRng
-                 for imgId in p.imgIds
+        images = [(imgId, [(catId, self._evalGroup(imgId, catId)) for catId in catIds]) for imgId in p.imgIds]
+        settings = {'iouThrs': np.asarray(p.iouThrs, dtype=np.float64),
+                    'areaRng': p.areaRng,
+                    'maxDet': p.maxDets[-1]}
+        if num_workers > 0 and len(images) > 1:
+            # a few shards per process to balance crowded and empty images
+            shard_size = int(np.ceil(len(images) / float(num_workers * 4)))
+            data_pack = [{'images': images[i:i + shard_size], 'settings': settings}
+                         for i in range(0, len(images), shard_size)]
+            pool = mp.Pool(num_workers)
+            results = pool.map(evaluate_images_kernel, data_pack)
+            pool.close()
+            pool.join()
+            results = sum(results, [])
+        else:
+            results = evaluate_images_kernel({'images': images, 'settings': settings})
+
+        self.ious = {(imgId, catId): results[i][k][0]
+                     for i, imgId in enumerate(p.imgIds)
+                     for k, catId in enumerate(catIds)}
+        self.evalImgs = [results[i][k][1][a]
+                 for k in range(len(catIds))
+                 for a in range(len(p.areaRng))
+                 for i in range(len(p.imgIds))
              ]
         self._paramsEval = copy.deepcopy(self.params)
         toc = time.time()
         print 'DONE (t=%0.2fs).'%(toc-tic)
 
+    def _evalGroup(self, imgId, catId):
+        '''
+        gt and dt of an image and category as arrays for evaluate_images_kernel
+        :return: dict of arrays, None if there is neither gt nor dt
+        '''
+        p = self.params
+        catIds = [catId] if p.useCats else p.catIds
+        key = 'segmentation' if p.useSegm else 'bbox'
+        group = self._gtGroup(imgId, catIds)
+        if isinstance(self.cocoDt, COCODetections):
+            det = self.cocoDt
+            inds = np.concatenate([det.getDetInds(imgId, cId) for cId in catIds])
+            group.update({
+                'dt':           [det.segms[i] for i in inds] if p.useSegm else det.bboxes[inds].tolist(),
+                'dt_ids':       det.ids[inds],
+                'dt_area':      det.areas[inds],
+                'dt_scores':    det.scores[inds],
+            })
+        else:
+            dt = [_ for cId in catIds for _ in self._dts[imgId,cId]]
+            group.update({
+                'dt':           [d[key] for d in dt],
+                'dt_ids':       np.array([d['id'] for d in dt], dtype=np.int64),
+                'dt_area':      np.array([d['area'] for d in dt], dtype=np.float64),
+                'dt_scores':    np.array([d['score'] for d in dt], dtype=np.float64),
+            })
+        if len(group['gt_ids']) == 0 and len(group['dt_ids']) == 0:
+            return None
+        return group
+
+    def _gtGroup(self, imgId, catIds):
+        '''
+        gt of an image and categories as arrays for evaluate_images_kernel
+        :return: dict of arrays
+        '''
+        key = 'segmentation' if self.params.useSegm else 'bbox'
+        if isinstance(self.cocoGt, COCOAnnotations):
+            ann = self.cocoGt
+            inds = np.concatenate([ann.getAnnInds(imgId, cId) for cId in catIds])
+            group = {
+                'gt':           ann.bboxes[inds].tolist(),
+                'gt_ids':       ann.annIds[inds],
+                'gt_area':      ann.areas[inds],
+                'gt_ignore':    (ann.iscrowd[inds] == 1) | (ann.ignore[inds] != 0),
+                'iscrowd':      ann.iscrowd[inds],
+            }
+        else:
+            gt = [_ for cId in catIds for _ in self._gts[imgId,cId]]
+            group = {
+                'gt':           [g[key] for g in gt],
+                'gt_ids':       np.array([g['id'] for g in gt], dtype=np.int64),
+                'gt_area':      np.array([g['area'] for g in gt], dtype=np.float64),
+                'gt_ignore':    np.array([g['iscrowd'] == 1 or bool(g.get('ignore', 0)) for g in gt], dtype=np.bool),
+                'iscrowd':      np.array([int(g['iscrowd']) for g in gt], dtype=np.uint8),
+            }
+        return group
+
     def computeIoU(self, imgId, catId):
         p = self.params
         if p.useCats:
@@ -313,56 +511,30 @@ class COCOeval:
             Nk = k0*A0*I0
             for a, a0 in enumerate(a_list):
                 Na = a0*I0
+                E = [self.evalImgs[Nk+Na+i] for i in i_list]
+                E = filter(None, E)
+                if len(E) == 0:
+                    continue
+                gtIg = np.concatenate([e['gtIgnore']  for e in E])
+                npig = np.count_nonzero(gtIg == 0)
+                if npig == 0:
+                    continue
+                # concatenate once, maxDet keeps the first detections of every image
+                dtScoresAll = np.concatenate([np.asarray(e['dtScores'], dtype=np.float64) for e in E])
+                dtRank = np.concatenate([np.arange(len(e['dtScores'])) for e in E])
+                dtmAll  = np.concatenate([e['dtMatches'] for e in E], axis=1)
+                dtIgAll = np.concatenate([e['dtIgnore']  for e in E], axis=1)
                 for m, maxDet in enumerate(m_list):
-                    E = [self.evalImgs[Nk+Na+i] for i in i_list]
-                    E = filter(None, E)
-                    if len(E) == 0:
-                        continue
-                    dtScores = np.concatenate([e['dtScores'][0:maxDet] for e in E])
+                    sel = dtRank < maxDet
+                    dtScores = dtScoresAll[sel]
 
                     # different sorting method generates slightly different results.
                     # mergesort is used to be consistent as Matlab implementation.
                     inds = np.argsort(-dtScores, kind='mergesort')
 
-                    dtm  = np.concatenate([e['dtMatches'][:,0:maxDet] for e in E], axis=1)[:,inds]
-                    dtIg = np.concatenate([e['dtIgnore'][:,0:maxDet]  for e in E], axis=1)[:,inds]
-                    gtIg = np.concatenate([e['gtIgnore']  for e in E])
-                    npig = len([ig for ig in gtIg if ig == 0])
-                    if npig == 0:
-                        continue
-                    tps = np.logical_and(               dtm,  np.logical_not(dtIg) )
-                    fps = np.logical_and(np.logical_not(dtm), np.logical_not(dtIg) )
-
-                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float)
-                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float)
-                    for t, (tp, fp) in enumerate(zip(tp_sum, fp_sum)):
-                        tp = np.array(tp)
-                        fp = np.array(fp)
-                        nd = len(tp)
-                        rc = tp / npig
-                        pr = tp / (fp+tp+np.spacing(1))
-                        q  = np.zeros((R,))
-
-                        if nd:
-                            recall[t,k,a,m] = rc[-1]
-                        else:
-                            recall[t,k,a,m] = 0
-
-                        # numpy is slow without cython optimization for accessing elements
-                        # use python array gets significant speed improvement
-                        pr = pr.tolist(); q = q.tolist()
-
-                        for i in range(nd-1, 0, -1):
-                            if pr[i] > pr[i-1]:
-                                pr[i-1] = pr[i]
-
-                        inds = np.searchsorted(rc, p.recThrs)
-                        try:
-                            for ri, pi in enumerate(inds):
-                                q[ri] = pr[pi]
-                        except:
-                            pass
-                        precision[t,:,k,a,m] = np.array(q)
+                    dtm  = dtmAll[:, sel][:, inds]
+                    dtIg = dtIgAll[:, sel][:, inds]
+                    recall[:,k,a,m], precision[:,:,k,a,m] = _precisionRecall(dtm, dtIg, npig, p.recThrs)
         self.eval = {
             'params': p,
             'counts': [T, R, K, A, M],
@@ -373,6 +545,121 @@ class COCOeval:
         toc = time.time()
         print 'DONE (t=%0.2fs).'%( toc-tic )
 
+    def beginIncremental(self):
+        '''
+        start evaluating detections image by image with addImage instead of evaluate,
+        only compact per category and area range arrays are kept, not the evalImgs dicts
+        :return: None
+        '''
+        p = self.params
+        p.imgIds = list(np.unique(p.imgIds))
+        if p.useCats:
+            p.catIds = list(np.unique(p.catIds))
+        p.maxDets = sorted(p.maxDets)
+        self.params=p
+
+        self._prepare()
+        self._paramsEval = copy.deepcopy(self.params)
+        self._settings = {'iouThrs': np.asarray(p.iouThrs, dtype=np.float64),
+                          'areaRng': p.areaRng,
+                          'maxDet': p.maxDets[-1]}
+        self._imgPos = dict(zip(p.imgIds, range(len(p.imgIds))))
+        K = len(p.catIds) if p.useCats else 1
+        A = len(p.areaRng)
+        # per category and area range: chunks of (dtScores, imgPos, dtRank, matched [TxD], ignored [TxD])
+        self._chunks = [[[] for a in range(A)] for k in range(K)]
+        self._npig = np.zeros((K, A), dtype=np.int64)
+        self._numImages = 0
+
+    def addImage(self, imgId, catIds, bboxes, scores):
+        '''
+        evaluate the box detections of one image, same per image results as evaluate
+        :param imgId: image id in params.imgIds
+        :param catIds: [N] category id of each detection
+        :param bboxes: [Nx4] boxes as [x, y, w, h]
+        :param scores: [N] confidence of each detection
+        :return: None
+        '''
+        p = self.params
+        assert not p.useSegm, 'addImage evaluates boxes'
+        catIds = np.asarray(catIds, dtype=np.int64).reshape(-1)
+        bboxes = np.asarray(bboxes, dtype=np.float64).reshape((-1, 4))
+        scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+        evalCatIds = p.catIds if p.useCats else [-1]
+        groups = []
+        for catId in evalCatIds:
+            cIds = [catId] if p.useCats else p.catIds
+            group = self._gtGroup(imgId, cIds)
+            inds = np.concatenate([np.flatnonzero(catIds == cId) for cId in cIds])
+            group.update({
+                'dt':           bboxes[inds].tolist(),
+                'dt_ids':       inds + 1,
+                'dt_area':      bboxes[inds, 2] * bboxes[inds, 3],
+                'dt_scores':    scores[inds],
+            })
+            if len(group['gt_ids']) == 0 and len(inds) == 0:
+                group = None
+            groups.append((catId, group))
+        results = evaluate_images_kernel({'images': [(imgId, groups)], 'settings': self._settings})[0]
+        pos = self._imgPos[imgId]
+        for k, (ious, evals) in enumerate(results):
+            for a, e in enumerate(evals):
+                if e is None:
+                    continue
+                D = len(e['dtScores'])
+                self._npig[k, a] += np.count_nonzero(e['gtIgnore'] == 0)
+                self._chunks[k][a].append((e['dtScores'], np.full((D,), pos, dtype=np.int32),
+                                           np.arange(D, dtype=np.int32), e['dtMatches'] != 0, e['dtIgnore'] != 0))
+        self._numImages += 1
+        if self._numImages % 256 == 0:
+            self._compactIncremental()
+
+    def _compactIncremental(self):
+        '''
+        merge the chunks of every category and area range into one
+        :return: None
+        '''
+        for chunks in self._chunks:
+            for a, C in enumerate(chunks):
+                if len(C) > 1:
+                    chunks[a] = [tuple(np.concatenate([c[n] for c in C], axis=-1) for n in range(5))]
+
+    def accumulateIncremental(self):
+        '''
+        accumulate the images added so far and store the result in self.eval,
+        equal to accumulate after evaluate once every image of params.imgIds is added
+        :return: None
+        '''
+        p = self.params
+        self._compactIncremental()
+        T           = len(p.iouThrs)
+        R           = len(p.recThrs)
+        K           = len(p.catIds) if p.useCats else 1
+        A           = len(p.areaRng)
+        M           = len(p.maxDets)
+        precision   = -np.ones((T,R,K,A,M)) # -1 for the precision of absent categories
+        recall      = -np.ones((T,K,A,M))
+        for k in range(K):
+            for a in range(A):
+                npig = self._npig[k, a]
+                if npig == 0:
+                    continue
+                dtScoresAll, imgPos, dtRank, dtmAll, dtIgAll = self._chunks[k][a][0]
+                for m, maxDet in enumerate(p.maxDets):
+                    sel = dtRank < maxDet
+                    # descending score, ties in image order as the stable sort of accumulate
+                    inds = np.lexsort((dtRank[sel], imgPos[sel], -dtScoresAll[sel]))
+                    dtm  = dtmAll[:, sel][:, inds]
+                    dtIg = dtIgAll[:, sel][:, inds]
+                    recall[:,k,a,m], precision[:,:,k,a,m] = _precisionRecall(dtm, dtIg, npig, p.recThrs)
+        self.eval = {
+            'params': p,
+            'counts': [T, R, K, A, M],
+            'date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'precision': precision,
+            'recall':   recall,
+        }
+
     def summarize(self):
         '''
         Compute and display summary metrics for evaluation results.
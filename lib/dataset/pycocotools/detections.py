@@ -0,0 +1,131 @@
+import json
+import os
+import numpy as np
+import mask
+
+class COCODetections:
+    # Detection results held as columns instead of a list of annotation dicts.
+    #
+    # COCOeval accepts it in place of the result api object returned by COCO.loadRes
+    # and evaluates it to the same numbers: detection ids are 1..N in input order,
+    # box areas are w*h and segmentation areas come from the RLEs as in loadRes.
+    # COCOeval.computeIoU and COCOeval.evaluateImg need annotation dicts and are
+    # not available for it, COCOeval.evaluate is.
+    #
+    # The usage is as follows:
+    #  dets = COCODetections(imageIds, catIds, bboxes, scores)
+    #  E = COCOeval(cocoGt, dets); E.evaluate(); E.accumulate(); E.summarize()
+    #  dets.writeJson(resFile)      # optional export in the results format
+    #  dets.save(resDir)            # compact binary export, COCODetections.load(resDir) reads it back
+    def __init__(self, imageIds, catIds, bboxes, scores, segms=None):
+        '''
+        :param imageIds: [N] image id of each detection
+        :param catIds: [N] category id of each detection
+        :param bboxes: [Nx4] boxes as [x, y, w, h]
+        :param scores: [N] confidence of each detection
+        :param segms: list of N compressed RLEs for segmentation results, None for box results
+        :return: None
+        '''
+        self.imageIds = np.asarray(imageIds, dtype=np.int64).reshape(-1)
+        self.catIds = np.asarray(catIds, dtype=np.int64).reshape(-1)
+        self.bboxes = np.asarray(bboxes, dtype=np.float64).reshape((-1, 4))
+        self.scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+        self.segms = segms
+        N = len(self.imageIds)
+        assert len(self.catIds) == N and len(self.bboxes) == N and len(self.scores) == N, \
+            'detection columns differ in length'
+        assert segms is None or len(segms) == N, 'one segmentation per detection'
+        self.ids = np.arange(1, N + 1, dtype=np.int64)
+        if segms is None:
+            self.areas = self.bboxes[:, 2] * self.bboxes[:, 3]
+        elif N > 0:
+            self.areas = mask.area(segms).astype(np.float64)
+        else:
+            self.areas = np.zeros((0,), dtype=np.float64)
+        self.createIndex()
+
+    def createIndex(self):
+        '''
+        group detections by image and category, input order within a group
+        :return: None
+        '''
+        order = np.lexsort((self.catIds, self.imageIds))
+        imgs = self.imageIds[order]
+        cats = self.catIds[order]
+        starts = np.flatnonzero(np.r_[True, (imgs[1:] != imgs[:-1]) | (cats[1:] != cats[:-1])]) \
+            if len(order) else np.zeros((0,), dtype=np.int64)
+        ends = np.r_[starts[1:], len(order)].astype(np.int64)
+        self._groups = {(imgId, catId): order[s:e] for imgId, catId, s, e in
+                        zip(imgs[starts].tolist(), cats[starts].tolist(), starts.tolist(), ends.tolist())}
+        self._empty = np.zeros((0,), dtype=np.int64)
+
+    def getDetInds(self, imgId, catId):
+        '''
+        :return: indexes of the detections of an image and category in input order
+        '''
+        return self._groups.get((imgId, catId), self._empty)
+
+    def writeJson(self, resFile, chunkSize=10000):
+        '''
+        stream the detections to a results json file, same fields as the results format
+        :param resFile: file name of the results file
+        :param chunkSize: detections formatted per write
+        :return: None
+        '''
+        imageIds = self.imageIds.tolist()
+        catIds = self.catIds.tolist()
+        scores = self.scores.tolist()
+        if self.segms is None:
+            bboxes = self.bboxes.tolist()
+            fmt = '{"bbox": [%r, %r, %r, %r], "category_id": %d, "image_id": %d, "score": %r}'
+            row = lambda i: fmt % (bboxes[i][0], bboxes[i][1], bboxes[i][2], bboxes[i][3],
+                                   catIds[i], imageIds[i], scores[i])
+        else:
+            fmt = '{"category_id": %d, "image_id": %d, "score": %r, "segmentation": %s}'
+            row = lambda i: fmt % (catIds[i], imageIds[i], scores[i], json.dumps(self.segms[i], sort_keys=True))
+        with open(resFile, 'w') as f:
+            f.write('[')
+            for start in xrange(0, len(imageIds), chunkSize):
+                rows = ',\n'.join(row(i) for i in xrange(start, min(start + chunkSize, len(imageIds))))
+                f.write(rows if start == 0 else ',\n' + rows)
+            f.write(']\n')
+
+    def save(self, resDir, chunkSize=10000):
+        '''
+        save the columns as .npy files, RLE counts of segmentation results are streamed into
+        one byte file with their offsets
+        :param resDir: output directory
+        :param chunkSize: RLEs joined per write
+        :return: None
+        '''
+        if not os.path.exists(resDir):
+            os.makedirs(resDir)
+        for name in ['imageIds', 'catIds', 'bboxes', 'scores']:
+            np.save(os.path.join(resDir, name + '.npy'), getattr(self, name))
+        if self.segms is None:
+            return
+        lengths = np.zeros((len(self.segms),), dtype=np.int64)
+        with open(os.path.join(resDir, 'counts.bin'), 'wb') as f:
+            for start in xrange(0, len(self.segms), chunkSize):
+                counts = [str(segm['counts']) for segm in self.segms[start:start + chunkSize]]
+                lengths[start:start + len(counts)] = [len(c) for c in counts]
+                f.write(''.join(counts))
+        np.save(os.path.join(resDir, 'countOffsets.npy'), np.r_[0, np.cumsum(lengths)].astype(np.int64))
+        np.save(os.path.join(resDir, 'sizes.npy'), np.array([segm['size'] for segm in self.segms],
+                                                            dtype=np.int64).reshape((-1, 2)))
+
+    @staticmethod
+    def load(resDir):
+        '''
+        :param resDir: directory written by save
+        :return: COCODetections
+        '''
+        columns = [np.load(os.path.join(resDir, name + '.npy')) for name in ['imageIds', 'catIds', 'bboxes', 'scores']]
+        segms = None
+        if os.path.exists(os.path.join(resDir, 'counts.bin')):
+            with open(os.path.join(resDir, 'counts.bin'), 'rb') as f:
+                counts = f.read()
+            offsets = np.load(os.path.join(resDir, 'countOffsets.npy')).tolist()
+            sizes = np.load(os.path.join(resDir, 'sizes.npy')).tolist()
+            segms = [{'size': size, 'counts': counts[offsets[i]:offsets[i + 1]]} for i, size in enumerate(sizes)]
+        return COCODetections(*columns, segms=segms)
@@ -12,6 +12,12 @@ ext_modules = [
         sources=['maskApi.c', '_mask.pyx'],
         include_dirs=[np.get_include()],
         extra_compile_args=['-Wno-cpp', '-Wno-unused-function', '-std=c99'],
+    ),
+    Extension(
+        '_cocoeval',
+        sources=['_cocoeval.pyx'],
+        include_dirs=[np.get_include()],
+        extra_compile_args=['-Wno-cpp', '-Wno-unused-function'],
     )
 ]
 
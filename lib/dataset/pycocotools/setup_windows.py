@@ -16,6 +16,12 @@ ext_modules = [
         sources=['maskApi.c', '_mask.pyx'],
         include_dirs=[np.get_include()],
         extra_compile_args=[],
+    ),
+    Extension(
+        '_cocoeval',
+        sources=['_cocoeval.pyx'],
+        include_dirs=[np.get_include()],
+        extra_compile_args=[],
     )
 ]
 
@@ -0,0 +1,206 @@
+"""
+Confusion matrix based evaluation of semantic segmentation.
+Pixels labelled 255 in the ground truth are ignored.
+"""
+
+import os
+import threading
+import Queue
+import cv2
+import numpy as np
+import PIL.Image
+import multiprocessing as mp
+
+
+def get_confusion_matrix(gt_label, pred_label, class_num):
+    """
+    Calcute the confusion matrix by given label and pred
+    :param gt_label: the ground truth label
+    :param pred_label: the pred label of the same pixels
+    :param class_num: the nunber of class
+    :return: [class_num, class_num] confusion matrix, rows are gt labels and columns are pred labels
+    """
+    index = gt_label.astype(np.int64).ravel() * class_num + pred_label.astype(np.int64).ravel()
+    label_count = np.bincount(index, minlength=class_num * class_num)
+    return label_count[:class_num * class_num].reshape((class_num, class_num)).astype(np.float64)
+
+
+def image_confusion_matrix(seg_gt, seg_pred, class_num, resize_to_gt):
+    """
+    confusion matrix of one image
+    :param seg_gt: [H, W] ground truth label map
+    :param seg_pred: [h, w] pred label map
+    :param resize_to_gt: resize the pred to the size of the gt, else the gt to the size of the pred
+    :return: [class_num, class_num] confusion matrix
+    """
+    if resize_to_gt:
+        seg_pred = cv2.resize(seg_pred, (seg_gt.shape[1], seg_gt.shape[0]), interpolation=cv2.INTER_NEAREST)
+    else:
+        seg_gt = cv2.resize(seg_gt, (seg_pred.shape[1], seg_pred.shape[0]), interpolation=cv2.INTER_NEAREST)
+    keep = seg_gt != 255
+    return get_confusion_matrix(seg_gt[keep], seg_pred[keep], class_num)
+
+
+def confusion_matrix_kernel(data_pack):
+    """
+    summed confusion matrix of a shard of images
+    :param data_pack: dict with 'gt_paths', 'preds' the pred label maps or the paths of their pngs,
+                      'class_num' and 'resize_to_gt'
+    :return: [class_num, class_num] confusion matrix
+    """
+    class_num = data_pack['class_num']
+    confusion_matrix = np.zeros((class_num, class_num))
+    for gt_path, pred in zip(data_pack['gt_paths'], data_pack['preds']):
+        seg_gt = np.array(PIL.Image.open(gt_path))
+        if isinstance(pred, basestring):
+            pred = np.array(PIL.Image.open(pred))
+        # same values as the written pngs
+        seg_pred = np.uint8(np.squeeze(pred))
+        confusion_matrix += image_confusion_matrix(seg_gt, seg_pred, class_num, data_pack['resize_to_gt'])
+    return confusion_matrix
+
+
+def evaluate_confusion_matrix(gt_paths, preds, class_num, resize_to_gt, num_workers=None):
+    """
+    confusion matrix of all images, images are scored in parallel and their matrices summed
+    :param gt_paths: ground truth png of every image
+    :param preds: pred label map of every image, or the path of its png
+    :param class_num: the nunber of class
+    :param resize_to_gt: resize the pred to the size of the gt, else the gt to the size of the pred
+    :param num_workers: number of processes, None for one per cpu, 0 to run in this process
+    :return: [class_num, class_num] confusion matrix
+    """
+    if num_workers is None:
+        num_workers = mp.cpu_count()
+    if num_workers == 0 or len(gt_paths) <= 1:
+        return confusion_matrix_kernel({'gt_paths': gt_paths, 'preds': preds,
+                                        'class_num': class_num, 'resize_to_gt': resize_to_gt})
+    # a few shards per process to balance image sizes
+    shard_size = int(np.ceil(len(gt_paths) / float(num_workers * 4)))
+    data_pack = [{'gt_paths': gt_paths[i:i + shard_size],
+                  'preds': preds[i:i + shard_size],
+                  'class_num': class_num,
+                  'resize_to_gt': resize_to_gt}
+                 for i in range(0, len(gt_paths), shard_size)]
+    pool = mp.Pool(num_workers)
+    results = pool.map(confusion_matrix_kernel, data_pack)
+    pool.close()
+    pool.join()
+    return np.sum(results, axis=0)
+
+
+def confusion_matrix_iu(confusion_matrix):
+    """
+    :param confusion_matrix: [class_num, class_num] confusion matrix
+    :return: dict with the 'IU_array' of every class and their 'meanIU'
+    """
+    pos = confusion_matrix.sum(1)
+    res = confusion_matrix.sum(0)
+    tp = np.diag(confusion_matrix)
+
+    IU_array = (tp / np.maximum(1.0, pos + res - tp))
+    mean_IU = IU_array.mean()
+
+    return {'meanIU': mean_IU, 'IU_array': IU_array}
+
+
+class SegmentationWriter(object):
+    """
+    saves pred label maps as palleted pngs from a background thread, so png encoding overlaps inference
+    """
+    def __init__(self, pallete, max_queue=16):
+        """
+        :param pallete: colormap of the pngs
+        :param max_queue: maps waiting to be written, put blocks once it is full
+        """
+        self.pallete = pallete
+        self.queue = Queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, path, pred):
+        """
+        :param path: png file name
+        :param pred: pred label map
+        :return: None
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((path, pred))
+
+    def close(self):
+        """
+        wait for the queued maps to be written
+        :return: None
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            path, pred = item
+            try:
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                segmentation_result = PIL.Image.fromarray(np.uint8(np.squeeze(pred)))
+                segmentation_result.putpalette(self.pallete)
+                segmentation_result.save(path)
+            except Exception as e:
+                self.error = e
+
+
+class SegmentationIncrementalEval(object):
+    """
+    confusion matrix updated image by image while the predictions are produced, the maps are not kept
+    """
+    def __init__(self, gt_paths, class_num, resize_to_gt, result_paths=None, pallete=None):
+        """
+        :param gt_paths: ground truth png of every image
+        :param class_num: the nunber of class
+        :param resize_to_gt: resize the pred to the size of the gt, else the gt to the size of the pred
+        :param result_paths: png file name of every image to write the preds from a SegmentationWriter, None to not write
+        :param pallete: colormap of the written pngs
+        """
+        self.gt_paths = gt_paths
+        self.class_num = class_num
+        self.resize_to_gt = resize_to_gt
+        self.result_paths = result_paths
+        self.writer = SegmentationWriter(pallete) if result_paths is not None else None
+        self.confusion_matrix = np.zeros((class_num, class_num))
+
+    def add(self, im_ind, pred):
+        """
+        :param im_ind: index of the image in the image set
+        :param pred: pred label map of the image
+        :return: None
+        """
+        if self.writer is not None:
+            self.writer.put(self.result_paths[im_ind], pred)
+        seg_gt = np.array(PIL.Image.open(self.gt_paths[im_ind]))
+        self.confusion_matrix += image_confusion_matrix(seg_gt, np.uint8(np.squeeze(pred)),
+                                                        self.class_num, self.resize_to_gt)
+
+    def mean_iu(self):
+        """
+        :return: mean IU of the images added so far
+        """
+        return confusion_matrix_iu(self.confusion_matrix)['meanIU']
+
+    def evaluate(self):
+        """
+        finish writing the pngs
+        :return: the evaluation metrics, same as evaluate_segmentations
+        """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        return confusion_matrix_iu(self.confusion_matrix)
@@ -7,6 +7,9 @@
 
 import numpy as np
 cimport numpy as np
+cimport cython
+from cython.parallel import prange
+from libc.math cimport exp
 
 cdef inline np.float32_t max(np.float32_t a, np.float32_t b):
     return a if a >= b else b
@@ -66,3 +69,335 @@ def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
                 suppressed[j] = 1
 
     return keep
+
+def cpu_batched_nms(np.ndarray[np.float64_t, ndim=2] dets, np.ndarray[np.int32_t, ndim=1] labels,
+                    np.ndarray[np.int32_t, ndim=1] images, np.float thresh, int max_per_image=0):
+    """
+    greedy nms over all boxes of one or more images at once
+    boxes only suppress boxes of the same label, which is the class offset trick without shifting coordinates
+    matches nms() run on each label separately: boxes are suppressed by overlap > thresh, computed in float64
+    :param dets: [N, 5] x1, y1, x2, y2, score
+    :param labels: [N] suppression group of each box, e.g. class or image * num_classes + class
+    :param images: [N] image of each box, max_per_image is applied per image
+    :param thresh: retain overlap <= thresh
+    :param max_per_image: per image, keep boxes scoring at least its max_per_image-th best kept score, 0 to disable
+    :return: kept indexes sorted by label, then by descending score
+    """
+    cdef int ndets = dets.shape[0]
+    if ndets == 0:
+        return np.zeros((0,), dtype=np.intp)
+
+    cdef np.ndarray[np.float64_t, ndim=1] x1 = dets[:, 0]
+    cdef np.ndarray[np.float64_t, ndim=1] y1 = dets[:, 1]
+    cdef np.ndarray[np.float64_t, ndim=1] x2 = dets[:, 2]
+    cdef np.ndarray[np.float64_t, ndim=1] y2 = dets[:, 3]
+    cdef np.ndarray[np.float64_t, ndim=1] scores = dets[:, 4]
+
+    cdef np.ndarray[np.float64_t, ndim=1] areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    # sorted by label so that every label is a contiguous run, then by descending score
+    cdef np.ndarray[np.intp_t, ndim=1] order = np.lexsort((-scores, labels))
+
+    cdef np.ndarray[np.uint8_t, ndim=1] suppressed = np.zeros((ndets,), dtype=np.uint8)
+    cdef np.ndarray[np.uint8_t, ndim=1] kept = np.zeros((ndets,), dtype=np.uint8)
+
+    cdef int _i, _j
+    cdef Py_ssize_t i, j
+    cdef int ilabel
+    cdef np.float64_t ix1, iy1, ix2, iy2, iarea
+    cdef np.float64_t xx1, yy1, xx2, yy2
+    cdef np.float64_t w, h
+    cdef np.float64_t inter, ovr
+
+    for _i in range(ndets):
+        i = order[_i]
+        if suppressed[i] == 1:
+            continue
+        kept[_i] = 1
+        ilabel = labels[i]
+        ix1 = x1[i]
+        iy1 = y1[i]
+        ix2 = x2[i]
+        iy2 = y2[i]
+        iarea = areas[i]
+        for _j in range(_i + 1, ndets):
+            j = order[_j]
+            if labels[j] != ilabel:
+                break
+            if suppressed[j] == 1:
+                continue
+            xx1 = ix1 if ix1 >= x1[j] else x1[j]
+            yy1 = iy1 if iy1 >= y1[j] else y1[j]
+            xx2 = ix2 if ix2 <= x2[j] else x2[j]
+            yy2 = iy2 if iy2 <= y2[j] else y2[j]
+            w = xx2 - xx1 + 1
+            h = yy2 - yy1 + 1
+            w = w if w >= 0.0 else 0.0
+            h = h if h >= 0.0 else 0.0
+            inter = w * h
+            ovr = inter / (iarea + areas[j] - inter)
+            if ovr > thresh:
+                suppressed[j] = 1
+
+    keep = order[kept == 1]
+    if max_per_image > 0:
+        kept_images = images[keep]
+        kept_scores = scores[keep]
+        mask = np.ones(keep.shape[0], dtype=np.bool)
+        for im in np.unique(kept_images):
+            in_image = kept_images == im
+            if np.count_nonzero(in_image) > max_per_image:
+                image_thresh = np.sort(kept_scores[in_image])[-max_per_image]
+                mask[in_image & (kept_scores < image_thresh)] = False
+        keep = keep[mask]
+    return keep
+
+
+@cython.cdivision(True)
+cdef inline double _iou(double* a, double* b) nogil:
+    """ overlap of two [x1, y1, x2, y2, ...] rows with the +1 pixel convention of nms """
+    cdef double xx1 = a[0] if a[0] >= b[0] else b[0]
+    cdef double yy1 = a[1] if a[1] >= b[1] else b[1]
+    cdef double xx2 = a[2] if a[2] <= b[2] else b[2]
+    cdef double yy2 = a[3] if a[3] <= b[3] else b[3]
+    cdef double w = xx2 - xx1 + 1
+    cdef double h = yy2 - yy1 + 1
+    if w <= 0 or h <= 0:
+        return 0.0
+    cdef double inter = w * h
+    cdef double area_a = (a[2] - a[0] + 1) * (a[3] - a[1] + 1)
+    cdef double area_b = (b[2] - b[0] + 1) * (b[3] - b[1] + 1)
+    return inter / (area_a + area_b - inter)
+
+
+cdef inline void _swap(double* b, Py_ssize_t* idx, Py_ssize_t i, Py_ssize_t j) nogil:
+    """ swap rows i and j of [N, 5] b and their indexes """
+    cdef Py_ssize_t k, t
+    cdef double tmp
+    for k in range(5):
+        tmp = b[i * 5 + k]
+        b[i * 5 + k] = b[j * 5 + k]
+        b[j * 5 + k] = tmp
+    t = idx[i]
+    idx[i] = idx[j]
+    idx[j] = t
+
+
+@cython.cdivision(True)
+cdef Py_ssize_t _soft_nms_group(double* b, Py_ssize_t* idx, Py_ssize_t start, Py_ssize_t end,
+                                double thresh, double sigma, double score_thresh, int method) nogil:
+    """ soft nms of rows [start, end) of [N, 5] b, kept rows end up in [start, returned end) by descending score """
+    cdef Py_ssize_t n = end
+    cdef Py_ssize_t i = start
+    cdef Py_ssize_t pos, maxpos
+    cdef double ov, weight
+    while i < n:
+        maxpos = i
+        for pos in range(i + 1, n):
+            if b[pos * 5 + 4] > b[maxpos * 5 + 4]:
+                maxpos = pos
+        _swap(b, idx, i, maxpos)
+        pos = i + 1
+        while pos < n:
+            ov = _iou(&b[i * 5], &b[pos * 5])
+            if method == 1:
+                weight = 1 - ov if ov > thresh else 1
+            else:
+                weight = exp(-(ov * ov) / sigma)
+            b[pos * 5 + 4] = b[pos * 5 + 4] * weight
+            # drop boxes decayed below score_thresh by swapping in the last box
+            if b[pos * 5 + 4] < score_thresh:
+                _swap(b, idx, pos, n - 1)
+                n -= 1
+            else:
+                pos += 1
+        i += 1
+    return n
+
+
+def _label_runs(np.ndarray labels):
+    """ [start, end) of every run of equal values in sorted labels """
+    cdef np.ndarray bounds = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+    starts = np.hstack(([0], bounds)).astype(np.intp)
+    ends = np.hstack((bounds, [labels.shape[0]])).astype(np.intp)
+    return starts, ends
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def cpu_soft_nms(np.ndarray[np.float64_t, ndim=2] dets, np.ndarray[np.int32_t, ndim=1] labels,
+                 double thresh, double sigma=0.5, double score_thresh=0.001, int method=1):
+    """
+    soft nms (Bodla et al. 2017) of every label, labels are processed in parallel
+    :param dets: [N, 5] x1, y1, x2, y2, score
+    :param labels: [N] boxes only decay boxes with the same label
+    :param thresh: linear method decays boxes with overlap > thresh by (1 - overlap)
+    :param sigma: gaussian method decays every box by exp(-overlap^2 / sigma)
+    :param score_thresh: drop boxes whose decayed score falls below it
+    :param method: 1 for linear, 2 for gaussian
+    :return: kept indexes sorted by label then by descending decayed score, decayed scores of all boxes
+    """
+    cdef Py_ssize_t ndets = dets.shape[0]
+    new_scores = dets[:, 4].copy()
+    if ndets == 0:
+        return np.zeros((0,), dtype=np.intp), new_scores
+
+    order = np.lexsort((-dets[:, 4], labels)).astype(np.intp)
+    cdef double[:, ::1] b = np.ascontiguousarray(dets[order, :5])
+    cdef Py_ssize_t[::1] idx = order
+    starts, ends = _label_runs(labels[order])
+    cdef Py_ssize_t[::1] run_starts = starts
+    cdef Py_ssize_t[::1] run_ends = ends
+    cdef Py_ssize_t[::1] run_kept = np.zeros(starts.shape[0], dtype=np.intp)
+    cdef Py_ssize_t g, nruns = starts.shape[0]
+
+    for g in prange(nruns, nogil=True, schedule='dynamic'):
+        run_kept[g] = _soft_nms_group(&b[0, 0], &idx[0], run_starts[g], run_ends[g],
+                                      thresh, sigma, score_thresh, method)
+
+    sorted_idx = np.asarray(idx)
+    new_scores[sorted_idx] = np.asarray(b)[:, 4]
+    keep = np.hstack([sorted_idx[starts[g]:run_kept[g]] for g in range(nruns)])
+    return keep.astype(np.intp), new_scores
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def cpu_matrix_nms(np.ndarray[np.float64_t, ndim=2] dets, np.ndarray[np.int32_t, ndim=1] labels,
+                   double sigma=0.5, double score_thresh=0.001, int method=1):
+    """
+    matrix nms (Wang et al. 2020, SOLOv2) on boxes, every row is decayed independently and in parallel
+    decay of box j is min over higher scoring boxes i of the same label of f(iou_ij) / f(compensate_i),
+    where compensate_i is the largest overlap of box i with a box scoring higher than itself
+    :param dets: [N, 5] x1, y1, x2, y2, score
+    :param labels: [N] boxes only decay boxes with the same label
+    :param sigma: gaussian method uses f(x) = exp(-x^2 / sigma), as soft nms
+    :param score_thresh: drop boxes whose decayed score falls below it
+    :param method: 1 for linear f(x) = 1 - x, 2 for gaussian
+    :return: kept indexes sorted by label then by descending decayed score, decayed scores of all boxes
+    """
+    cdef Py_ssize_t ndets = dets.shape[0]
+    new_scores = dets[:, 4].copy()
+    if ndets == 0:
+        return np.zeros((0,), dtype=np.intp), new_scores
+
+    order = np.lexsort((-dets[:, 4], labels)).astype(np.intp)
+    sorted_labels = labels[order]
+    cdef double[:, ::1] b = np.ascontiguousarray(dets[order, :5])
+    starts, ends = _label_runs(sorted_labels)
+    # start of the label run of every sorted box
+    cdef Py_ssize_t[::1] run_start = np.repeat(starts, ends - starts)
+    cdef double[::1] compensate = np.zeros(ndets, dtype=np.float64)
+    cdef double[::1] decay = np.ones(ndets, dtype=np.float64)
+    cdef Py_ssize_t i, j
+    cdef double ov, f
+
+    for j in prange(ndets, nogil=True, schedule='dynamic'):
+        for i in range(run_start[j], j):
+            ov = _iou(&b[i, 0], &b[j, 0])
+            if ov > compensate[j]:
+                compensate[j] = ov
+
+    for j in prange(ndets, nogil=True, schedule='dynamic'):
+        for i in range(run_start[j], j):
+            # a duplicate of a higher box (compensate 1) does not decay anything
+            if compensate[i] >= 1:
+                continue
+            ov = _iou(&b[i, 0], &b[j, 0])
+            if method == 1:
+                f = (1 - ov) / (1 - compensate[i])
+            else:
+                f = exp(-(ov * ov - compensate[i] * compensate[i]) / sigma)
+            if f < decay[j]:
+                decay[j] = f
+
+    decayed = np.asarray(b)[:, 4] * np.asarray(decay)
+    new_scores[order] = decayed
+    kept = np.flatnonzero(decayed >= score_thresh)
+    kept = kept[np.lexsort((-decayed[kept], sorted_labels[kept]))]
+    return order[kept], new_scores
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _suppress(np.float32_t[:, ::1] b, np.float32_t[::1] areas, np.uint8_t[::1] suppressed,
+                    Py_ssize_t i, Py_ssize_t start, Py_ssize_t end, np.float32_t thresh) nogil:
+    """
+    mark boxes in [start, end) overlapping box i by more than thresh, in float32 as in the gpu nms kernel
+    b holds x1, y1, x2, y2 in rows, the loop is branch free so that the compiler can vectorize it
+    """
+    cdef np.float32_t* x1 = &b[0, 0]
+    cdef np.float32_t* y1 = &b[1, 0]
+    cdef np.float32_t* x2 = &b[2, 0]
+    cdef np.float32_t* y2 = &b[3, 0]
+    cdef np.float32_t* area = &areas[0]
+    cdef np.uint8_t* sup = &suppressed[0]
+    cdef np.float32_t ix1 = x1[i], iy1 = y1[i], ix2 = x2[i], iy2 = y2[i], iarea = area[i]
+    cdef np.float32_t xx1, yy1, xx2, yy2, w, h, inter
+    cdef Py_ssize_t j
+    for j in range(start, end):
+        xx1 = ix1 if ix1 >= x1[j] else x1[j]
+        yy1 = iy1 if iy1 >= y1[j] else y1[j]
+        xx2 = ix2 if ix2 <= x2[j] else x2[j]
+        yy2 = iy2 if iy2 <= y2[j] else y2[j]
+        w = xx2 - xx1 + 1
+        h = yy2 - yy1 + 1
+        w = w if w > 0 else 0
+        h = h if h > 0 else 0
+        inter = w * h
+        sup[j] |= inter / (iarea + area[j] - inter) > thresh
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def cpu_nms_topn(np.ndarray[np.float32_t, ndim=2] dets, np.float32_t thresh,
+                 int pre_nms_top_n=0, int post_nms_top_n=0, int chunk_size=1024):
+    """
+    greedy nms of the pre_nms_top_n highest scoring boxes, stopping once post_nms_top_n boxes are kept,
+    suppressing overlap > thresh as gpu_nms does. the sweep of each kept box is split into chunks
+    of chunk_size boxes run by parallel threads
+    :param dets: [N, 5] x1, y1, x2, y2, score, need not be sorted
+    :param pre_nms_top_n: boxes considered, 0 for all
+    :param post_nms_top_n: boxes kept at most, 0 for no limit
+    :return: indexes into dets of kept boxes by descending score
+    """
+    cdef Py_ssize_t ndets = dets.shape[0]
+    scores = dets[:, 4]
+    if 0 < pre_nms_top_n < ndets:
+        # sorted by index first so that ties keep the order of a full stable sort
+        order = np.sort(np.argpartition(-scores, pre_nms_top_n - 1)[:pre_nms_top_n])
+        order = order[np.argsort(-scores[order], kind='mergesort')]
+    else:
+        order = np.argsort(-scores, kind='mergesort')
+    order = order.astype(np.intp)
+
+    # coordinates as rows so that the sweep reads contiguous memory
+    cdef np.float32_t[:, ::1] b = np.ascontiguousarray(dets[order, :4].T)
+    cdef np.float32_t[::1] areas = np.ascontiguousarray((dets[order, 2] - dets[order, 0] + 1) *
+                                                        (dets[order, 3] - dets[order, 1] + 1))
+    cdef Py_ssize_t n = order.shape[0]
+    cdef Py_ssize_t max_keep = post_nms_top_n if 0 < post_nms_top_n < n else n
+    cdef np.uint8_t[::1] suppressed = np.zeros(n, dtype=np.uint8)
+    cdef Py_ssize_t[::1] keep = np.zeros(n, dtype=np.intp)
+    cdef Py_ssize_t nkeep = 0
+    cdef Py_ssize_t i, c, nchunks
+    cdef Py_ssize_t chunk = chunk_size if chunk_size > 0 else n
+
+    with nogil:
+        for i in range(n):
+            if suppressed[i]:
+                continue
+            keep[nkeep] = i
+            nkeep = nkeep + 1
+            if nkeep >= max_keep:
+                break
+            nchunks = (n - i - 1 + chunk - 1) / chunk
+            if nchunks <= 1:
+                _suppress(b, areas, suppressed, i, i + 1, n, thresh)
+            else:
+                for c in prange(nchunks, schedule='static'):
+                    _suppress(b, areas, suppressed, i, i + 1 + c * chunk,
+                              i + 1 + (c + 1) * chunk if i + 1 + (c + 1) * chunk < n else n, thresh)
+
+    return order[np.asarray(keep)[:nkeep]]
@@ -1,7 +1,14 @@
 import numpy as np
 
-from cpu_nms import cpu_nms
-from gpu_nms import gpu_nms
+from cpu_nms import cpu_nms, cpu_batched_nms, cpu_soft_nms, cpu_matrix_nms, cpu_nms_topn
+try:
+    from gpu_nms import gpu_nms
+except ImportError:
+    # cpu only build, e.g. setup_windows.py
+    gpu_nms = None
+
+# greedy nms, soft nms (Bodla et al. 2017) and matrix nms (Wang et al. 2020) with linear or gaussian decay
+NMS_TYPES = ['nms', 'soft_linear', 'soft_gaussian', 'matrix_linear', 'matrix_gaussian']
 
 def py_nms_wrapper(thresh):
     def _nms(dets):
@@ -15,12 +22,46 @@ def cpu_nms_wrapper(thresh):
     return _nms
 
 
+def batched_nms_wrapper(thresh, max_per_image=0):
+    def _nms(dets, labels, images=None):
+        return batched_nms(dets, labels, thresh, images, max_per_image)
+    return _nms
+
+
 def gpu_nms_wrapper(thresh, device_id):
+    assert gpu_nms is not None, 'gpu_nms is not built, run nms on cpu'
     def _nms(dets):
         return gpu_nms(dets, thresh, device_id)
     return _nms
 
 
+def soft_nms_wrapper(nms_type, thresh, sigma=0.5, score_thresh=0.001):
+    """
+    soft or matrix nms of one set of boxes
+    the returned function writes the decayed scores into dets[:, 4] and returns the indexes to keep,
+    sorted by descending decayed score
+    """
+    def _nms(dets):
+        labels = np.zeros((dets.shape[0],), dtype=np.int32)
+        keep, new_scores = soft_nms(dets, labels, nms_type, thresh, sigma, score_thresh)
+        dets[:, 4] = new_scores
+        return keep
+    return _nms
+
+
+def nms_wrapper_by_type(nms_type, thresh, device_id=None, sigma=0.5, score_thresh=0.001):
+    """
+    nms function of config.TEST.NMS_TYPE
+    :param nms_type: 'nms', 'soft_linear', 'soft_gaussian', 'matrix_linear' or 'matrix_gaussian'
+    :param device_id: gpu used by greedy nms, None for cpu
+    """
+    if nms_type == 'nms':
+        if device_id is None:
+            return cpu_nms_wrapper(thresh)
+        return gpu_nms_wrapper(thresh, device_id)
+    return soft_nms_wrapper(nms_type, thresh, sigma, score_thresh)
+
+
 def nms(dets, thresh):
     """
     greedily select boxes with high confidence and overlap with current maximum <= thresh
@@ -59,3 +100,78 @@ def nms(dets, thresh):
         order = order[inds + 1]
 
     return keep
+
+
+def batched_nms(dets, labels, thresh, images=None, max_per_image=0):
+    """
+    nms of every label of one or more images in a single call, boxes only suppress boxes with the same label
+    :param dets: [[x1, y1, x2, y2 score]]
+    :param labels: [N] group of each box, e.g. class, or image * num_classes + class for a batch of images
+    :param thresh: retain overlap <= thresh, same as nms
+    :param images: [N] image of each box for max_per_image, None for a single image
+    :param max_per_image: limit detections of each image as in pred_eval, 0 to disable
+    :return: indexes to keep, sorted by label and then by descending score
+    """
+    dets = np.ascontiguousarray(dets, dtype=np.float64)
+    labels = np.ascontiguousarray(labels, dtype=np.int32)
+    if images is None:
+        images = np.zeros(labels.shape, dtype=np.int32)
+    else:
+        images = np.ascontiguousarray(images, dtype=np.int32)
+    return cpu_batched_nms(dets, labels, images, thresh, max_per_image)
+
+
+def soft_nms(dets, labels, nms_type, thresh, sigma=0.5, score_thresh=0.001):
+    """
+    soft nms or matrix nms of every label, boxes only decay boxes with the same label
+    :param dets: [[x1, y1, x2, y2 score]]
+    :param labels: [N] group of each box
+    :param nms_type: 'soft_linear', 'soft_gaussian', 'matrix_linear' or 'matrix_gaussian'
+    :param thresh: overlap above which soft_linear decays scores, unused by the other types
+    :param sigma: gaussian width
+    :param score_thresh: drop boxes whose decayed score falls below it
+    :return: indexes to keep sorted by label and then by descending decayed score, decayed scores of all boxes
+    """
+    assert nms_type in NMS_TYPES and nms_type != 'nms', 'unknown nms type {}'.format(nms_type)
+    dets = np.ascontiguousarray(dets, dtype=np.float64)
+    labels = np.ascontiguousarray(labels, dtype=np.int32)
+    method = 1 if nms_type.endswith('linear') else 2
+    if nms_type.startswith('soft'):
+        return cpu_soft_nms(dets, labels, thresh, sigma, score_thresh, method)
+    return cpu_matrix_nms(dets, labels, sigma, score_thresh, method)
+
+
+def multiclass_nms(scores, boxes, thresh, score_thresh=0., max_per_image=0, class_agnostic=False,
+                   nms_type='nms', sigma=0.5, soft_score_thresh=0.001):
+    """
+    per class nms and max_per_image selection of one image, equal to running nms on every class
+    :param scores: [N, num_classes] including background at 0
+    :param boxes: [N, 8] if class_agnostic else [N, 4 * num_classes]
+    :param thresh: nms overlap threshold
+    :param score_thresh: keep boxes with score > score_thresh
+    :param max_per_image: limit detections over all classes, 0 to disable
+    :param class_agnostic: use boxes[:, 4:8] for all classes
+    :param nms_type: one of NMS_TYPES, soft and matrix nms return decayed scores
+    :param sigma: gaussian width of soft and matrix nms
+    :param soft_score_thresh: soft and matrix nms drop boxes whose decayed score falls below it
+    :return: list of [[x1, y1, x2, y2 score]] for each class, background included and empty
+    """
+    num_classes = scores.shape[1]
+    inds, labels = np.where(scores[:, 1:] > score_thresh)
+    labels += 1
+    if class_agnostic:
+        cls_boxes = boxes[inds, 4:8]
+    else:
+        cls_boxes = boxes[inds[:, np.newaxis], labels[:, np.newaxis] * 4 + np.arange(4)]
+    dets = np.hstack((cls_boxes, scores[inds, labels][:, np.newaxis]))
+
+    if nms_type == 'nms':
+        keep = batched_nms(dets, labels, thresh, max_per_image=max_per_image)
+    else:
+        keep, dets[:, 4] = soft_nms(dets, labels, nms_type, thresh, sigma, soft_score_thresh)
+        if 0 < max_per_image < len(keep):
+            image_thresh = np.sort(dets[keep, 4])[-max_per_image]
+            keep = keep[dets[keep, 4] >= image_thresh]
+    dets = dets[keep, :]
+    bounds = np.searchsorted(labels[keep], np.arange(num_classes + 1))
+    return [dets[bounds[j]:bounds[j + 1], :] for j in range(num_classes)]
@@ -111,7 +111,9 @@ ext_modules = [
     Extension(
         "cpu_nms",
         ["cpu_nms.pyx"],
-        extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function"]},
+        # openmp runs soft nms and matrix nms in parallel
+        extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function", "-fopenmp"]},
+        extra_link_args=['-fopenmp'],
         include_dirs = [numpy_include]
     ),
     Extension('gpu_nms',
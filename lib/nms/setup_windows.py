@@ -132,7 +132,8 @@ ext_modules = [
     Extension(
         "cpu_nms",
         sources=["cpu_nms.pyx"],
-        extra_compile_args={'gcc': []},
+        # openmp runs soft nms and matrix nms in parallel
+        extra_compile_args={'gcc': ['/openmp']},
         include_dirs = [numpy_include],
     ),
 ]
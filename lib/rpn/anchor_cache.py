@@ -0,0 +1,132 @@
+"""
+LRU caches of anchor grids and feature map shapes.
+With aspect grouping only a few padded data shapes occur in training, so the shifted anchors,
+the anchors inside the image and the feature shape inferred from the symbol are computed once
+per shape and shared by assign_anchor, the proposal operator and AnchorLoader.
+Cached arrays are read-only.
+"""
+
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from generate_anchor import generate_anchors
+
+
+class LRUCache(object):
+    def __init__(self, capacity=32):
+        """
+        :param capacity: number of entries kept, least recently used ones are dropped first
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, create):
+        """
+        :param key: hashable key
+        :param create: function computing the value on a miss
+        :return: cached value
+        """
+        with self.lock:
+            if key in self.entries:
+                # move to the most recently used end
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = create()
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+_anchor_cache = LRUCache()
+_feat_shape_cache = LRUCache()
+
+
+def _read_only(array):
+    array.flags.writeable = False
+    return array
+
+
+def _anchor_key(feat_stride, scales, ratios):
+    return int(feat_stride), tuple(np.asarray(scales).ravel().tolist()), tuple(np.asarray(ratios).ravel().tolist())
+
+
+def get_shifted_anchors(feat_height, feat_width, feat_stride, scales, ratios):
+    """
+    anchors of every cell of a feature map
+    :param scales: anchor scales, base anchors are generated with their dtype
+    :param ratios: anchor aspect ratios
+    :return: [feat_height * feat_width * A, 4] anchors ordered by (h, w, a)
+    """
+    key = ('shifted', int(feat_height), int(feat_width)) + _anchor_key(feat_stride, scales, ratios)
+
+    def create():
+        base_anchors = generate_anchors(base_size=feat_stride, ratios=list(ratios), scales=scales)
+        shift_x = np.arange(0, feat_width) * feat_stride
+        shift_y = np.arange(0, feat_height) * feat_stride
+        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
+        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())).transpose()
+        # add A anchors (1, A, 4) to
+        # cell K shifts (K, 1, 4) to get
+        # shift anchors (K, A, 4)
+        # reshape to (K*A, 4) shifted anchors
+        A = base_anchors.shape[0]
+        K = shifts.shape[0]
+        all_anchors = base_anchors.reshape((1, A, 4)) + shifts.reshape((1, K, 4)).transpose((1, 0, 2))
+        return _read_only(all_anchors.reshape((K * A, 4)))
+
+    return _anchor_cache.get(key, create)
+
+
+def get_inside_anchors(feat_height, feat_width, im_height, im_width, feat_stride, scales, ratios, allowed_border):
+    """
+    anchors of a feature map that lie inside an image
+    :param im_height: image height as in im_info
+    :param im_width: image width as in im_info
+    :param allowed_border: keep anchors crossing the image edge by at most allowed_border
+    :return: all anchors as get_shifted_anchors, indexes of the inside ones, inside anchors
+    """
+    key = ('inside', int(feat_height), int(feat_width), float(im_height), float(im_width), allowed_border) + \
+          _anchor_key(feat_stride, scales, ratios)
+
+    def create():
+        all_anchors = get_shifted_anchors(feat_height, feat_width, feat_stride, scales, ratios)
+        inds_inside = np.where((all_anchors[:, 0] >= -allowed_border) &
+                               (all_anchors[:, 1] >= -allowed_border) &
+                               (all_anchors[:, 2] < im_width + allowed_border) &
+                               (all_anchors[:, 3] < im_height + allowed_border))[0]
+        return all_anchors, _read_only(inds_inside), _read_only(all_anchors[inds_inside, :])
+
+    return _anchor_cache.get(key, create)
+
+
+def infer_feat_shape(feat_sym, data_shape):
+    """
+    output shape of feat_sym, cached by symbol and input shapes
+    :param feat_sym: symbol of the rpn feature map
+    :param data_shape: dict of input name to shape
+    :return: list of int feature shape
+    """
+    # output names are shared by different networks, so the symbol object itself is the key,
+    # the entry keeps a reference to it so that its id is not reused while the entry exists
+    key = (id(feat_sym), tuple(sorted((k, tuple(v)) for k, v in data_shape.items())))
+
+    def create():
+        _, feat_shape, _ = feat_sym.infer_shape(**data_shape)
+        return feat_sym, [int(i) for i in feat_shape[0]]
+
+    return list(_feat_shape_cache.get(key, create)[1])
@@ -15,7 +15,8 @@ import numpy.random as npr
 
 from utils.image import get_image, tensor_vstack
 from generate_anchor import generate_anchors
-from bbox.bbox_transform import bbox_overlaps, bbox_transform
+from anchor_cache import get_inside_anchors
+from bbox.bbox_transform import anchor_overlaps, bbox_transform
 
 
 def get_rpn_testbatch(roidb, cfg):
@@ -36,14 +37,15 @@ def get_rpn_testbatch(roidb, cfg):
     return data, label, im_info
 
 
-def get_rpn_batch(roidb, cfg):
+def get_rpn_batch(roidb, cfg, rng=None):
     """
     prototype for rpn batch: data, im_info, gt_boxes
     :param roidb: ['image', 'flipped'] + ['gt_boxes', 'boxes', 'gt_classes']
+    :param rng: np.random.RandomState choosing the scale, the global random module if None
     :return: data, label
     """
     assert len(roidb) == 1, 'Single batch only'
-    imgs, roidb = get_image(roidb, cfg)
+    imgs, roidb = get_image(roidb, cfg, rng)
     im_array = imgs[0]
     im_info = np.array([roidb[0]['im_info']], dtype=np.float32)
 
@@ -64,7 +66,7 @@ def get_rpn_batch(roidb, cfg):
 
 
 def assign_anchor(feat_shape, gt_boxes, im_info, cfg, feat_stride=16,
-                  scales=(8, 16, 32), ratios=(0.5, 1, 2), allowed_border=0):
+                  scales=(8, 16, 32), ratios=(0.5, 1, 2), allowed_border=0, rng=None):
     """
     assign ground truth boxes to anchor positions
     :param feat_shape: infer output shape
@@ -74,6 +76,7 @@ def assign_anchor(feat_shape, gt_boxes, im_info, cfg, feat_stride=16,
     :param scales: used to generate anchors, affects num_anchors (per location)
     :param ratios: aspect ratios of generated anchors
     :param allowed_border: filter out anchors with edge overlap > allowed_border
+    :param rng: np.random.RandomState subsampling the labels, the global numpy.random if None
     :return: dict of label
     'label': of shape (batch_size, 1) <- (batch_size, num_anchors, feat_height, feat_width)
     'bbox_target': of shape (batch_size, num_anchors * 4, feat_height, feat_width)
@@ -93,13 +96,15 @@ def assign_anchor(feat_shape, gt_boxes, im_info, cfg, feat_stride=16,
         return ret
 
     DEBUG = False
+    if rng is None:
+        rng = npr
     im_info = im_info[0]
     scales = np.array(scales, dtype=np.float32)
-    base_anchors = generate_anchors(base_size=feat_stride, ratios=list(ratios), scales=scales)
-    num_anchors = base_anchors.shape[0]
+    num_anchors = len(ratios) * len(scales)
     feat_height, feat_width = feat_shape[-2:]
 
     if DEBUG:
+        base_anchors = generate_anchors(base_size=feat_stride, ratios=list(ratios), scales=scales)
         print 'anchors:'
         print base_anchors
         print 'anchor shapes:'
@@ -111,32 +116,15 @@ def assign_anchor(feat_shape, gt_boxes, im_info, cfg, feat_stride=16,
         print 'gt_boxes', gt_boxes
 
     # 1. generate proposals from bbox deltas and shifted anchors
-    shift_x = np.arange(0, feat_width) * feat_stride
-    shift_y = np.arange(0, feat_height) * feat_stride
-    shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())).transpose()
-    # add A anchors (1, A, 4) to
-    # cell K shifts (K, 1, 4) to get
-    # shift anchors (K, A, 4)
-    # reshape to (K*A, 4) shifted anchors
+    # only keep anchors inside the image, both cached by feature and image shape
     A = num_anchors
-    K = shifts.shape[0]
-    all_anchors = base_anchors.reshape((1, A, 4)) + shifts.reshape((1, K, 4)).transpose((1, 0, 2))
-    all_anchors = all_anchors.reshape((K * A, 4))
+    K = feat_height * feat_width
     total_anchors = int(K * A)
-
-    # only keep anchors inside the image
-    inds_inside = np.where((all_anchors[:, 0] >= -allowed_border) &
-                           (all_anchors[:, 1] >= -allowed_border) &
-                           (all_anchors[:, 2] < im_info[1] + allowed_border) &
-                           (all_anchors[:, 3] < im_info[0] + allowed_border))[0]
+    all_anchors, inds_inside, anchors = get_inside_anchors(feat_height, feat_width, im_info[0], im_info[1],
+                                                           feat_stride, scales, ratios, allowed_border)
     if DEBUG:
         print 'total_anchors', total_anchors
         print 'inds_inside', len(inds_inside)
-
-    # keep only inside anchors
-    anchors = all_anchors[inds_inside, :]
-    if DEBUG:
         print 'anchors shape', anchors.shape
 
     # label: 1 is positive, 0 is negative, -1 is dont care
@@ -145,13 +133,32 @@ def assign_anchor(feat_shape, gt_boxes, im_info, cfg, feat_stride=16,
 
     if gt_boxes.size > 0:
         # overlap between the anchors and the gt boxes
-        # overlaps (ex, gt)
-        overlaps = bbox_overlaps(anchors.astype(np.float), gt_boxes.astype(np.float))
-        argmax_overlaps = overlaps.argmax(axis=1)
-        max_overlaps = overlaps[np.arange(len(inds_inside)), argmax_overlaps]
-        gt_argmax_overlaps = overlaps.argmax(axis=0)
-        gt_max_overlaps = overlaps[gt_argmax_overlaps, np.arange(overlaps.shape[1])]
-        gt_argmax_overlaps = np.where(overlaps == gt_max_overlaps)[0]
+        # only intersecting (ex, gt) pairs are computed, the rest of the dense overlap matrix is 0
+        ex_inds, gt_inds, pair_overlaps = anchor_overlaps(all_anchors, feat_height, feat_width, A, feat_stride,
+                                                          gt_boxes[:, :4])
+        inside_pos = np.empty((total_anchors,), dtype=np.int)
+        inside_pos.fill(-1)
+        inside_pos[inds_inside] = np.arange(len(inds_inside))
+        ex_inds = inside_pos[ex_inds]
+        is_inside = ex_inds >= 0
+        ex_inds, gt_inds, pair_overlaps = ex_inds[is_inside], gt_inds[is_inside], pair_overlaps[is_inside]
+
+        # max over each row, ties go to the lowest gt as in argmax, rows without pairs are 0 at gt 0
+        order = np.lexsort((gt_inds, -pair_overlaps, ex_inds))
+        first = order[np.r_[True, ex_inds[order][1:] != ex_inds[order][:-1]]] if len(order) else order
+        argmax_overlaps = np.zeros((len(inds_inside),), dtype=np.int)
+        argmax_overlaps[ex_inds[first]] = gt_inds[first]
+        max_overlaps = np.zeros((len(inds_inside),), dtype=np.float)
+        max_overlaps[ex_inds[first]] = pair_overlaps[first]
+
+        # anchors reaching the max overlap of any gt
+        gt_max_overlaps = np.zeros((gt_boxes.shape[0],), dtype=np.float)
+        np.maximum.at(gt_max_overlaps, gt_inds, pair_overlaps)
+        if np.any(gt_max_overlaps == 0):
+            # a gt overlapping no anchor has max overlap 0, which every anchor reaches
+            gt_argmax_overlaps = np.arange(len(inds_inside))
+        else:
+            gt_argmax_overlaps = ex_inds[pair_overlaps == gt_max_overlaps[gt_inds]]
 
         if not cfg.TRAIN.RPN_CLOBBER_POSITIVES:
             # assign bg labels first so that positive labels can clobber them
@@ -173,7 +180,7 @@ def assign_anchor(feat_shape, gt_boxes, im_info, cfg, feat_stride=16,
     num_fg = int(cfg.TRAIN.RPN_FG_FRACTION * cfg.TRAIN.RPN_BATCH_SIZE)
     fg_inds = np.where(labels == 1)[0]
     if len(fg_inds) > num_fg:
-        disable_inds = npr.choice(fg_inds, size=(len(fg_inds) - num_fg), replace=False)
+        disable_inds = rng.choice(fg_inds, size=(len(fg_inds) - num_fg), replace=False)
         if DEBUG:
             disable_inds = fg_inds[:(len(fg_inds) - num_fg)]
         labels[disable_inds] = -1
@@ -182,7 +189,7 @@ def assign_anchor(feat_shape, gt_boxes, im_info, cfg, feat_stride=16,
     num_bg = cfg.TRAIN.RPN_BATCH_SIZE - np.sum(labels == 1)
     bg_inds = np.where(labels == 0)[0]
     if len(bg_inds) > num_bg:
-        disable_inds = npr.choice(bg_inds, size=(len(bg_inds) - num_bg), replace=False)
+        disable_inds = rng.choice(bg_inds, size=(len(bg_inds) - num_bg), replace=False)
         if DEBUG:
             disable_inds = bg_inds[:(len(bg_inds) - num_bg)]
         labels[disable_inds] = -1
@@ -7,9 +7,12 @@
 # --------------------------------------------------------
 
 
+import sys
+import time
+import logging
+import threading
 import mxnet as mx
 from mxnet.io import DataDesc, DataBatch
-import threading
 
 
 class PrefetchingIter(mx.io.DataIter):
@@ -27,53 +30,125 @@ class PrefetchingIter(mx.io.DataIter):
         in iter[i].provide_data
     rename_label : None or list of dict
         Similar to rename_data
+    prefetch_depth : int
+        maximum number of batches produced ahead of the consumer
+    num_workers : int
+        number of producer threads. More than one worker requires the wrapped
+        iter to provide "next_cursor" and "get_batch_at", so that a batch can
+        be claimed in order and built outside the lock
+
+    Batches are always returned in the order of the wrapped iter. Queue
+    occupancy and producer/consumer wait time are available from get_stats().
 
     Examples
     --------
     iter = PrefetchingIter([NDArrayIter({'data': X1}), NDArrayIter({'data': X2})],
                            rename_data=[{'data': 'data1'}, {'data': 'data2'}])
     """
-    def __init__(self, iters, rename_data=None, rename_label=None):
+    def __init__(self, iters, rename_data=None, rename_label=None, prefetch_depth=1, num_workers=1):
         super(PrefetchingIter, self).__init__()
         if not isinstance(iters, list):
             iters = [iters]
         self.n_iter = len(iters)
         assert self.n_iter ==1, "Our prefetching iter only support 1 DataIter"
+        assert prefetch_depth >= 1, "prefetch_depth must be at least 1"
+        assert num_workers == 1 or (hasattr(iters[0], 'next_cursor') and hasattr(iters[0], 'get_batch_at')), \
+            "multiple workers need an iter with next_cursor and get_batch_at"
         self.iters = iters
         self.rename_data = rename_data
         self.rename_label = rename_label
+        self.prefetch_depth = prefetch_depth
+        self.num_workers = num_workers
         self.batch_size = len(self.provide_data) * self.provide_data[0][0][1][0]
-        self.data_ready = [threading.Event() for i in range(self.n_iter)]
-        self.data_taken = [threading.Event() for i in range(self.n_iter)]
-        for e in self.data_taken:
-            e.set()
+        self.current_batch = None
+
+        # produced batches keyed by sequence number, guarded by self.cond
+        self.cond = threading.Condition()
+        self.next_batch = {}
+        self.prefetch_threads = []
+        self.reset_stats()
+        self._start()
+
+    def __del__(self):
+        self._stop()
+
+    def _start(self):
         self.started = True
-        self.current_batch = [None for _ in range(self.n_iter)]
-        self.next_batch = [None for _ in range(self.n_iter)]
-        def prefetch_func(self, i):
+        self.exhausted = False
+        self.error = None
+        self.produce_seq = 0
+        self.consume_seq = 0
+        self.next_batch = {}
+
+        def prefetch_func(self):
             """Thread entry"""
+            it = self.iters[0]
             while True:
-                self.data_taken[i].wait()
-                if not self.started:
-                    break
+                tic = time.time()
+                with self.cond:
+                    while self.started and not self.exhausted and \
+                            self.produce_seq - self.consume_seq >= self.prefetch_depth:
+                        self.cond.wait()
+                    self.producer_wait += time.time() - tic
+                    if not self.started or self.exhausted:
+                        return
+                    seq = self.produce_seq
+                    self.produce_seq += 1
+                    cursor = None
+                    try:
+                        if self.num_workers > 1:
+                            cursor = it.next_cursor()
+                    except Exception:
+                        self.error = sys.exc_info()
+                        self.started = False
+                        self.cond.notify_all()
+                        return
+                    if self.num_workers > 1 and cursor is None:
+                        self.exhausted = True
+                        self.next_batch[seq] = None
+                        self.cond.notify_all()
+                        return
                 try:
-                    self.next_batch[i] = self.iters[i].next()
+                    if cursor is None:
+                        batch = it.next()
+                    else:
+                        batch = it.get_batch_at(cursor)
                 except StopIteration:
-                    self.next_batch[i] = None
-                self.data_taken[i].clear()
-                self.data_ready[i].set()
-        self.prefetch_threads = [threading.Thread(target=prefetch_func, args=[self, i]) \
-                                 for i in range(self.n_iter)]
+                    batch = None
+                except Exception:
+                    with self.cond:
+                        self.error = sys.exc_info()
+                        self.started = False
+                        self.cond.notify_all()
+                    return
+                with self.cond:
+                    if batch is None:
+                        self.exhausted = True
+                    self.next_batch[seq] = batch
+                    self.cond.notify_all()
+                    if batch is None:
+                        return
+
+        self.prefetch_threads = [threading.Thread(target=prefetch_func, args=[self]) \
+                                 for i in range(self.num_workers)]
         for thread in self.prefetch_threads:
             thread.setDaemon(True)
             thread.start()
 
-    def __del__(self):
-        self.started = False
-        for e in self.data_taken:
-            e.set()
+    def _stop(self):
+        with self.cond:
+            self.started = False
+            self.cond.notify_all()
         for thread in self.prefetch_threads:
             thread.join()
+        self.prefetch_threads = []
+
+    def close(self):
+        """stop the producers, then release the resources of the wrapped iters that have a close method"""
+        self._stop()
+        for i in self.iters:
+            if hasattr(i, 'close'):
+                i.close()
 
     @property
     def provide_data(self):
@@ -100,27 +175,61 @@ class PrefetchingIter(mx.io.DataIter):
             ] for r, i in zip(self.rename_label, self.iters)], [])
 
     def reset(self):
-        for e in self.data_ready:
-            e.wait()
+        self._stop()
+        if self.num_batches > 0:
+            logging.info('prefetch stats: %s', self.stats_str())
+            self.reset_stats()
         for i in self.iters:
             i.reset()
-        for e in self.data_ready:
-            e.clear()
-        for e in self.data_taken:
-            e.set()
+        self._start()
+
+    def reset_stats(self):
+        self.num_batches = 0
+        self.occupancy = 0
+        self.producer_wait = 0.0
+        self.consumer_wait = 0.0
+
+    def get_stats(self):
+        """
+        summary of the prefetch queue since the last reset_stats
+        :return: dict of mean queue occupancy and total producer/consumer wait in seconds
+        """
+        return {'num_batches': self.num_batches,
+                'mean_occupancy': self.occupancy / float(max(self.num_batches, 1)),
+                'prefetch_depth': self.prefetch_depth,
+                'producer_wait': self.producer_wait,
+                'consumer_wait': self.consumer_wait}
+
+    def stats_str(self):
+        stats = self.get_stats()
+        return 'batches %d, queue %.2f/%d, producer wait %.3fs, consumer wait %.3fs' % \
+               (stats['num_batches'], stats['mean_occupancy'], stats['prefetch_depth'],
+                stats['producer_wait'], stats['consumer_wait'])
 
     def iter_next(self):
-        for e in self.data_ready:
-            e.wait()
-        if self.next_batch[0] is None:
+        tic = time.time()
+        with self.cond:
+            self.occupancy += len(self.next_batch)
+            while self.consume_seq not in self.next_batch and self.error is None:
+                self.cond.wait()
+            self.consumer_wait += time.time() - tic
+            if self.consume_seq not in self.next_batch:
+                error = self.error
+            else:
+                error = None
+                batch = self.next_batch[self.consume_seq]
+                if batch is not None:
+                    del self.next_batch[self.consume_seq]
+                    self.consume_seq += 1
+                    self.num_batches += 1
+                    self.cond.notify_all()
+        if error is not None:
+            self._stop()
+            raise error[0], error[1], error[2]
+        if batch is None:
             return False
-        else:
-            self.current_batch = self.next_batch[0]
-            for e in self.data_ready:
-                e.clear()
-            for e in self.data_taken:
-                e.set()
-            return True
+        self.current_batch = batch
+        return True
 
     def next(self):
         if self.iter_next():
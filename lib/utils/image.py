@@ -4,40 +4,68 @@ import cv2
 import random
 from PIL import Image
 from bbox.bbox_transform import clip_boxes
+from utils.image_cache import get_image_cache
 
 
 # TODO: This two functions should be merged with individual data loader
-def get_image(roidb, config):
+def get_image(roidb, config, rng=None):
     """
     preprocess image and return processed roidb
     :param roidb: a list of roidb
+    :param rng: np.random.RandomState choosing the scales, the global random module if None
     :return: list of img as in mxnet format
     roidb add new item['im_info']
     0 --- x (width, second dim of im)
     |
     y (height, first dim of im)
     """
+    ims, processed_roidb = load_images(roidb, config, rng)
+    processed_ims = [transform(im, config.network.PIXEL_MEANS) for im in ims]
+    return processed_ims, processed_roidb
+
+
+def get_image_batch(roidb, config):
+    """
+    preprocess images straight into one zero padded batch tensor,
+    equal to tensor_vstack of the images from get_image
+    :param roidb: a list of roidb
+    :return: [num_images, channel, height, width] float32 tensor, processed roidb
+    """
+    ims, processed_roidb = load_images(roidb, config)
+    max_height = max([im.shape[0] for im in ims])
+    max_width = max([im.shape[1] for im in ims])
+    im_array = np.zeros((len(ims), 3, max_height, max_width), dtype=np.float32)
+    for i, im in enumerate(ims):
+        transform(im, config.network.PIXEL_MEANS, out=im_array[i:i + 1, :, :im.shape[0], :im.shape[1]])
+    return im_array, processed_roidb
+
+
+def load_images(roidb, config, rng=None):
+    """
+    read and resize images of roidb, fill in im_info and rescaled boxes
+    :param roidb: a list of roidb
+    :param rng: np.random.RandomState choosing the scales, the global random module if None
+    :return: list of resized BGR images, processed roidb
+    """
     num_images = len(roidb)
-    processed_ims = []
+    ims = []
     processed_roidb = []
+    cache = get_image_cache(config)
     for i in range(num_images):
         roi_rec = roidb[i]
-        assert os.path.exists(roi_rec['image']), '%s does not exist'.format(roi_rec['image'])
-        im = cv2.imread(roi_rec['image'], cv2.IMREAD_COLOR|cv2.IMREAD_IGNORE_ORIENTATION)
-        if roidb[i]['flipped']:
-            im = im[:, ::-1, :]
         new_rec = roi_rec.copy()
-        scale_ind = random.randrange(len(config.SCALES))
-        target_size = config.SCALES[scale_ind][0]
-        max_size = config.SCALES[scale_ind][1]
-        im, im_scale = resize(im, target_size, max_size, stride=config.network.IMAGE_STRIDE)
-        im_tensor = transform(im, config.network.PIXEL_MEANS)
-        processed_ims.append(im_tensor)
-        im_info = [im_tensor.shape[2], im_tensor.shape[3], im_scale]
+        if rng is None:
+            scale_ind = random.randrange(len(config.SCALES))
+        else:
+            scale_ind = rng.randint(len(config.SCALES))
+        im, im_scale = load_resized(roi_rec['image'], roi_rec['flipped'], scale_ind, config, cache,
+                                    lambda path: cv2.imread(path, cv2.IMREAD_COLOR|cv2.IMREAD_IGNORE_ORIENTATION))
+        ims.append(im)
+        im_info = [im.shape[0], im.shape[1], im_scale]
         new_rec['boxes'] = clip_boxes(np.round(roi_rec['boxes'].copy() * im_scale), im_info[:2])
         new_rec['im_info'] = im_info
         processed_roidb.append(new_rec)
-    return processed_ims, processed_roidb
+    return ims, processed_roidb
 
 
 def get_segmentation_image(segdb, config):
@@ -51,24 +79,21 @@ def get_segmentation_image(segdb, config):
     processed_ims = []
     processed_segdb = []
     processed_seg_cls_gt = []
+    cache = get_image_cache(config)
     for i in range(num_images):
         seg_rec = segdb[i]
-        assert os.path.exists(seg_rec['image']), '%s does not exist'.format(seg_rec['image'])
-        im = np.array(cv2.imread(seg_rec['image']))
-
         new_rec = seg_rec.copy()
 
         scale_ind = random.randrange(len(config.SCALES))
-        target_size = config.SCALES[scale_ind][0]
-        max_size = config.SCALES[scale_ind][1]
-        im, im_scale = resize(im, target_size, max_size, stride=config.network.IMAGE_STRIDE)
+        im, im_scale = load_resized(seg_rec['image'], False, scale_ind, config, cache,
+                                    lambda path: np.array(cv2.imread(path)))
         im_tensor = transform(im, config.network.PIXEL_MEANS)
         im_info = [im_tensor.shape[2], im_tensor.shape[3], im_scale]
         new_rec['im_info'] = im_info
 
-        seg_cls_gt = np.array(Image.open(seg_rec['seg_cls_path']))
-        seg_cls_gt, seg_cls_gt_scale = resize(
-            seg_cls_gt, target_size, max_size, stride=config.network.IMAGE_STRIDE, interpolation=cv2.INTER_NEAREST)
+        seg_cls_gt, seg_cls_gt_scale = load_resized(seg_rec['seg_cls_path'], False, scale_ind, config, cache,
+                                                    lambda path: np.array(Image.open(path)),
+                                                    interpolation=cv2.INTER_NEAREST, kind='seg_cls_gt')
         seg_cls_gt_tensor = transform_seg_gt(seg_cls_gt)
 
         processed_ims.append(im_tensor)
@@ -77,6 +102,37 @@ def get_segmentation_image(segdb, config):
 
     return processed_ims, processed_seg_cls_gt, processed_segdb
 
+def load_resized(image_path, flipped, scale_ind, config, cache=None, imread=cv2.imread,
+                 interpolation=cv2.INTER_LINEAR, kind='image'):
+    """
+    read, flip and resize an image to config.SCALES[scale_ind], going through the image cache if given
+    :param image_path: image file
+    :param flipped: flip horizontally after reading
+    :param scale_ind: index into config.SCALES
+    :param cache: ImageCache or None
+    :param imread: function reading image_path into an uint8 array
+    :param interpolation: passed to resize
+    :param kind: distinguishes cache entries of different reads of the same file
+    :return: resized image (read-only when served from cache), im_scale
+    """
+    target_size = config.SCALES[scale_ind][0]
+    max_size = config.SCALES[scale_ind][1]
+    stride = config.network.IMAGE_STRIDE
+    if cache is not None:
+        key = cache.make_key(image_path, flipped, scale_ind, stride, target_size, max_size, kind)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    assert os.path.exists(image_path), '{} does not exist'.format(image_path)
+    im = imread(image_path)
+    if flipped:
+        im = im[:, ::-1, :]
+    im, im_scale = resize(im, target_size, max_size, stride=stride, interpolation=interpolation)
+    if cache is not None:
+        cache.put(key, im, im_scale)
+    return im, im_scale
+
 def resize(im, target_size, max_size, stride=0, interpolation = cv2.INTER_LINEAR):
     """
     only resize input image to target size and return scale
@@ -102,23 +158,27 @@ def resize(im, target_size, max_size, stride=0, interpolation = cv2.INTER_LINEAR
         # pad to product of stride
         im_height = int(np.ceil(im.shape[0] / float(stride)) * stride)
         im_width = int(np.ceil(im.shape[1] / float(stride)) * stride)
-        im_channel = im.shape[2]
-        padded_im = np.zeros((im_height, im_width, im_channel))
-        padded_im[:im.shape[0], :im.shape[1], :] = im
+        # keep the input dtype, padding with 0 is exact for uint8
+        padded_im = np.zeros((im_height, im_width) + im.shape[2:], dtype=im.dtype)
+        padded_im[:im.shape[0], :im.shape[1]] = im
         return padded_im, im_scale
 
-def transform(im, pixel_means):
+def transform(im, pixel_means, out=None):
     """
     transform into mxnet tensor
     substract pixel size and transform to correct format
+    the subtraction runs in float64 and is rounded once to float32 when written to out,
+    which matches converting the float64 tensor with mx.nd.array
     :param im: [height, width, channel] in BGR
     :param pixel_means: [B, G, R pixel means]
+    :param out: optional float32 [1, channel, height, width] view to write into, e.g. a slice of a batch
     :return: [batch, channel, height, width]
     """
-    im_tensor = np.zeros((1, 3, im.shape[0], im.shape[1]))
-    for i in range(3):
-        im_tensor[0, i, :, :] = im[:, :, 2 - i] - pixel_means[2 - i]
-    return im_tensor
+    if out is None:
+        out = np.empty((1, 3, im.shape[0], im.shape[1]), dtype=np.float32)
+    pixel_means = np.asarray(pixel_means, dtype=np.float64)
+    np.subtract(im[:, :, ::-1].transpose((2, 0, 1)), pixel_means[::-1].reshape((3, 1, 1)), out=out[0])
+    return out
 
 def transform_seg_gt(gt):
     """
@@ -126,7 +186,7 @@ def transform_seg_gt(gt):
     :param gt: [height, width, channel = 1]
     :return: [batch, channel = 1, height, width]
     """
-    gt_tensor = np.zeros((1, 1, gt.shape[0], gt.shape[1]))
+    gt_tensor = np.empty((1, 1, gt.shape[0], gt.shape[1]), dtype=np.float32)
     gt_tensor[0, 0, :, :] = gt[:, :]
 
     return gt_tensor
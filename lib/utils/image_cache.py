@@ -0,0 +1,121 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The Apache-2.0 License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+On-disk cache of decoded and resized images.
+Each entry is a uint8 .npy file (memory mapped on read, so loader processes share pages)
+and a .scale file holding the resize factor. Entries are evicted in LRU order (file mtime,
+refreshed on every hit) once the cache grows beyond max_size megabytes.
+"""
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+_caches = {}
+
+
+def get_image_cache(config):
+    """
+    return the ImageCache configured by config.IMAGE_CACHE, None if caching is disabled
+    """
+    cache_cfg = config.get('IMAGE_CACHE')
+    if cache_cfg is None or not cache_cfg.PATH:
+        return None
+    if cache_cfg.PATH not in _caches:
+        _caches[cache_cfg.PATH] = ImageCache(cache_cfg.PATH, cache_cfg.MAX_SIZE)
+    return _caches[cache_cfg.PATH]
+
+
+class ImageCache(object):
+    def __init__(self, cache_path, max_size=0):
+        """
+        :param cache_path: directory of cache entries, shared between processes
+        :param max_size: size cap in megabytes, 0 for unlimited
+        """
+        self.cache_path = cache_path
+        self.max_bytes = int(max_size * 1024 * 1024)
+        if not os.path.exists(cache_path):
+            try:
+                os.makedirs(cache_path)
+            except OSError:
+                # created by another loader process
+                pass
+        self.cur_bytes = sum([size for _, size, _ in self._entries()])
+
+    @staticmethod
+    def make_key(image_path, flipped, scale_ind, stride, target_size, max_size, kind='image'):
+        """ key of an image resized to config.SCALES[scale_ind] and padded to stride """
+        return '%s|%s|%d|%d|%d|%d|%s' % (os.path.abspath(image_path), bool(flipped), scale_ind, stride,
+                                         target_size, max_size, kind)
+
+    def _path(self, key):
+        return os.path.join(self.cache_path, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _entries(self):
+        """ list of (path prefix, size in bytes, mtime) of complete entries """
+        entries = []
+        for name in os.listdir(self.cache_path):
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.cache_path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path[:-len('.npy')], st.st_size, st.st_mtime))
+        return entries
+
+    def get(self, key):
+        """
+        :param key: from make_key
+        :return: (read-only uint8 image, im_scale) or None on miss
+        """
+        path = self._path(key)
+        try:
+            with open(path + '.scale') as f:
+                im_scale = float(f.read())
+            im = np.load(path + '.npy', mmap_mode='r')
+            os.utime(path + '.npy', None)
+        except (IOError, OSError, ValueError):
+            return None
+        return im, im_scale
+
+    def put(self, key, im, im_scale):
+        """
+        store an image, written to a temporary file first so readers never see partial entries
+        :param im: resized image, values must fit uint8
+        """
+        path = self._path(key)
+        im = np.ascontiguousarray(im, dtype=np.uint8)
+        fd, tmp = tempfile.mkstemp(dir=self.cache_path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(repr(float(im_scale)))
+        os.rename(tmp, path + '.scale')
+        fd, tmp = tempfile.mkstemp(dir=self.cache_path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, im)
+        os.rename(tmp, path + '.npy')
+
+        self.cur_bytes += im.nbytes
+        if 0 < self.max_bytes < self.cur_bytes:
+            self.evict()
+
+    def evict(self):
+        """ remove least recently used entries until the cache is 90% of max_size """
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum([size for _, size, _ in entries])
+        for prefix, size, _ in entries:
+            if total <= 0.9 * self.max_bytes:
+                break
+            for ext in ['.npy', '.scale']:
+                try:
+                    os.remove(prefix + ext)
+                except OSError:
+                    pass
+            total -= size
+        self.cur_bytes = total
@@ -9,7 +9,7 @@ from skimage.draw import polygon
 import numpy as np
 import cv2
 from utils.tictoc import tic, toc
-from dataset.pycocotools.mask import encode as encodeMask_c
+from dataset.pycocotools.mask import frPyObjects
 
 def encodeMask(M):
     """
@@ -38,14 +38,55 @@ def encodeMask(M):
             'counts': counts_list,
             }
 
+def encodeBoxMask(box_mask, x1, y1, im_height, im_width):
+    """
+    Run-length encode an image mask that is zero outside a box, working on the box only.
+    :param box_mask: [h, w] bool mask of the box
+    :param x1: column of the top left pixel of the box
+    :param y1: row of the top left pixel of the box
+    :return: counts of the column-major image mask, the same as encoding the full mask
+    """
+    h, w = box_mask.shape
+    # column-major pixels of the box, each column followed by the zeros up to the next column
+    vals = np.zeros((w, h + 1), dtype=np.bool)
+    vals[:, :h] = box_mask.T
+    lens = np.ones((w, h + 1), dtype=np.int64)
+    lens[:, h] = im_height - h
+    vals = vals.ravel()[:-1]
+    lens = lens.ravel()[:-1]
+    # zeros before the box and after its last pixel
+    head = x1 * im_height + y1
+    tail = im_height * im_width - head - lens.sum()
+    vals = np.hstack(([False], vals, [False]))
+    lens = np.hstack(([head], lens, [tail]))
+    keep = lens > 0
+    vals = vals[keep]
+    lens = lens[keep]
+    starts = np.flatnonzero(np.hstack(([True], vals[1:] != vals[:-1])))
+    counts = np.add.reduceat(lens, starts)
+    # if array starts from 1. start with 0 counts for 0
+    if vals[0]:
+        counts = np.hstack(([0], counts))
+    return counts
+
+
 def mask_voc2coco(voc_masks, voc_boxes, im_height, im_width, binary_thresh = 0.4):
+    """
+    compressed RLEs of predicted masks pasted into their boxes, boxes must lie inside the image
+    each mask is encoded from its box, no image sized buffer is allocated
+    :param voc_masks: [N, mask_h, mask_w] mask probabilities
+    :param voc_boxes: [N, 4+] boxes as [x1, y1, x2, y2]
+    :return: list of N RLEs as returned by encode
+    """
     num_pred = len(voc_masks)
     assert(num_pred==voc_boxes.shape[0])
-    mask_img = np.zeros((im_height, im_width, num_pred), dtype=np.uint8, order='F')
+    if num_pred == 0:
+        return []
+    ucRles = []
     for i in xrange(num_pred):
         pred_box = np.round(voc_boxes[i, :4]).astype(int)
         pred_mask = voc_masks[i]
         pred_mask = cv2.resize(pred_mask.astype(np.float32), (pred_box[2] - pred_box[0] + 1, pred_box[3] - pred_box[1] + 1))
-        mask_img[pred_box[1]:pred_box[3]+1, pred_box[0]:pred_box[2]+1, i] = pred_mask >= binary_thresh
-    coco_mask = encodeMask_c(mask_img)
-    return coco_mask
+        counts = encodeBoxMask(pred_mask >= binary_thresh, pred_box[0], pred_box[1], im_height, im_width)
+        ucRles.append({'size': [im_height, im_width], 'counts': counts})
+    return frPyObjects(ucRles, im_height, im_width)
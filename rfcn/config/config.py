@@ -37,6 +37,14 @@ config.network.FIXED_PARAMS_SHARED = ['gamma', 'beta']
 config.network.ANCHOR_SCALES = (8, 16, 32)
 config.network.ANCHOR_RATIOS = (0.5, 1, 2)
 config.network.NUM_ANCHORS = len(config.network.ANCHOR_SCALES) * len(config.network.ANCHOR_RATIOS)
+# executors of other input shapes than the maximum ones kept for reuse, 0 rebinds on every shape change
+config.network.EXECUTOR_CACHE_SIZE = 8
+
+# on-disk cache of decoded and resized images, empty PATH disables it
+config.IMAGE_CACHE = edict()
+config.IMAGE_CACHE.PATH = ''
+# size cap in MB, least recently used images are evicted beyond it, 0 for unlimited
+config.IMAGE_CACHE.MAX_SIZE = 0
 
 # dataset related params
 config.dataset = edict()
@@ -96,6 +104,22 @@ config.TRAIN.BATCH_IMAGES = 2
 config.TRAIN.END2END = False
 # group images with similar aspect ratio
 config.TRAIN.ASPECT_GROUPING = True
+# number of worker processes building AnchorLoader batches, 0 to build them in the main process
+config.TRAIN.NUM_WORKERS = 0
+# number of batches prepared ahead of training and number of threads preparing them,
+# with NUM_WORKERS > 0 every batch that can be in flight gets its own shared image buffers
+config.TRAIN.PREFETCH_DEPTH = 1
+config.TRAIN.PREFETCH_WORKERS = 1
+# time the phases of every training batch and log their rolling p50/p95 with the speed
+config.TRAIN.PHASE_TIMING = False
+# wait for the devices at the end of every phase, the phases are exact but training is slower
+config.TRAIN.PHASE_TIMING_SYNC = False
+# if given, a json line with the phase times of every batch is appended to this file
+config.TRAIN.PHASE_TRACE = ''
+# record time, copies and calls of the python custom operators and log them with the speed
+config.TRAIN.PROFILE_OPS = False
+# if given, every custom operator call is written to this chrome trace file
+config.TRAIN.PROFILE_OPS_TRACE = ''
 
 # R-CNN
 # rcnn rois batch size
@@ -157,8 +181,21 @@ config.TEST.PROPOSAL_MIN_SIZE = config.network.RPN_FEAT_STRIDE
 
 # RCNN nms
 config.TEST.NMS = 0.3
+# nms used by RCNN and the python proposal op: 'nms', 'soft_linear', 'soft_gaussian',
+# 'matrix_linear' or 'matrix_gaussian'
+config.TEST.NMS_TYPE = 'nms'
+# gaussian width of soft and matrix nms
+config.TEST.NMS_SIGMA = 0.5
+# soft and matrix nms drop detections whose decayed score falls below it
+config.TEST.NMS_SCORE_THRESH = 0.001
 
 config.TEST.max_per_image = 300
+# match detections image by image while testing instead of keeping all of them, VOC and COCO boxes
+config.TEST.INCREMENTAL_EVAL = False
+# log the running mAP every this many images, 0 to disable
+config.TEST.INCREMENTAL_EVAL_INTERVAL = 500
+# pad test images to multiples of it to bound the number of executors, 0 to not pad
+config.TEST.SHAPE_QUANTUM = 0
 
 # Test Model Epoch
 config.TEST.test_epoch = 0
@@ -15,17 +15,19 @@ import numpy as np
 from module import MutableModule
 from utils import image
 from bbox.bbox_transform import bbox_pred, clip_boxes
-from nms.nms import py_nms_wrapper, cpu_nms_wrapper, gpu_nms_wrapper
+from nms.nms import multiclass_nms
 from utils.PrefetchingIter import PrefetchingIter
+from dataset.proposal_store import ProposalWriter
 
 
 class Predictor(object):
     def __init__(self, symbol, data_names, label_names,
                  context=mx.cpu(), max_data_shapes=None,
                  provide_data=None, provide_label=None,
-                 arg_params=None, aux_params=None):
+                 arg_params=None, aux_params=None, max_cached_modules=8, shape_quantum=0):
         self._mod = MutableModule(symbol, data_names, label_names,
-                                  context=context, max_data_shapes=max_data_shapes)
+                                  context=context, max_data_shapes=max_data_shapes,
+                                  max_cached_modules=max_cached_modules, shape_quantum=shape_quantum)
         self._mod.bind(provide_data, provide_label, for_training=False)
         self._mod.init_params(arg_params=arg_params, aux_params=aux_params)
 
@@ -63,7 +65,7 @@ def generate_proposals(predictor, test_data, imdb, cfg, vis=False, thresh=0.):
     :param imdb: image database
     :param vis: controls visualization
     :param thresh: thresh for valid detections
-    :return: list of detected boxes
+    :return: ProposalStore of the detected boxes of every image
     """
     assert vis or not test_data.shuffle
     data_names = [k[0] for k in test_data.provide_data[0]]
@@ -71,10 +73,16 @@ def generate_proposals(predictor, test_data, imdb, cfg, vis=False, thresh=0.):
     if not isinstance(test_data, PrefetchingIter):
         test_data = PrefetchingIter(test_data)
 
+    # proposals are appended to the store image by image instead of kept until the end
+    rpn_folder = os.path.join(imdb.result_path, 'rpn_data')
+    if not os.path.exists(rpn_folder):
+        os.mkdir(rpn_folder)
+    rpn_prefix = os.path.join(rpn_folder, imdb.name + '_rpn')
+    rpn_writer = ProposalWriter(rpn_prefix)
+    full_rpn_writer = ProposalWriter(os.path.join(rpn_folder, imdb.name + '_full_rpn')) if thresh > 0 else None
+
     idx = 0
     t = time.time()
-    imdb_boxes = list()
-    original_boxes = list()
     for im_info, data_batch in test_data:
         t1 = time.time() - t
         t = time.time()
@@ -86,12 +94,13 @@ def generate_proposals(predictor, test_data, imdb, cfg, vis=False, thresh=0.):
         for delta, (scores, boxes, data_dict, scale) in enumerate(zip(scores_all, boxes_all, data_dict_all, scales)):
             # assemble proposals
             dets = np.hstack((boxes, scores))
-            original_boxes.append(dets)
+            if full_rpn_writer is not None:
+                full_rpn_writer.append(dets)
 
             # filter proposals
             keep = np.where(dets[:, 4:] > thresh)[0]
             dets = dets[keep, :]
-            imdb_boxes.append(dets)
+            rpn_writer.append(dets)
 
             if vis:
                 vis_all_detection(data_dict['data'].asnumpy(), [dets], ['obj'], scale, cfg)
@@ -101,23 +110,14 @@ def generate_proposals(predictor, test_data, imdb, cfg, vis=False, thresh=0.):
             idx += 1
 
 
-    assert len(imdb_boxes) == imdb.num_images, 'calculations not complete'
+    assert idx == imdb.num_images, 'calculations not complete'
 
     # save results
-    rpn_folder = os.path.join(imdb.result_path, 'rpn_data')
-    if not os.path.exists(rpn_folder):
-        os.mkdir(rpn_folder)
+    imdb_boxes = rpn_writer.close()
+    if full_rpn_writer is not None:
+        full_rpn_writer.close()
 
-    rpn_file = os.path.join(rpn_folder, imdb.name + '_rpn.pkl')
-    with open(rpn_file, 'wb') as f:
-        cPickle.dump(imdb_boxes, f, cPickle.HIGHEST_PROTOCOL)
-
-    if thresh > 0:
-        full_rpn_file = os.path.join(rpn_folder, imdb.name + '_full_rpn.pkl')
-        with open(full_rpn_file, 'wb') as f:
-            cPickle.dump(original_boxes, f, cPickle.HIGHEST_PROTOCOL)
-
-    print 'wrote rpn proposals to {}'.format(rpn_file)
+    print 'wrote rpn proposals to {}'.format(rpn_prefix + '.bin')
     return imdb_boxes
 
 
@@ -177,17 +177,17 @@ def pred_eval(predictor, test_data, imdb, cfg, vis=False, thresh=1e-3, logger=No
     if not isinstance(test_data, PrefetchingIter):
         test_data = PrefetchingIter(test_data)
 
-    nms = py_nms_wrapper(cfg.TEST.NMS)
-
     # limit detections to max_per_image over all classes
     max_per_image = cfg.TEST.max_per_image
 
     num_images = imdb.num_images
-    # all detections are collected into:
+    # detections are matched image by image and not kept if the dataset supports it
+    evaluator = imdb.incremental_evaluator() if cfg.TEST.INCREMENTAL_EVAL else None
+    # otherwise all detections are collected into:
     #    all_boxes[cls][image] = N x 5 array of detections in
     #    (x1, y1, x2, y2, score)
     all_boxes = [[[] for _ in range(num_images)]
-                 for _ in range(imdb.num_classes)]
+                 for _ in range(imdb.num_classes)] if evaluator is None else None
 
     idx = 0
     data_time, net_time, post_time = 0.0, 0.0, 0.0
@@ -202,25 +202,17 @@ def pred_eval(predictor, test_data, imdb, cfg, vis=False, thresh=1e-3, logger=No
         t2 = time.time() - t
         t = time.time()
         for delta, (scores, boxes, data_dict) in enumerate(zip(scores_all, boxes_all, data_dict_all)):
-            for j in range(1, imdb.num_classes):
-                indexes = np.where(scores[:, j] > thresh)[0]
-                cls_scores = scores[indexes, j, np.newaxis]
-                cls_boxes = boxes[indexes, 4:8] if cfg.CLASS_AGNOSTIC else boxes[indexes, j * 4:(j + 1) * 4]
-                cls_dets = np.hstack((cls_boxes, cls_scores))
-                keep = nms(cls_dets)
-                all_boxes[j][idx+delta] = cls_dets[keep, :]
-
-            if max_per_image > 0:
-                image_scores = np.hstack([all_boxes[j][idx+delta][:, -1]
-                                          for j in range(1, imdb.num_classes)])
-                if len(image_scores) > max_per_image:
-                    image_thresh = np.sort(image_scores)[-max_per_image]
-                    for j in range(1, imdb.num_classes):
-                        keep = np.where(all_boxes[j][idx+delta][:, -1] >= image_thresh)[0]
-                        all_boxes[j][idx+delta] = all_boxes[j][idx+delta][keep, :]
+            # nms of all classes and max_per_image selection in one call
+            cls_dets = multiclass_nms(scores, boxes, cfg.TEST.NMS, thresh, max_per_image, cfg.CLASS_AGNOSTIC,
+                                      cfg.TEST.NMS_TYPE, cfg.TEST.NMS_SIGMA, cfg.TEST.NMS_SCORE_THRESH)
+            if evaluator is not None:
+                evaluator.add(idx+delta, cls_dets)
+            else:
+                for j in range(1, imdb.num_classes):
+                    all_boxes[j][idx+delta] = cls_dets[j]
 
             if vis:
-                boxes_this_image = [[]] + [all_boxes[j][idx+delta] for j in range(1, imdb.num_classes)]
+                boxes_this_image = [[]] + [cls_dets[j] for j in range(1, imdb.num_classes)]
                 vis_all_detection(data_dict['data'].asnumpy(), boxes_this_image, imdb.classes, scales[delta], cfg)
 
         idx += test_data.batch_size
@@ -232,6 +224,18 @@ def pred_eval(predictor, test_data, imdb, cfg, vis=False, thresh=1e-3, logger=No
         print 'testing {}/{} data {:.4f}s net {:.4f}s post {:.4f}s'.format(idx, imdb.num_images, data_time / idx * test_data.batch_size, net_time / idx * test_data.batch_size, post_time / idx * test_data.batch_size)
         if logger:
             logger.info('testing {}/{} data {:.4f}s net {:.4f}s post {:.4f}s'.format(idx, imdb.num_images, data_time / idx * test_data.batch_size, net_time / idx * test_data.batch_size, post_time / idx * test_data.batch_size))
+        interval = cfg.TEST.INCREMENTAL_EVAL_INTERVAL
+        if evaluator is not None and interval > 0 and idx // interval > (idx - test_data.batch_size) // interval:
+            running_map = evaluator.mean_ap()
+            print 'running mAP {}/{}: {:.4f}'.format(idx, imdb.num_images, running_map)
+            if logger:
+                logger.info('running mAP {}/{}: {:.4f}'.format(idx, imdb.num_images, running_map))
+
+    if evaluator is not None:
+        info_str = imdb.evaluate_incremental(evaluator)
+        if logger:
+            logger.info('evaluate detections: \n{}'.format(info_str))
+        return
 
     with open(det_file, 'wb') as f:
         cPickle.dump(all_boxes, f, protocol=cPickle.HIGHEST_PROTOCOL)
@@ -30,7 +30,7 @@ from symbols import *
 from utils.load_model import load_param
 from utils.show_boxes import show_boxes
 from utils.tictoc import tic, toc
-from nms.nms import py_nms_wrapper, cpu_nms_wrapper, gpu_nms_wrapper
+from nms.nms import py_nms_wrapper, cpu_nms_wrapper, gpu_nms_wrapper, multiclass_nms
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Show Deformable ConvNets demo')
@@ -87,7 +87,6 @@ def main():
                           context=[mx.gpu(0)], max_data_shapes=max_data_shape,
                           provide_data=provide_data, provide_label=provide_label,
                           arg_params=arg_params, aux_params=aux_params)
-    nms = gpu_nms_wrapper(config.TEST.NMS, 0)
 
     # warm up
     for j in xrange(2):
@@ -108,15 +107,8 @@ def main():
         scores, boxes, data_dict = im_detect(predictor, data_batch, data_names, scales, config)
         boxes = boxes[0].astype('f')
         scores = scores[0].astype('f')
-        dets_nms = []
-        for j in range(1, scores.shape[1]):
-            cls_scores = scores[:, j, np.newaxis]
-            cls_boxes = boxes[:, 4:8] if config.CLASS_AGNOSTIC else boxes[:, j * 4:(j + 1) * 4]
-            cls_dets = np.hstack((cls_boxes, cls_scores))
-            keep = nms(cls_dets)
-            cls_dets = cls_dets[keep, :]
-            cls_dets = cls_dets[cls_dets[:, -1] > 0.7, :]
-            dets_nms.append(cls_dets)
+        # boxes scoring <= 0.7 can only suppress lower scoring boxes, so filtering before nms is equivalent
+        dets_nms = multiclass_nms(scores, boxes, config.TEST.NMS, 0.7, class_agnostic=config.CLASS_AGNOSTIC)[1:]
         print 'testing {} {:.4f}s'.format(im_name, toc())
         # visualize
         im = cv2.imread(cur_path + '/../demo/' + im_name)
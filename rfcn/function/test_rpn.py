@@ -62,7 +62,8 @@ def test_rpn(cfg, dataset, image_set, root_path, dataset_path,
     predictor = Predictor(sym, data_names, label_names,
                           context=ctx, max_data_shapes=max_data_shape,
                           provide_data=test_data.provide_data, provide_label=test_data.provide_label,
-                          arg_params=arg_params, aux_params=aux_params)
+                          arg_params=arg_params, aux_params=aux_params,
+                          max_cached_modules=cfg.network.EXECUTOR_CACHE_SIZE, shape_quantum=cfg.TEST.SHAPE_QUANTUM)
 
     # start testing
     imdb_boxes = generate_proposals(predictor, test_data, imdb, cfg, vis=vis, thresh=thresh)
@@ -86,7 +86,8 @@ def train_rcnn(cfg, dataset, image_set, root_path, dataset_path,
         fixed_param_prefix = cfg.network.FIXED_PARAMS
     mod = MutableModule(sym, data_names=data_names, label_names=label_names,
                         logger=logger, context=ctx,
-                        max_data_shapes=[max_data_shape for _ in range(batch_size)], fixed_param_prefix=fixed_param_prefix)
+                        max_data_shapes=[max_data_shape for _ in range(batch_size)], fixed_param_prefix=fixed_param_prefix,
+                        max_cached_modules=cfg.network.EXECUTOR_CACHE_SIZE)
 
     if cfg.TRAIN.RESUME:
         mod._preload_opt_states = '%s-%04d.states'%(prefix, begin_epoch)
@@ -124,10 +125,12 @@ def train_rcnn(cfg, dataset, image_set, root_path, dataset_path,
     # train
 
     if not isinstance(train_data, PrefetchingIter):
-        train_data = PrefetchingIter(train_data)
+        train_data = PrefetchingIter(train_data, prefetch_depth=cfg.TRAIN.PREFETCH_DEPTH,
+                                     num_workers=cfg.TRAIN.PREFETCH_WORKERS)
 
     mod.fit(train_data, eval_metric=eval_metrics, epoch_end_callback=epoch_end_callback,
             batch_end_callback=batch_end_callback, kvstore=kvstore,
             optimizer='sgd', optimizer_params=optimizer_params,
             arg_params=arg_params, aux_params=aux_params, begin_epoch=begin_epoch, num_epoch=end_epoch)
+    train_data.close()
 
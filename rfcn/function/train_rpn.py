@@ -89,7 +89,8 @@ def train_rpn(cfg, dataset, image_set, root_path, dataset_path,
         fixed_param_prefix = cfg.network.FIXED_PARAMS
     mod = MutableModule(sym, data_names=data_names, label_names=label_names,
                         logger=logger, context=ctx, max_data_shapes=[max_data_shape for _ in xrange(batch_size)],
-                        max_label_shapes=[max_label_shape for _ in xrange(batch_size)], fixed_param_prefix=fixed_param_prefix)
+                        max_label_shapes=[max_label_shape for _ in xrange(batch_size)], fixed_param_prefix=fixed_param_prefix,
+                        max_cached_modules=cfg.network.EXECUTOR_CACHE_SIZE)
 
     # decide training params
     # metric
@@ -121,11 +122,13 @@ def train_rpn(cfg, dataset, image_set, root_path, dataset_path,
                         'clip_gradient': None}
 
     if not isinstance(train_data, PrefetchingIter):
-        train_data = PrefetchingIter(train_data)
+        train_data = PrefetchingIter(train_data, prefetch_depth=cfg.TRAIN.PREFETCH_DEPTH,
+                                     num_workers=cfg.TRAIN.PREFETCH_WORKERS)
 
     # train
     mod.fit(train_data, eval_metric=eval_metrics, epoch_end_callback=epoch_end_callback,
             batch_end_callback=batch_end_callback, kvstore=kvstore,
             optimizer='sgd', optimizer_params=optimizer_params,
             arg_params=arg_params, aux_params=aux_params, begin_epoch=begin_epoch, num_epoch=end_epoch)
+    train_data.close()
 
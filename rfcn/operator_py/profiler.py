@@ -0,0 +1,158 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The Apache-2.0 License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Profiler of the python custom operators.
+Operators decorated with profile_op record the wall time, host device copy bytes and number
+of calls of their forward and backward once enable is called, and optionally each call as a
+chrome trace event (chrome://tracing). When disabled the decorated methods only check a flag.
+Inputs are counted as copied to host since the operators read them with asnumpy, the values
+assigned to outputs and gradients from host count as copied to device.
+"""
+
+import os
+import time
+import json
+import threading
+import numpy as np
+import mxnet as mx
+
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+# (op name, 'forward' or 'backward') -> [calls, seconds, bytes to host, bytes to device]
+_stats = dict()
+_trace = None
+
+
+def enable(trace_file=None):
+    """
+    start recording
+    :param trace_file: if given, every call is appended to it as a chrome trace event
+    :return: None
+    """
+    global _enabled, _trace
+    with _lock:
+        if trace_file and _trace is None:
+            _trace = open(trace_file, 'w')
+            # the json array format of chrome traces, the closing bracket is optional
+            _trace.write('[\n')
+        _enabled = True
+
+
+def disable():
+    """
+    stop recording and close the trace file
+    :return: None
+    """
+    global _enabled, _trace
+    with _lock:
+        _enabled = False
+        if _trace is not None:
+            _trace.close()
+            _trace = None
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    """
+    clear the recorded statistics
+    :return: None
+    """
+    with _lock:
+        _stats.clear()
+
+
+def stats():
+    """
+    :return: dict of (op name, 'forward' or 'backward') -> dict with 'calls', 'time', 'to_host', 'to_device'
+    """
+    with _lock:
+        return dict([(key, {'calls': v[0], 'time': v[1], 'to_host': v[2], 'to_device': v[3]})
+                     for key, v in _stats.items()])
+
+
+def summary(reset_stats=False):
+    """
+    :param reset_stats: clear the statistics afterwards, so the next summary covers the calls after this one
+    :return: calls, mean ms and copied MB of every op and pass
+    """
+    records = stats()
+    if reset_stats:
+        reset()
+    return ', '.join(['%s.%s=%dx%.1fms %.2f/%.2fMB' % (name, phase, v['calls'], v['time'] * 1000 / max(v['calls'], 1),
+                                                       v['to_host'] / 1e6, v['to_device'] / 1e6)
+                      for (name, phase), v in sorted(records.items())])
+
+
+def _nbytes(array):
+    if isinstance(array, np.ndarray):
+        return array.nbytes
+    if isinstance(array, mx.nd.NDArray):
+        return array.size * np.dtype(array.dtype).itemsize
+    # scalars are filled on device
+    return 0
+
+
+def _record(name, phase, tic, toc, to_host, to_device):
+    with _lock:
+        record = _stats.setdefault((name, phase), [0, 0.0, 0, 0])
+        record[0] += 1
+        record[1] += toc - tic
+        record[2] += to_host
+        record[3] += to_device
+        if _trace is not None:
+            _trace.write(json.dumps({'name': '%s.%s' % (name, phase), 'cat': 'custom_op', 'ph': 'X',
+                                     'ts': tic * 1e6, 'dur': (toc - tic) * 1e6,
+                                     'pid': os.getpid(), 'tid': threading.current_thread().ident,
+                                     'args': {'to_host': to_host, 'to_device': to_device}}) + ',\n')
+
+
+def profile_op(name):
+    """
+    class decorator of a mx.operator.CustomOp recording its forward and backward
+    :param name: op name in the statistics
+    :return: decorator
+    """
+    def decorate(cls):
+        forward = cls.forward
+        backward = cls.backward
+        assign = cls.assign
+
+        def _profiled(method, phase, inputs, self, *args):
+            if not _enabled:
+                return method(self, *args)
+            # time the op, not the producers of its inputs
+            for array in inputs:
+                array.wait_to_read()
+            _local.to_device = 0
+            tic = time.time()
+            method(self, *args)
+            toc = time.time()
+            _record(name, phase, tic, toc, sum([_nbytes(array) for array in inputs]) if phase == 'forward' else 0,
+                    _local.to_device)
+
+        def profiled_forward(self, is_train, req, in_data, out_data, aux):
+            return _profiled(forward, 'forward', in_data, self, is_train, req, in_data, out_data, aux)
+
+        def profiled_backward(self, req, out_grad, in_data, out_data, in_grad, aux):
+            return _profiled(backward, 'backward', out_grad, self, req, out_grad, in_data, out_data, in_grad, aux)
+
+        def profiled_assign(self, dst, req, src):
+            if _enabled and req != 'null':
+                _local.to_device = getattr(_local, 'to_device', 0) + _nbytes(src)
+            return assign(self, dst, req, src)
+
+        profiled_forward.__doc__ = forward.__doc__
+        profiled_backward.__doc__ = backward.__doc__
+        cls.forward = profiled_forward
+        cls.backward = profiled_backward
+        cls.assign = profiled_assign
+        return cls
+    return decorate
@@ -786,7 +786,8 @@ class deform_conv_demo(Symbol):
                     op_type='proposal', feat_stride=cfg.network.RPN_FEAT_STRIDE,
                     scales=tuple(cfg.network.ANCHOR_SCALES), ratios=tuple(cfg.network.ANCHOR_RATIOS),
                     rpn_pre_nms_top_n=cfg.TEST.RPN_PRE_NMS_TOP_N, rpn_post_nms_top_n=cfg.TEST.RPN_POST_NMS_TOP_N,
-                    threshold=cfg.TEST.RPN_NMS_THRESH, rpn_min_size=cfg.TEST.RPN_MIN_SIZE)
+                    threshold=cfg.TEST.RPN_NMS_THRESH, rpn_min_size=cfg.TEST.RPN_MIN_SIZE,
+                    nms_type=cfg.TEST.NMS_TYPE, nms_sigma=cfg.TEST.NMS_SIGMA)
 
 
 
@@ -889,7 +890,8 @@ class deform_conv_demo(Symbol):
                     op_type='proposal', feat_stride=cfg.network.RPN_FEAT_STRIDE,
                     scales=tuple(cfg.network.ANCHOR_SCALES), ratios=tuple(cfg.network.ANCHOR_RATIOS),
                     rpn_pre_nms_top_n=cfg.TEST.RPN_PRE_NMS_TOP_N, rpn_post_nms_top_n=cfg.TEST.RPN_POST_NMS_TOP_N,
-                    threshold=cfg.TEST.RPN_NMS_THRESH, rpn_min_size=cfg.TEST.RPN_MIN_SIZE)
+                    threshold=cfg.TEST.RPN_NMS_THRESH, rpn_min_size=cfg.TEST.RPN_MIN_SIZE,
+                    nms_type=cfg.TEST.NMS_TYPE, nms_sigma=cfg.TEST.NMS_SIGMA)
                 group = mx.symbol.Group([rois, score])
         self.sym = group
         return group